@@ -1,8 +1,23 @@
+from . import bloom
+from . import cache
+from . import compression
 from . import hashify
+from . import locking
 from . import model
+from . import migration
+from . import pack
+from . import storage
+from . import scrub
+from . import gc
+from . import sync
+from . import tuning
 from . import database
+from . import aio
 from .database import Base, DigestDB
+from .aio import AsyncDigestDB
 
 __version__ = "16.08.01"
 
-(hashify, model, database, Base, DigestDB)  # Silence pep8 unused warning
+(bloom, cache, compression, hashify, locking, model, migration, pack,
+ storage, scrub, gc, sync, tuning, database, aio, Base, DigestDB,
+ AsyncDigestDB)  # Silence pep8 unused warning
@@ -0,0 +1,660 @@
+''' This module provides an asyncio front-end to the DigestDB '''
+
+import asyncio
+import collections
+import functools
+import itertools
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import (
+    PUT_DUPLICATE, PUT_STORED, DigestDB, GetResult, PutResult, hash_data_item)
+from .gc import Collector, GCReport, RetentionPolicy
+from .scrub import ScrubReport, Scrubber
+
+# type annotations
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Set, Tuple)
+import datetime
+from .database import QueryResult
+
+
+logger = logging.getLogger(__name__)
+
+
+def _operation(method: Callable) -> Callable:
+    '''
+    Decorate a coroutine method of :class:`AsyncDigestDB` so that it holds
+    one of the ``max_pending`` slots from when it starts until it finishes,
+    however many steps it runs in the executors.
+    '''
+    @functools.wraps(method)
+    async def wrapper(self: 'AsyncDigestDB', *args: Any, **kwargs: Any) -> Any:
+        async with self._semaphore:
+            return await method(self, *args, **kwargs)
+    return wrapper
+
+
+class AsyncDigestDB(object):
+    '''
+    This class provides awaitable access to a :class:`DigestDB`.
+
+    The blocking disk and SQLite operations are run in executors so that
+    they do not block the event loop. The same on-disk layout is used as
+    the synchronous :class:`DigestDB` so both can be used (one at a time)
+    with the same database.
+
+    SQLite sessions can not be shared between threads so all metadata
+    operations are performed by a single dedicated thread. Blob file
+    operations (hashing, reading and writing) are performed by a bounded
+    pool of I/O threads.
+
+    The number of operations that can be in progress at once is limited by
+    ``max_pending``. Additional requests wait on the event loop, without
+    consuming a thread, until an earlier operation completes. This applies
+    backpressure to callers issuing large numbers of concurrent requests.
+    An operation holds its slot from start to finish, however many steps
+    it takes, so long running operations such as :meth:`scrub` occupy one
+    slot throughout. Each step of an asynchronous iterator is an operation
+    of its own.
+
+    .. code-block:: python
+
+        db = AsyncDigestDB('/tmp/store')
+        await db.open()
+        digest = await db.put_data('js', b'...')
+        data = await db.get_data(digest)
+        await db.close()
+    '''
+
+    def __init__(self,
+                 db_dir: str,
+                 max_workers: int = 4,
+                 max_pending: int = 64,
+                 **kwargs: Any) -> None:
+        '''
+
+        :param db_dir: the top level directory that the blob database will use
+          for its file and directory artefacts. See :class:`DigestDB`.
+
+        :param max_workers: the number of threads used to perform blob file
+          I/O.
+
+        :param max_pending: the maximum number of operations that can be
+          in progress at any time. Further requests wait until a slot
+          becomes available.
+
+        :param kwargs: any additional keyword arguments are passed to the
+          :class:`DigestDB` constructor.
+        '''
+        self.db = DigestDB(db_dir, **kwargs)
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._io_executor = None  # type: ThreadPoolExecutor
+        self._db_executor = None  # type: ThreadPoolExecutor
+        self._semaphore = None  # type: asyncio.Semaphore
+
+    def __repr__(self) -> str:
+        return "<AsyncDigestDB '{}'>".format(self.db.db_dir)
+
+    async def __aenter__(self) -> 'AsyncDigestDB':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def _run(self,
+                   executor: ThreadPoolExecutor,
+                   func: Callable,
+                   *args: Any,
+                   **kwargs: Any) -> Any:
+        '''
+        Run a blocking function in an executor. The caller should hold a
+        slot (see :func:`_operation`).
+        '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args, **kwargs))
+
+    async def open(self,
+                   bulk_load: bool = False,
+                   read_only: bool = False) -> None:
+        ''' Open the database.
+
+        This will create the database file if necessary or will open an
+        existing file if one is present.
+
+        :param bulk_load: use the 'bulk-load' SQLite profile until the
+          database is closed. See :meth:`DigestDB.open`.
+
+        :param read_only: open an existing database for reading alongside
+          a writer in another process. See :meth:`DigestDB.open`.
+        '''
+        self._semaphore = asyncio.Semaphore(self.max_pending)
+        self._io_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._db_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            await self._run(
+                self._db_executor, self.db.open, bulk_load, read_only)
+        except Exception:
+            self._shutdown_executors()
+            raise
+
+    @_operation
+    async def close(self) -> None:
+        ''' Close the database '''
+        try:
+            await self._run(self._db_executor, self.db.close)
+        finally:
+            self._shutdown_executors()
+
+    def _shutdown_executors(self) -> None:
+        for executor in (self._io_executor, self._db_executor):
+            if executor:
+                executor.shutdown(wait=True)
+        self._io_executor = None
+        self._db_executor = None
+
+    @_operation
+    async def put_category(self,
+                           label: str,
+                           description: str = '') -> None:
+        ''' Add a category to the database. See :meth:`DigestDB.put_category`
+        '''
+        await self._run(
+            self._db_executor, self.db.put_category, label, description)
+
+    @_operation
+    async def get_category(self,
+                           label: str) -> Tuple[str, str]:
+        ''' Return the contents of a category.
+        See :meth:`DigestDB.get_category`
+        '''
+        return await self._run(
+            self._db_executor, self.db.get_category, label)
+
+    @_operation
+    async def set_retention(self,
+                            label: str,
+                            max_age: float = None,
+                            max_bytes: int = None,
+                            max_count: int = None) -> None:
+        ''' Set the retention policy of a category.
+        See :meth:`DigestDB.set_retention`
+        '''
+        await self._run(
+            self._db_executor, self.db.set_retention, label, max_age,
+            max_bytes, max_count)
+
+    @_operation
+    async def get_retention(self,
+                            label: str) -> RetentionPolicy:
+        ''' Return the retention policy of a category.
+        See :meth:`DigestDB.get_retention`
+        '''
+        return await self._run(
+            self._db_executor, self.db.get_retention, label)
+
+    @_operation
+    async def put_data(self,
+                       category: str,
+                       data: bytes,
+                       timestamp: datetime.datetime = None) -> bytes:
+        '''
+        Add a data item to the database.
+
+        The data is hashed and written to storage by an I/O thread
+        and then the metadata is added by the database thread.
+
+        :param category: a category label that must match an existing
+          category in the database.
+
+        :param data: the binary data to be stored in the database.
+
+        :param timestamp: a specific timestamp to store alongside the metadata
+          instead of the default `now` timestamp used if this field if left
+          as its default of None.
+
+        :return: a bytes object representing the hash digest of the data item
+        '''
+        db = self.db
+        digest, error = await self._run(
+            self._io_executor, hash_data_item, data, db.hash_name)
+        if error:
+            raise error
+        if await self._is_damaged(digest):
+            await self._repair(category, digest, data, occurrence=dict(
+                digest=digest, category_label=category,
+                timestamp=timestamp or datetime.datetime.now()))
+            return digest
+        stored, codec, dictionary_id = await self._run(
+            self._io_executor, db._encode, data, category)
+        await self._run(self._io_executor, db.storage.put, digest, stored)
+        await self._run(
+            self._db_executor, db._put_data_digest,
+            category, digest, len(data), timestamp=timestamp, codec=codec,
+            dictionary_id=dictionary_id)
+        return digest
+
+    @_operation
+    async def put_data_dedup(self,
+                             category: str,
+                             data: bytes,
+                             timestamp: datetime.datetime = None,
+                             digest: bytes = None,
+                             reference: bool = False) -> PutResult:
+        '''
+        Add a data item to the database unless it is already stored. See
+        :meth:`DigestDB.put_data_dedup`.
+
+        :return: a :class:`PutResult` with a ``stored`` status if the item
+          was added or a ``duplicate`` status if it was already stored.
+        '''
+        db = self.db
+        if digest is None:
+            digest, error = await self._run(
+                self._io_executor, hash_data_item, data, db.hash_name)
+            if error:
+                raise error
+        if await self._run(self._db_executor, db._is_recorded, digest):
+            if await self._run(self._db_executor, db._is_damaged, digest):
+                occurrence = None
+                if reference:
+                    occurrence = dict(
+                        digest=digest, category_label=category,
+                        timestamp=timestamp or datetime.datetime.now())
+                await self._repair(
+                    category, digest, data, occurrence=occurrence)
+                return PutResult(digest, PUT_STORED, None)
+            if reference:
+                await self._run(
+                    self._db_executor, db._add_references, [dict(
+                        digest=digest, category_label=category,
+                        timestamp=timestamp or datetime.datetime.now())])
+            return PutResult(digest, PUT_DUPLICATE, None)
+        stored, codec, dictionary_id = await self._run(
+            self._io_executor, db._encode, data, category)
+        await self._run(
+            self._io_executor, db._put_or_replace, digest, stored)
+        await self._run(
+            self._db_executor, db._put_data_digest,
+            category, digest, len(data), timestamp=timestamp, codec=codec,
+            dictionary_id=dictionary_id)
+        return PutResult(digest, PUT_STORED, None)
+
+    async def _is_damaged(self, digest: bytes) -> bool:
+        '''
+        Return True if an item is stored and the scrubber found its stored
+        copy damaged or quarantined it. The caller should hold a slot.
+        '''
+        db = self.db
+        if not await self._run(self._db_executor, db._is_recorded, digest):
+            return False
+        return await self._run(self._db_executor, db._is_damaged, digest)
+
+    async def _repair(self,
+                      category: str,
+                      digest: bytes,
+                      data: bytes,
+                      occurrence: Dict = None) -> None:
+        '''
+        Store a damaged data item again. See :meth:`DigestDB._repair`. The
+        caller should hold a slot.
+        '''
+        db = self.db
+        stored, codec, dictionary_id = await self._run(
+            self._io_executor, db._encode, data, category)
+        await self._run(
+            self._io_executor, db._put_or_replace, digest, stored)
+        await self._run(
+            self._db_executor, db._record_repair, digest, len(data), codec,
+            dictionary_id, occurrence=occurrence)
+
+    @_operation
+    async def query_occurrences(
+            self,
+            digest: bytes) -> List[Tuple[str, datetime.datetime]]:
+        '''
+        Return each time a data item was stored. See
+        :meth:`DigestDB.query_occurrences`.
+        '''
+        return await self._run(
+            self._db_executor, self.db.query_occurrences, digest)
+
+    @_operation
+    async def get_data(self, digest: bytes) -> bytes:
+        ''' Return the contents of a data item.
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :return: bytes, or None if the item could not be found.
+        '''
+        db = self.db
+        codec, dictionary = await self._run(
+            self._db_executor, db._encoding, digest)
+        return await self._run(
+            self._io_executor, db._read_data, digest, codec, dictionary)
+
+    @_operation
+    async def get_data_many(self,
+                            digests: Iterable[bytes],
+                            window: int = 64) -> List[GetResult]:
+        '''
+        Return the contents of many data items, read concurrently by the
+        I/O threads. See :meth:`DigestDB.get_data_many`.
+
+        :param digests: an iterable of digests of the data items to return.
+
+        :param window: the maximum number of items being read at once. The
+          window is refilled in batches, once half of it has been read, and
+          each batch is read in the storage's order.
+
+        :return: a list of :class:`GetResult` 3-tuples of (digest, data,
+          error), one for each distinct digest in the order they were first
+          requested.
+
+        :raises: Exception if an invalid argument is used.
+        '''
+        if window < 1:
+            raise Exception(
+                'Invalid window. Expected at least 1 but got {}'.format(
+                    window))
+        db = self.db
+        requested = list(collections.OrderedDict.fromkeys(digests))
+        encodings = await self._run(
+            self._db_executor, db._encodings, requested)
+        results = {}  # type: Dict[bytes, GetResult]
+        pending = set()  # type: Set[asyncio.Future]
+        position = 0
+        try:
+            while pending or position < len(requested):
+                if position < len(requested) and \
+                        len(pending) <= window // 2:
+                    batch = requested[
+                        position:position + window - len(pending)]
+                    position += len(batch)
+                    order = await self._run(
+                        self._io_executor, db.storage.read_order, batch)
+                    pending.update(
+                        asyncio.ensure_future(self._run(
+                            self._io_executor, db._get_item, digest,
+                            *encodings.get(digest, (None, None))))
+                        for digest in order)
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results[result.digest] = result
+        finally:
+            for future in pending:
+                future.cancel()
+        return [results[digest] for digest in requested]
+
+    def iter_data(self,
+                  digest: bytes,
+                  chunk_size: int = 2**20) -> 'AsyncChunkIterator':
+        '''
+        Return an asynchronous iterator over the contents of a data item.
+
+        This avoids reading large items completely into memory.
+
+        .. code-block:: python
+
+            async for chunk in db.iter_data(digest):
+                print(chunk)
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :param chunk_size: the number of bytes to read from the file per
+          iteration.
+
+        :raises: OSError exception, when iterated, if the item's file does
+          not exist.
+        '''
+        return AsyncChunkIterator(self, digest, chunk_size)
+
+    @_operation
+    async def exists(self, digest: bytes) -> bool:
+        ''' Check if an entry exists in the database for the digest.
+        See :meth:`DigestDB.exists`
+        '''
+        return await self._run(self._db_executor, self.db.exists, digest)
+
+    @_operation
+    async def query_data(self,
+                         **filters: Any) -> QueryResult:
+        ''' Query data items in the database.
+        See :meth:`DigestDB.query_data`
+        '''
+        return await self._run(
+            self._db_executor, self.db.query_data, **filters)
+
+    def iter_query_data(self,
+                        batch_size: int = 1000,
+                        **filters: Any) -> 'AsyncQueryIterator':
+        '''
+        Return an asynchronous iterator over the data items matching a
+        query. See :meth:`DigestDB.iter_query_data`.
+
+        .. code-block:: python
+
+            async for row in db.iter_query_data(category='js'):
+                print(row.digest)
+
+        :param batch_size: the number of rows fetched by the database
+          thread at a time.
+        '''
+        return AsyncQueryIterator(
+            self, self.db.iter_query_data, batch_size, filters)
+
+    def iter_query_category(self,
+                            batch_size: int = 1000,
+                            **filters: Any) -> 'AsyncQueryIterator':
+        '''
+        Return an asynchronous iterator over the categories matching a
+        query. See :meth:`DigestDB.iter_query_category`.
+
+        :param batch_size: the number of rows fetched by the database
+          thread at a time.
+        '''
+        return AsyncQueryIterator(
+            self, self.db.iter_query_category, batch_size, filters)
+
+    @_operation
+    async def count_data(self) -> int:
+        ''' Return the number of data items in the database. '''
+        return await self._run(self._db_executor, self.db.count_data)
+
+    @_operation
+    async def retrain_dictionaries(self,
+                                   categories: Iterable[str] = None,
+                                   samples: int = 1000,
+                                   size: int = 16384,
+                                   recompress: bool = True,
+                                   batch_size: int = 100) -> Dict[str, int]:
+        '''
+        Train a new compression dictionary for each category and recompress
+        the existing data items in the category using it.
+        See :meth:`DigestDB.retrain_dictionaries`.
+
+        The work is split into small steps so other operations continue to
+        be served while it runs. It can be run in the background using:
+
+        .. code-block:: python
+
+            task = asyncio.ensure_future(db.retrain_dictionaries())
+
+        :return: a dict mapping each retrained category label to the version
+          of its new dictionary.
+        '''
+        db = self.db
+        categories = await self._run(
+            self._db_executor, db._dictionary_categories, categories)
+        versions = {}  # type: Dict[str, int]
+        for category in categories:
+            versions[category] = await self._run(
+                self._db_executor, db.train_dictionary, category,
+                samples=samples, size=size)
+            if not recompress:
+                continue
+            after = b''
+            while True:
+                candidates = await self._run(
+                    self._db_executor, db._recompress_candidates,
+                    category, after, batch_size)
+                if not candidates:
+                    break
+                after = candidates[-1][0]
+                updates = await self._run(
+                    self._io_executor, db._recompress_items,
+                    category, candidates)
+                await self._run(
+                    self._db_executor, db._update_encodings, updates)
+            await self._run(
+                self._db_executor, db._prune_dictionaries, category)
+        return versions
+
+    @_operation
+    async def scrub(self,
+                    rate: float = None,
+                    max_age: float = None,
+                    limit: int = None,
+                    quarantine: bool = False,
+                    batch_size: int = 64) -> ScrubReport:
+        '''
+        Verify that the data items in storage still hash to their digests.
+        See :meth:`DigestDB.scrub`.
+
+        Items are checked by the I/O threads and the database thread is
+        only used between batches, so other operations continue to be
+        served while a scrub runs.
+
+        :return: a :class:`scrub.ScrubReport` listing the problems found.
+        '''
+        db = self.db
+        scrubber = Scrubber(
+            db, rate=rate, max_age=max_age, limit=limit,
+            quarantine=quarantine, batch_size=batch_size)
+        while True:
+            rows = await self._run(self._db_executor, scrubber.next_batch)
+            if not rows:
+                break
+            by_digest = dict((row[0], row) for row in rows)
+            order = await self._run(
+                self._io_executor, db.storage.read_order, list(by_digest))
+            results = await asyncio.gather(*[
+                self._run(
+                    self._io_executor, scrubber.check_row, by_digest[digest])
+                for digest in order])
+            await self._run(self._db_executor, scrubber.record, results)
+        return scrubber.report()
+
+    @_operation
+    async def collect_garbage(self,
+                              categories: Iterable[str] = None,
+                              rate: float = None,
+                              limit: int = None,
+                              batch_size: int = 1000) -> GCReport:
+        '''
+        Enforce the retention policies of the categories. See
+        :meth:`DigestDB.collect_garbage`.
+
+        Each batch is deleted by the database thread and the rate limit is
+        waited out in an I/O thread, so other operations are served between
+        batches and a collection can run in the background alongside
+        ingest.
+
+        :return: a :class:`gc.GCReport` counting what was reclaimed.
+        '''
+        collector = Collector(
+            self.db, categories=categories, rate=rate, limit=limit,
+            batch_size=batch_size)
+        batches = collector.batches()
+        while True:
+            batch = await self._run(self._db_executor, next, batches, None)
+            if batch is None:
+                break
+            label, ids = batch
+            await self._run(self._db_executor, collector.collect, label, ids)
+            await self._run(self._io_executor, collector.throttle, len(ids))
+        return collector.report()
+
+
+class AsyncChunkIterator(object):
+    '''
+    An asynchronous iterator that reads each chunk of a data item in an
+    I/O thread.
+
+    The codec and dictionary used to store the item are looked up by the
+    database thread when the first chunk is requested.
+    '''
+
+    def __init__(self,
+                 db: AsyncDigestDB,
+                 digest: bytes,
+                 chunk_size: int) -> None:
+        self.db = db
+        self.digest = digest
+        self.chunk_size = chunk_size
+        self.chunks = None  # type: Iterator[bytes]
+
+    def __aiter__(self) -> 'AsyncChunkIterator':
+        return self
+
+    async def __anext__(self) -> bytes:
+        async with self.db._semaphore:
+            if self.chunks is None:
+                db = self.db.db
+                codec, dictionary = await self.db._run(
+                    self.db._db_executor, db._encoding, self.digest)
+                self.chunks = db._iter_stored(
+                    self.digest, self.chunk_size, codec, dictionary)
+            # A StopIteration can not be raised through a future so a
+            # sentinel value is used to detect the end of the generator.
+            chunk = await self.db._run(
+                self.db._io_executor, next, self.chunks, None)
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+
+class AsyncQueryIterator(object):
+    '''
+    An asynchronous iterator over the rows of a query.
+
+    The query is run by the database thread, which fetches a batch of rows
+    each time the previous batch has been consumed.
+    '''
+
+    def __init__(self,
+                 db: AsyncDigestDB,
+                 query: Callable[..., Iterator],
+                 batch_size: int,
+                 filters: Dict[str, Any]) -> None:
+        self.db = db
+        self.query = query
+        self.batch_size = batch_size
+        self.filters = filters
+        self.rows = None  # type: Iterator
+        self.batch = collections.deque()  # type: collections.deque
+
+    def __aiter__(self) -> 'AsyncQueryIterator':
+        return self
+
+    def _fetch(self) -> List:
+        if self.rows is None:
+            self.rows = self.query(batch_size=self.batch_size, **self.filters)
+        return list(itertools.islice(self.rows, self.batch_size))
+
+    async def __anext__(self) -> Any:
+        if not self.batch:
+            async with self.db._semaphore:
+                self.batch.extend(
+                    await self.db._run(self.db._db_executor, self._fetch))
+            if not self.batch:
+                raise StopAsyncIteration
+        return self.batch.popleft()
@@ -0,0 +1,148 @@
+''' This module implements a Bloom filter used to skip negative lookups '''
+
+import hashlib
+import math
+import os
+import struct
+import threading
+
+# type annotations
+from typing import Iterable
+
+
+# Persisted filter files start with this header. The header fields are the
+# magic bytes, format version, number of bits, number of hash functions,
+# and the number of items added.
+HEADER_FORMAT = '<8sIQIQ'
+HEADER_MAGIC = b'DDBBLOOM'
+HEADER_VERSION = 1
+
+
+class BloomFilter(object):
+    '''
+    A Bloom filter is a compact probabilistic set. A membership test can
+    return a false positive but never a false negative. This makes it useful
+    for answering "definitely not present" without performing any I/O.
+
+    Items can not be removed from a Bloom filter. Removing an item from the
+    underlying set simply leaves a possible false positive behind.
+
+    Keys are expected to be digests, which are already uniformly distributed,
+    so the bit positions are derived directly from the key bytes using
+    double hashing rather than by hashing the key again.
+    '''
+
+    def __init__(self,
+                 capacity: int,
+                 error_rate: float = 0.01) -> None:
+        '''
+
+        :param capacity: the number of items the filter is sized for. The
+          false positive rate rises above ``error_rate`` once more items than
+          this have been added.
+
+        :param error_rate: the desired false positive rate at capacity.
+        '''
+        if not isinstance(capacity, int) or capacity < 1:
+            raise Exception(
+                'Invalid capacity. Value must be an integer, 1 or greater, '
+                'got: {}'.format(capacity))
+        if not 0 < error_rate < 1:
+            raise Exception(
+                'Invalid error_rate. Value must be between 0 and 1, '
+                'got: {}'.format(error_rate))
+        num_bits = int(
+            math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        self._setup(num_bits, num_hashes)
+
+    def _setup(self, num_bits: int, num_hashes: int) -> None:
+        # round the number of bits up to a whole number of bytes
+        self.num_bits = ((num_bits + 7) // 8) * 8
+        self.num_hashes = num_hashes
+        self.count = 0
+        self.bits = bytearray(self.num_bits // 8)
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return '<BloomFilter bits={} hashes={} count={}>'.format(
+            self.num_bits, self.num_hashes, self.count)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, key: bytes) -> bool:
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _positions(self, key: bytes) -> Iterable[int]:
+        ''' Return the bit positions for a key '''
+        if len(key) < 16:
+            # Short keys are not digests, spread them out first.
+            key = hashlib.sha256(key).digest()
+        h1, h2 = struct.unpack_from('<QQ', key)
+        h2 |= 1  # an odd step visits more distinct positions
+        num_bits = self.num_bits
+        return ((h1 + i * h2) % num_bits for i in range(self.num_hashes))
+
+    def add(self, key: bytes) -> None:
+        ''' Add a key to the filter '''
+        bits = self.bits
+        with self._lock:
+            for position in self._positions(key):
+                bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def update(self, keys: Iterable[bytes]) -> None:
+        ''' Add many keys to the filter '''
+        for key in keys:
+            self.add(key)
+
+    def save(self, path: str) -> None:
+        '''
+        Write the filter to a file.
+
+        The file is written to a temporary name and then renamed so that a
+        partially written filter is never loaded.
+
+        :param path: the file path to write the filter to.
+        '''
+        temp_path = '{}.tmp'.format(path)
+        with self._lock:
+            with open(temp_path, 'wb') as fd:
+                fd.write(struct.pack(
+                    HEADER_FORMAT, HEADER_MAGIC, HEADER_VERSION,
+                    self.num_bits, self.num_hashes, self.count))
+                fd.write(self.bits)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'BloomFilter':
+        '''
+        Read a filter from a file previously written by :meth:`save`.
+
+        :param path: the file path to read the filter from.
+
+        :raises: OSError if the file can not be read.
+
+        :raises: Exception if the file is not a valid filter.
+        '''
+        header_size = struct.calcsize(HEADER_FORMAT)
+        with open(path, 'rb') as fd:
+            header = fd.read(header_size)
+            bits = fd.read()
+        if len(header) != header_size:
+            raise Exception('Invalid bloom filter file: {}'.format(path))
+        magic, version, num_bits, num_hashes, count = struct.unpack(
+            HEADER_FORMAT, header)
+        if magic != HEADER_MAGIC or version != HEADER_VERSION or \
+                len(bits) * 8 != num_bits:
+            raise Exception('Invalid bloom filter file: {}'.format(path))
+        bf = cls.__new__(cls)
+        bf._setup(num_bits, num_hashes)
+        bf.bits = bytearray(bits)
+        bf.count = count
+        return bf
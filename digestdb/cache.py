@@ -0,0 +1,118 @@
+''' This module implements a bounded in-process cache used by the DigestDB '''
+
+import collections
+import threading
+import time
+
+# type annotations
+from typing import Any, Callable, Hashable, NamedTuple
+
+
+CacheInfo = NamedTuple('CacheInfo', [
+    ('hits', int),
+    ('misses', int),
+    ('maxsize', int),
+    ('currsize', int)])
+
+
+# A sentinel used to distinguish a cache miss from a cached None value.
+MISSING = object()
+
+
+class LRUCache(object):
+    '''
+    A bounded, least recently used, cache with an optional time to live.
+
+    When the cache is full the least recently used entry is discarded to
+    make room for a new entry. Entries older than ``ttl`` seconds are
+    treated as misses and discarded when they are next looked up.
+
+    The cache keeps counts of the number of hits and misses so that its
+    effectiveness can be monitored. All operations are thread safe.
+    '''
+
+    def __init__(self,
+                 maxsize: int = 4096,
+                 ttl: float = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        '''
+
+        :param maxsize: the maximum number of entries stored in the cache.
+
+        :param ttl: the number of seconds an entry remains valid for. If
+          None then entries remain valid until they are evicted.
+
+        :param clock: a function returning the current time in seconds.
+        '''
+        if not isinstance(maxsize, int) or maxsize < 1:
+            raise Exception(
+                'Invalid maxsize. Value must be an integer, 1 or greater, '
+                'got: {}'.format(maxsize))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = \
+            collections.OrderedDict()  # type: collections.OrderedDict
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return '<LRUCache {}>'.format(self.info())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        '''
+        Return the value stored for a key.
+
+        :param key: the cache key.
+
+        :param default: the value to return if the key is not in the cache
+          or its entry has expired. Defaults to the :data:`MISSING` sentinel.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        '''
+        Store a value for a key, evicting the least recently used entry if
+        the cache is full.
+
+        :param key: the cache key.
+
+        :param value: the value to store.
+        '''
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        ''' Remove an entry from the cache, if present '''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        ''' Remove all entries from the cache and reset the counters '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        ''' Return the cache statistics '''
+        return CacheInfo(
+            self.hits, self.misses, self.maxsize, len(self._entries))
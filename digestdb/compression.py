@@ -0,0 +1,455 @@
+''' This module implements the compression codecs used to store blobs '''
+
+import bz2
+import collections
+import itertools
+import lzma
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# type annotations
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+    Tuple)
+
+
+class Codec(object):
+    '''
+    A compression codec.
+
+    :param name: the name recorded against each blob compressed using this
+      codec.
+
+    :param compress: a function that accepts data, a compression level
+      (which may be None to use the codec's default) and a dictionary (which
+      may be None) and returns the compressed data.
+
+    :param decompressobj: a function that accepts a dictionary (which may be
+      None) and returns a new streaming decompressor object. The object must
+      provide a ``decompress`` method and may provide a ``flush`` method.
+
+    :param train: a function that accepts a list of sample data items and a
+      maximum size and returns a dictionary. If None then the codec does not
+      support dictionaries.
+    '''
+
+    def __init__(self,
+                 name: str,
+                 compress: Callable[[bytes, int, Optional[bytes]], bytes],
+                 decompressobj: Callable[[Optional[bytes]], Any],
+                 train: Callable[[List[bytes], int], bytes] = None) -> None:
+        self.name = name
+        self._compress = compress
+        self._decompressobj = decompressobj
+        self._train = train
+
+    def __repr__(self) -> str:
+        return "<Codec '{}'>".format(self.name)
+
+    @property
+    def supports_dictionary(self) -> bool:
+        ''' True if the codec can use a trained dictionary '''
+        return self._train is not None
+
+    def _check_dictionary(self, dictionary: Optional[bytes]) -> None:
+        if dictionary is not None and not self.supports_dictionary:
+            raise Exception(
+                'Compression codec {} does not support dictionaries'.format(
+                    self.name))
+
+    def compress(self,
+                 data: bytes,
+                 level: int = None,
+                 dictionary: bytes = None) -> bytes:
+        ''' Return the compressed form of data '''
+        self._check_dictionary(dictionary)
+        return self._compress(data, level, dictionary)
+
+    def decompress(self, data: bytes, dictionary: bytes = None) -> bytes:
+        ''' Return the decompressed form of data '''
+        return b''.join(self.iter_decompress([data], dictionary=dictionary))
+
+    def iter_decompress(self,
+                        chunks: Iterable[bytes],
+                        dictionary: bytes = None) -> Iterator[bytes]:
+        '''
+        Decompress a stream of compressed chunks.
+
+        :param chunks: an iterable of compressed bytes objects.
+
+        :param dictionary: the dictionary the data was compressed with, if
+          any.
+
+        :return: an iterator of decompressed bytes objects.
+        '''
+        self._check_dictionary(dictionary)
+        decompressor = self._decompressobj(dictionary)
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        flush = getattr(decompressor, 'flush', None)
+        if flush:
+            data = flush()
+            if data:
+                yield data
+
+
+# zlib can only refer back this far so larger dictionaries are wasted.
+ZLIB_MAX_DICTIONARY_SIZE = 32768
+
+
+def _zlib_compress(data: bytes, level: int, dictionary: bytes) -> bytes:
+    level = -1 if level is None else level
+    if dictionary is None:
+        return zlib.compress(data, level)
+    compressor = zlib.compressobj(level, zdict=dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib_decompressobj(dictionary: bytes) -> Any:
+    if dictionary is None:
+        return zlib.decompressobj()
+    return zlib.decompressobj(zdict=dictionary)
+
+
+def _zlib_train(samples: List[bytes], size: int) -> bytes:
+    '''
+    Build a zlib preset dictionary from sample data items.
+
+    zlib has no dictionary trainer so the dictionary is assembled from the
+    fixed size segments that occur in the most samples, preceded by recent
+    sample data. Segments are placed in order of increasing frequency
+    because zlib encodes matches near the end of the dictionary most
+    cheaply.
+    '''
+    size = min(size, ZLIB_MAX_DICTIONARY_SIZE)
+    segment_size = 16
+    counts = collections.Counter()  # type: collections.Counter
+    for sample in samples:
+        counts.update(set(
+            sample[i:i + segment_size]
+            for i in range(0, len(sample) - segment_size + 1, segment_size)))
+    segments = []  # type: List[bytes]
+    total = 0
+    for segment, count in counts.most_common():
+        if count < 2 or total + len(segment) > size:
+            break
+        segments.append(segment)
+        total += len(segment)
+    # Shared content that is not aligned to a segment boundary is caught by
+    # also including as much recent sample data as there is room for.
+    recent = b''.join(samples)[-(size - total):] if size > total else b''
+    return recent + b''.join(reversed(segments))
+
+
+def _lzma_compress(data: bytes, level: int, dictionary: bytes) -> bytes:
+    return lzma.compress(data, preset=level)
+
+
+def _lzma_decompressobj(dictionary: bytes) -> Any:
+    return lzma.LZMADecompressor()
+
+
+def _bz2_compress(data: bytes, level: int, dictionary: bytes) -> bytes:
+    return bz2.compress(data, 9 if level is None else level)
+
+
+def _bz2_decompressobj(dictionary: bytes) -> Any:
+    return bz2.BZ2Decompressor()
+
+
+CODECS = {
+    'zlib': Codec(
+        'zlib', _zlib_compress, _zlib_decompressobj, train=_zlib_train),
+    'lzma': Codec('lzma', _lzma_compress, _lzma_decompressobj),
+    'bz2': Codec('bz2', _bz2_compress, _bz2_decompressobj),
+}  # type: Dict[str, Codec]
+
+
+if zstandard is not None:
+
+    def _zstd_compress(data: bytes, level: int, dictionary: bytes) -> bytes:
+        dict_data = None
+        if dictionary is not None:
+            dict_data = zstandard.ZstdCompressionDict(dictionary)
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level,
+            dict_data=dict_data).compress(data)
+
+    def _zstd_decompressobj(dictionary: bytes) -> Any:
+        dict_data = None
+        if dictionary is not None:
+            dict_data = zstandard.ZstdCompressionDict(dictionary)
+        return zstandard.ZstdDecompressor(
+            dict_data=dict_data).decompressobj()
+
+    def _zstd_train(samples: List[bytes], size: int) -> bytes:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+    CODECS['zstd'] = Codec(
+        'zstd', _zstd_compress, _zstd_decompressobj, train=_zstd_train)
+
+
+def available_codecs() -> List[str]:
+    ''' Return the names of the codecs that can be used '''
+    return sorted(CODECS)
+
+
+def get_codec(name: str) -> Codec:
+    '''
+    Return a codec by name.
+
+    :raises: Exception if the codec is not available.
+    '''
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise Exception(
+            'Unsupported compression codec: {}. Available codecs are: '
+            '{}'.format(name, ', '.join(available_codecs()))) from None
+
+
+def compress(data: bytes,
+             codec: str,
+             level: int = None,
+             dictionary: bytes = None) -> bytes:
+    ''' Return data compressed using the named codec '''
+    return get_codec(codec).compress(
+        data, level=level, dictionary=dictionary)
+
+
+def decompress(data: bytes, codec: str, dictionary: bytes = None) -> bytes:
+    ''' Return data decompressed using the named codec '''
+    return get_codec(codec).decompress(data, dictionary=dictionary)
+
+
+def iter_decompress(chunks: Iterable[bytes],
+                    codec: str,
+                    dictionary: bytes = None) -> Iterator[bytes]:
+    ''' Decompress a stream of chunks using the named codec '''
+    return get_codec(codec).iter_decompress(chunks, dictionary=dictionary)
+
+
+def train_dictionary(samples: Iterable[bytes],
+                     codec: str,
+                     size: int = 16384) -> bytes:
+    '''
+    Train a compression dictionary from sample data items.
+
+    A dictionary holds content that is common to the samples. Compressing
+    small data items that have a similar structure using a dictionary gives
+    much better ratios than compressing each item on its own.
+
+    :param samples: an iterable of sample data items.
+
+    :param codec: the name of a codec that supports dictionaries.
+
+    :param size: the maximum size of the dictionary in bytes.
+
+    :raises: Exception if the codec does not support dictionaries.
+    '''
+    c = get_codec(codec)
+    if not c.supports_dictionary:
+        raise Exception(
+            'Compression codec {} does not support dictionaries'.format(
+                codec))
+    return c._train(list(samples), size)
+
+
+def encode(data: bytes,
+           codec: str = None,
+           threshold: int = 0,
+           level: int = None,
+           dictionary: bytes = None) -> Tuple[bytes, Optional[str]]:
+    '''
+    Compress data for storage if doing so is worthwhile.
+
+    Data smaller than ``threshold`` is not compressed as the saving is
+    usually not worth the cost of decompressing it on every read. Data that
+    does not get smaller when compressed is also stored uncompressed.
+
+    This function is suitable for submitting to a thread or process pool
+    executor.
+
+    :param data: a bytes object to compress.
+
+    :param codec: the name of the codec to use. If None then the data is
+      not compressed.
+
+    :param threshold: the minimum size of data that will be compressed.
+
+    :param level: the compression level passed to the codec.
+
+    :param dictionary: an optional dictionary, see :func:`train_dictionary`.
+
+    :return: a 2-tuple of (stored_data, codec) where codec is None if the
+      data was not compressed.
+    '''
+    if codec is None or len(data) < threshold:
+        return frame_plain(data), None
+    compressed = compress(data, codec, level=level, dictionary=dictionary)
+    if len(compressed) >= len(data):
+        return frame_plain(data), None
+    return compressed, codec
+
+
+# Blobs that are replaced in storage, e.g. when they are recompressed, are
+# stored in a frame: a header recording how the blob is encoded followed by
+# the encoded data. Readers that looked up a blob's encoding before it was
+# replaced, or after a replacement that was interrupted before its metadata
+# was updated, still decode it correctly. The compressed output of every
+# codec starts with its own signature, so only uncompressed data can be
+# mistaken for a frame and such data is stored framed too.
+FRAME_MAGIC = b'\x89DDB\r\n\x1a\n'
+# the magic, the dictionary id (0 if none) and the length of the codec name
+FRAME_HEADER = struct.Struct('>8sIB')
+# the size of the largest possible header
+MAX_FRAME_HEADER = FRAME_HEADER.size + 255
+
+Frame = NamedTuple('Frame', [
+    # the number of bytes preceding the encoded data
+    ('header_size', int),
+    # the codec the data was compressed with, or None if it is uncompressed
+    ('codec', Optional[str]),
+    # the identifier of the dictionary the data was compressed with, if any
+    ('dictionary_id', Optional[int])])
+
+
+def frame(stored: bytes,
+          codec: Optional[str],
+          dictionary_id: Optional[int] = None) -> bytes:
+    ''' Return an encoded data item preceded by a header describing it '''
+    name = (codec or '').encode()
+    return FRAME_HEADER.pack(
+        FRAME_MAGIC, dictionary_id or 0, len(name)) + name + stored
+
+
+def frame_plain(data: bytes) -> bytes:
+    '''
+    Return the stored form of uncompressed data. This is the data itself
+    unless it starts like a frame, in which case it is framed.
+    '''
+    if is_framed(data):
+        return frame(data, None)
+    return data
+
+
+def is_framed(stored: bytes) -> bool:
+    ''' Return True if a stored data item, or its start, is framed '''
+    return bytes(stored[:len(FRAME_MAGIC)]) == FRAME_MAGIC
+
+
+def parse_frame(stored: bytes) -> Optional[Frame]:
+    '''
+    Return the header of a framed data item, or None if it is not framed.
+
+    :param stored: the stored data item, or at least its first
+      :data:`MAX_FRAME_HEADER` bytes.
+
+    :raises: Exception if the header is truncated.
+    '''
+    if not is_framed(stored):
+        return None
+    if len(stored) >= FRAME_HEADER.size:
+        _, dictionary_id, length = FRAME_HEADER.unpack_from(stored)
+        header_size = FRAME_HEADER.size + length
+        if len(stored) >= header_size:
+            codec = bytes(stored[FRAME_HEADER.size:header_size]).decode()
+            return Frame(header_size, codec or None, dictionary_id or None)
+    raise Exception('Invalid frame. The header is truncated')
+
+
+def split_frame(
+        chunks: Iterable[bytes]) -> Tuple[Optional[Frame], Iterator[bytes]]:
+    '''
+    Read the header of a stream of stored chunks if the data item is framed.
+
+    :return: a 2-tuple of the header, or None if the item is not framed,
+      and an iterator over the remaining chunks of encoded data. The chunks
+      of an item that is not framed are returned unchanged.
+    '''
+    chunks = iter(chunks)
+    head = []  # type: List[bytes]
+    prefix = b''
+    for chunk in chunks:
+        head.append(chunk)
+        prefix += chunk
+        if len(prefix) < len(FRAME_MAGIC):
+            if FRAME_MAGIC.startswith(prefix):
+                continue
+            break
+        if not is_framed(prefix):
+            break
+        if len(prefix) < FRAME_HEADER.size or \
+                len(prefix) < FRAME_HEADER.size + prefix[FRAME_HEADER.size - 1]:
+            continue
+        header = parse_frame(prefix)
+        return header, itertools.chain([prefix[header.header_size:]], chunks)
+    if is_framed(prefix):
+        parse_frame(prefix)  # the item ended part way through the header
+    return None, itertools.chain(head, chunks)
+
+
+def _frame_encoding(
+        header: Frame,
+        dictionaries: Callable[[int], bytes] = None) -> Tuple[
+            Optional[str], Optional[bytes]]:
+    dictionary = None
+    if header.dictionary_id is not None:
+        if dictionaries is None:
+            raise Exception(
+                'Dictionary {} is not available'.format(header.dictionary_id))
+        dictionary = dictionaries(header.dictionary_id)
+    return header.codec, dictionary
+
+
+def decode(stored: bytes,
+           codec: str = None,
+           dictionary: bytes = None,
+           dictionaries: Callable[[int], bytes] = None) -> bytes:
+    '''
+    Return the original form of a stored data item.
+
+    :param stored: the stored form of the data item.
+
+    :param codec: the codec recorded for the item, or None if it was stored
+      uncompressed. A framed item is decoded as its header describes
+      instead.
+
+    :param dictionary: the dictionary recorded for the item, if any.
+
+    :param dictionaries: a function that returns a dictionary given its
+      identifier, used to decode framed items compressed with a dictionary.
+    '''
+    header = parse_frame(stored[:MAX_FRAME_HEADER])
+    if header is not None:
+        codec, dictionary = _frame_encoding(header, dictionaries)
+        stored = stored[header.header_size:]
+    if not codec:
+        return stored
+    return decompress(stored, codec, dictionary=dictionary)
+
+
+def iter_decode(chunks: Iterable[bytes],
+                codec: str = None,
+                dictionary: bytes = None,
+                dictionaries: Callable[[int], bytes] = None) -> Iterator[bytes]:
+    '''
+    Decode a stream of stored chunks. See :func:`decode`.
+
+    :return: an iterator of bytes objects. Nothing is read until it is
+      iterated.
+    '''
+    header, chunks = split_frame(chunks)
+    if header is not None:
+        codec, dictionary = _frame_encoding(header, dictionaries)
+    if not codec:
+        yield from chunks
+    else:
+        yield from iter_decompress(chunks, codec, dictionary=dictionary)
@@ -1,123 +1,203 @@
 
+import collections
+import io
+import itertools
 import logging
 import os
-
+import threading
+import time
+import urllib.parse
+import weakref
+
+from concurrent.futures import (
+    FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor,
+    ThreadPoolExecutor, wait)
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-from .model import Base, Category, Digest
-from .hashify import data_digest, file_digest, digest_filepath
+from sqlalchemy import (
+    Integer, LargeBinary, bindparam, create_engine, func, literal, or_,
+    tuple_)
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from .bloom import BloomFilter
+from .cache import CacheInfo, LRUCache, MISSING
+from .compression import (
+    FRAME_MAGIC, decode, encode, frame, frame_plain, get_codec, is_framed,
+    iter_decode, train_dictionary)
+from .model import (
+    Base, Category, Dictionary, Digest, EpochTimestamp, Occurrence,
+    Verification)
+from .pack import PackStore
+from .hashify import data_digest, file_digest
+from .locking import FileLock
+from .migration import SCHEMA_VERSION, migrate, stored_schema_version
+from .storage import (
+    DURABILITY_NONE, FileStorage, HybridStorage, ReadOnlyStorage, Storage,
+    _chunksize, check_durability)
+from .gc import Collector, GCReport, RetentionPolicy, check_policy
+from .scrub import ScrubReport, Scrubber
+from .sync import SyncReport, reconcile
+from .tuning import (
+    PROFILE_BULK_LOAD, PROFILE_DURABLE, SQLiteProfile, apply_profile,
+    checkpoint, get_profile)
+# The file storage functions used to live in this module.
+from .storage import (
+    TEMP_FILE_PREFIX, commit_database_file, copy_database_file,
+    map_database_file, read_database_file, read_database_file_all,
+    read_database_file_into, write_data_item, write_database_file,
+    write_database_files, write_database_stream)
 
 # type annotations
 from typing import (
-    Dict, Generator, List, Optional, Sequence, Tuple, Union)
+    Any, BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence,
+    Set, Tuple, Union)
 import datetime
 from sqlalchemy.engine import Engine
+from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.session import Session
 
 # type aliases
 PutItem = Tuple[str, bytes, Union[datetime.datetime, None]]
-QueryResult = Sequence[Tuple[bytes, str, int, datetime.datetime]]
+QueryRow = NamedTuple('QueryRow', [
+    ('digest', bytes),
+    ('category_label', str),
+    ('byte_size', int),
+    ('timestamp', datetime.datetime),
+    ('occurrence_id', int)])
+QueryResult = Sequence[QueryRow]
+
+ReplayItem = NamedTuple('ReplayItem', [
+    ('timestamp', datetime.datetime),
+    ('category', str),
+    ('data', Optional[bytes])])
+
+# Status values reported in a PutResult
+PUT_STORED = 'stored'
+PUT_DUPLICATE = 'duplicate'
+PUT_FAILED = 'failed'
+
+PutResult = NamedTuple('PutResult', [
+    ('digest', Optional[bytes]),
+    ('status', str),
+    ('error', Optional[Exception])])
+
+# The fewest data items a compression dictionary will be trained from.
+MIN_DICTIONARY_SAMPLES = 8
+
+DeleteResult = NamedTuple('DeleteResult', [
+    # the number of occurrences deleted
+    ('occurrences', int),
+    # the number of data items removed from storage
+    ('items', int),
+    # the total size of the data items removed from storage
+    ('byte_count', int)])
+
+GetResult = NamedTuple('GetResult', [
+    ('digest', bytes),
+    ('data', Optional[bytes]),
+    ('error', Optional[Exception])])
+
+# SQLite limits the number of host parameters in a single statement to 999
+# in older releases. Keep 'IN' queries comfortably below that limit.
+MAX_SQL_VARIABLES = 900
 
 
 logger = logging.getLogger(__name__)
 
+(TEMP_FILE_PREFIX, commit_database_file, copy_database_file,
+ map_database_file, read_database_file, read_database_file_all,
+ read_database_file_into, write_data_item, write_database_file,
+ write_database_files, write_database_stream)  # Silence pep8 unused warning
 
-def write_database_file(digest: bytes,
-                        data: bytes,
-                        data_dir: str,
-                        dir_depth: int) -> None:
+
+def hash_data_item(data: bytes,
+                   hash_name: str) -> Tuple[Optional[bytes],
+                                            Optional[Exception]]:
     '''
-    Writes a binary database item to the file system.
+    Return the digest of a data item, or the error raised while hashing it.
 
-    This function first creates the filename and file path from the digest
-    information. It creates the directory tree is necessary and then writes
-    the data into the file.
+    This function is suitable for submitting to a thread or process pool
+    executor as it never raises an exception itself.
 
-    :param digest: a bytes object representing a hash of some data.
+    :param data: a bytes object representing the object to be hashed.
 
-    :param data: a bytes object containing the binary data to be stored by the
-      database.
+    :param hash_name: the name of a hash calculator.
 
-    :param data_dir: the database's root directory path where binary data is
-      being stored.
+    :return: a 2-tuple of (digest, error). One of the fields will be None.
+    '''
+    try:
+        return data_digest(data, hash_name=hash_name), None
+    except Exception as exc:
+        return None, exc
 
-    :param dir_depth: the number of directories to being used to spread files.
 
-    :raises: Exception if a duplicate filename is detected.
+def create_executor(kind: str = 'thread',
+                    max_workers: int = None) -> Executor:
     '''
-    fpath = os.path.join(
-        data_dir, digest_filepath(digest, dir_depth=dir_depth))
+    Create an executor that can be used by :class:`DigestDB` to hash and
+    write data items in parallel.
 
-    # Create directories as required
-    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    A thread pool is usually the best choice as ``hashlib`` releases the GIL
+    while hashing large buffers and file writes release it too. A process
+    pool may suit workloads made up of lots of small items where the GIL
+    would otherwise limit throughput, at the cost of copying each item to
+    a worker process.
 
-    if os.path.exists(fpath):
-        raise Exception(
-            'Duplicate file detected: {}'.format(fpath))
+    The caller owns the executor and is responsible for shutting it down.
 
-    with open(fpath, 'wb') as fd:
-        fd.write(data)
+    :param kind: the kind of pool to create, either 'thread' or 'process'.
 
+    :param max_workers: the maximum number of workers in the pool. The
+      executor's default is used if this is left as None.
 
-def read_database_file(digest: bytes,
-                       data_dir: str,
-                       dir_depth: int,
-                       chunk_size: int = 2**20) -> Generator[bytes, None, None]:
+    :raises: Exception if an invalid kind is specified.
     '''
-    Return the binary data associated with the digest.
-
-    This method is implemented as a generator that returns one chunk per
-    iteration. This is to avoid reading large files completely into memory.
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    elif kind == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers)
+    raise Exception(
+        'Invalid executor kind. Expected thread or process but got {}'.format(
+            kind))
 
-    .. code-block:: python
 
-        for chunk in read_database_file():
-            print(chunk)
-
-    :param digest: a bytes object representing a hash of some data.
-
-    :param data_dir: the database's root directory path where binary data is
-      being stored.
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    '''
+    Split an iterable into lists containing up to ``size`` items.
 
-    :param dir_depth: the number of directories to being used to spread files.
+    The iterable is consumed lazily so this can be used with generators
+    that produce more items than would fit in memory.
 
-    :param chunk_size: the number of bytes to read from the file per
-      iteration.
+    :param iterable: the iterable to split into chunks.
 
-    :raises: OSError exception if the resolved file does not exist.
+    :param size: the maximum number of items in each chunk.
     '''
-    fpath = os.path.join(data_dir, digest_filepath(
-        digest, dir_depth=dir_depth))
-    with open(fpath, 'rb') as fd:
-        for chunk in iter(lambda: fd.read(chunk_size), b''):
+    chunk = []  # type: List
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
             yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def sync_file_system(data_dir: str,
                      db: 'DigestDB') -> List[bytes]:
     '''
-    Walk the file system under the ``data_dir`` to find items that are not
-    listed in the database.
+    Find items in the database's storage that are not listed in the
+    database.
 
     :param data_dir: the database's root directory path where binary data is
-      being stored.
+      being stored. This is no longer used as the items are listed by the
+      database's storage backend, see :meth:`Storage.shard_digests`.
 
     :param db: a database object.
 
-    :return: a list of digests found on the file system that are not found
-      in the database.
+    :return: a list of digests found in storage that are not found in the
+      database. See :meth:`DigestDB.reconcile` for a full report.
     '''
-    items = []
-    for dirpath, dirnames, filenames in os.walk(data_dir):
-        for filename in filenames:
-            # filename is the str dump of the hex digest
-            digest = bytes.fromhex(filename)
-            if not db.exists(digest):
-                items.append(digest)
-    return items
+    return reconcile(db).untracked
 
 
 class DigestDB(object):
@@ -128,8 +208,9 @@ class DigestDB(object):
 
     - the metadata database that stores the hash of each binary blob.
 
-    - a filesystem directory structure for storing the binary blobs in
-      filenames that match the hash digest of the blob.
+    - a storage backend for the binary blobs. By default this is a
+      filesystem directory structure storing the binary blobs in filenames
+      that match the hash digest of the blob (see :class:`FileStorage`).
 
     The directories down which data blobs are stored are created only when
     required. The number of directories used to balance the data over a
@@ -148,7 +229,28 @@ class DigestDB(object):
                  filename: str = 'digestdb.db',
                  data_dir: str = 'digestdb.data',
                  dir_depth: int = 3,
-                 hash_name: str = 'sha256') -> None:
+                 hash_name: str = 'sha256',
+                 executor: Executor = None,
+                 cache_size: int = 0,
+                 cache_ttl: float = None,
+                 bloom_capacity: int = 0,
+                 bloom_error_rate: float = 0.01,
+                 pack_dir: str = 'digestdb.packs',
+                 pack_threshold: int = 0,
+                 max_pack_size: int = 256 * 2**20,
+                 storage: Storage = None,
+                 compression: str = None,
+                 compression_threshold: int = 1024,
+                 compression_level: int = None,
+                 dictionary_threshold: int = 64,
+                 without_rowid: bool = False,
+                 quarantine_dir: str = 'digestdb.quarantine',
+                 durability: str = DURABILITY_NONE,
+                 sqlite_profile: Union[str, SQLiteProfile] = PROFILE_DURABLE,
+                 thread_safe: bool = False,
+                 pool_size: int = 5,
+                 max_overflow: int = None,
+                 pool_timeout: float = 30.0) -> None:
         '''
 
         :param db_dir: the top level directory that the blob database will use
@@ -167,6 +269,122 @@ class DigestDB(object):
           be sufficient for large databases.
 
         :param hash_name: the name of a hash calculator. Defaults to sha256.
+
+        :param executor: an optional thread or process pool executor (see
+          :func:`create_executor`) used by the bulk ingest methods to hash
+          items and write blob files in parallel. Metadata inserts are always
+          performed by the calling thread so that SQLite only ever sees a
+          single writer.
+
+        :param cache_size: the maximum number of digests whose existence is
+          cached in memory by :meth:`exists`. A value of 0 disables the
+          cache. The cache is kept up to date by the methods that add and
+          delete data items.
+
+        :param cache_ttl: the number of seconds a cached existence check
+          remains valid. This bounds how long changes made by another
+          process can go unnoticed. If None then entries do not expire.
+
+        :param bloom_capacity: the number of digests to size a Bloom filter
+          for. The filter lets :meth:`exists` report items that are
+          definitely not stored without performing any I/O. A value of 0
+          disables the filter. The filter is grown automatically when the
+          database is opened if it already holds more items than this.
+
+        :param bloom_error_rate: the false positive rate the Bloom filter
+          is sized for.
+
+        :param pack_dir: the directory in which pack files are stored.
+
+        :param pack_threshold: data items smaller than this number of bytes
+          are appended to pack files (see :class:`PackStore`) instead of being
+          stored in their own file. This avoids the inode, directory entry and
+          block allocation overhead of storing lots of tiny files. A value of
+          0 disables pack files.
+
+        :param max_pack_size: the size at which a new pack file is started.
+
+        :param storage: the storage backend used to store the binary blobs.
+          See :class:`Storage`. If not specified the blobs are stored in the
+          ``data_dir`` directory tree and, if ``pack_threshold`` is set, in
+          pack files.
+
+        :param compression: the name of a compression codec (e.g. 'zlib',
+          'lzma', 'bz2' or, if the zstandard package is installed, 'zstd')
+          used to compress data items as they are stored. The codec used is
+          recorded for each item so items are decompressed transparently
+          when they are read. Digests are always calculated from the
+          uncompressed data. If None then data items are not compressed.
+
+        :param compression_threshold: data items smaller than this number of
+          bytes are not compressed.
+
+        :param compression_level: the compression level passed to the codec.
+          If None the codec's default level is used.
+
+        :param dictionary_threshold: data items in a category that has a
+          trained compression dictionary (see :meth:`train_dictionary`) are
+          compressed if they are at least this number of bytes. Dictionaries
+          make compressing much smaller items worthwhile.
+
+        :param without_rowid: create the digests table as a SQLite WITHOUT
+          ROWID table that is keyed on the digest. This avoids storing a
+          second b-tree and makes lookups by digest cheaper. It only takes
+          effect when the table is created, which happens when a new
+          database is created or when an existing database is migrated to a
+          schema version that rebuilds the table. See :mod:`migration`.
+
+        :param quarantine_dir: the directory to which :meth:`scrub` moves
+          damaged data items.
+
+        :param durability: whether data items are flushed to disk as they
+          are stored. Items are always written to a temporary file and then
+          renamed into place so a crash can not leave a partially written
+          item. The modes trade throughput for durability:
+
+          - 'none' (the default) leaves flushing to the operating system so
+            items stored just before a power failure may be lost.
+          - 'fsync' flushes every item, and its directory, as it is stored.
+          - 'batch' flushes the items stored by a bulk method, such as
+            :meth:`put_data_batch`, together and then each of their
+            directories once. Items stored on their own are flushed as with
+            'fsync'.
+
+          The mode applies to the default storage. A custom ``storage`` is
+          configured when it is created.
+
+        :param sqlite_profile: the settings applied to every SQLite
+          connection. Either the name of a preset or a
+          :class:`tuning.SQLiteProfile`. The presets are:
+
+          - 'durable' (the default) uses a write ahead log and waits for
+            every commit to reach the disk.
+          - 'balanced' only waits for the disk at checkpoints, so a power
+            failure can roll back the latest commits but can not corrupt
+            the database, and memory maps the database file.
+          - 'bulk-load' never waits for the disk and uses a larger cache.
+            See the ``bulk_load`` option of :meth:`open`.
+
+        :param thread_safe: let the database be shared by several threads.
+          Each thread is given its own session, and so its own connection
+          from the pool, the first time it uses the database. A thread can
+          return its connection to the pool with :meth:`release_session`,
+          e.g. at the end of each request handled by a web worker, but does
+          not have to as the pool grows when every connection is in use.
+          Writes from different threads are serialised by SQLite and wait
+          for each other for up to the profile's ``busy_timeout``.
+
+        :param pool_size: the number of SQLite connections kept open when
+          they are not in use.
+
+        :param max_overflow: the number of connections that can be opened in
+          addition to ``pool_size`` when they are all in use. They are
+          closed when they are returned to the pool. If None then the
+          number is not limited.
+
+        :param pool_timeout: the number of seconds a thread waits for a
+          connection when ``max_overflow`` connections have been opened
+          before an exception is raised.
         '''
         if not os.path.exists(db_dir):
             raise Exception(
@@ -176,46 +394,313 @@ class DigestDB(object):
         self.data_dir = os.path.join(self.db_dir, data_dir)
         self.dir_depth = dir_depth
         self.hash_name = hash_name
+        self.executor = executor
+        self.cache = None  # type: LRUCache
+        if cache_size:
+            self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
         self.db_url = 'sqlite:///{}'.format(self.filename)
         self.lock_file = '{}.lock'.format(
             os.path.splitext(self.filename)[0])
+        self.shared_lock_file = '{}.shared.lock'.format(
+            os.path.splitext(self.filename)[0])
+        self._write_lock = None  # type: FileLock
+        self._shared_lock = None  # type: FileLock
+        self.bloom_file = '{}.bloom'.format(
+            os.path.splitext(self.filename)[0])
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom = None  # type: BloomFilter
+        self.pack_threshold = pack_threshold
+        self.packs = None  # type: PackStore
+        check_durability(durability)
+        self.durability = durability
+        if storage is None:
+            storage = FileStorage(
+                self.data_dir, dir_depth=dir_depth, durability=durability)
+            if pack_threshold:
+                self.packs = PackStore(
+                    os.path.join(self.db_dir, pack_dir),
+                    max_pack_size=max_pack_size, durability=durability)
+                storage = HybridStorage(self.packs, storage, pack_threshold)
+        self.storage = storage
+        if compression is not None:
+            get_codec(compression)  # raises if the codec is unavailable
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        self.dictionary_threshold = dictionary_threshold
+        self.without_rowid = without_rowid
+        self.quarantine_dir = os.path.join(self.db_dir, quarantine_dir)
+        self.sqlite_profile = get_profile(sqlite_profile)
+        self.thread_safe = thread_safe
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        # the sessions created for threads in thread safe mode
+        self._sessions = weakref.WeakSet()  # type: weakref.WeakSet
+        self._sessions_lock = threading.Lock()
+        # set when the database is opened in bulk load or read only mode
+        self.bulk_load = False
+        self.read_only = False
+        # set when the database is opened if any item may be compressed
+        self._codecs_in_use = False
+        # compression dictionaries by id, loaded as they are needed
+        self._dictionaries = {}  # type: Dict[int, bytes]
+        # the latest (id, dictionary) for each category that can be used
+        # with the configured codec.
+        self._current_dictionaries = {}  # type: Dict[str, Tuple[int, bytes]]
 
         self.engine = None  # type: Engine
         self.sessionmaker = None  # type: sessionmaker
-        self.session = None  # type: Session
+        # a scoped_session, which proxies to a session per thread, in
+        # thread safe mode.
+        self.session = None  # type: Union[Session, scoped_session]
 
     def __repr__(self) -> str:
         return "<DigestDB '{}'>".format(self.db_dir)
 
-    def open(self) -> None:
+    def open(self, bulk_load: bool = False, read_only: bool = False) -> None:
         ''' Open the database.
 
         This will create the database file if necessary or will open an
         existing file if one is present.
+
+        A database can be open for writing by one process at a time, and
+        for reading by any number of processes at the same time. Access is
+        coordinated with operating system file locks which are released if
+        a process exits without closing the database, so a crashed process
+        never leaves the database locked.
+
+        :param bulk_load: use the 'bulk-load' SQLite profile, instead of the
+          configured ``sqlite_profile``, until the database is closed. This
+          suits importing lots of data that can be imported again if the
+          import is interrupted. Commits do not wait for the disk so a crash
+          or power failure can lose them, or corrupt the database. The
+          database is flushed to disk when it is closed.
+
+        :param read_only: open an existing database for reading. The
+          database, which must have been created by a writer, is not
+          changed. Methods that would change it raise an exception. Readers
+          see the changes committed by the writer as they are made when the
+          'wal' journal mode is used. A reader's Bloom filter is disabled
+          and its existence cache should be given a ``cache_ttl`` as items
+          the writer adds or deletes are not seen by the cache.
+
+        :raises: an exception is raised if the database is already open for
+          writing and ``read_only`` is not set.
         '''
-        if os.path.exists(self.lock_file):
+        if bulk_load and read_only:
+            raise Exception('A read only database can not be bulk loaded')
+        if read_only and not os.path.exists(self.filename):
             raise Exception(
-                'Database is already open. Close database or '
-                'remove .lock file: {}'.format(self.lock_file))
+                'Database file not found: {}'.format(self.filename))
+        exclusive = self._lock(read_only)
+        self.bulk_load = bulk_load
+        self.read_only = read_only
+        try:
+            url = self.db_url
+            if read_only:
+                url = 'sqlite:///file:{}?mode=ro&uri=true'.format(
+                    urllib.parse.quote(self.filename))
+            # Connections are not tied to the thread that opened them as
+            # the pool hands them to whichever thread needs one.
+            self.engine = create_engine(
+                url, pool_size=self.pool_size,
+                max_overflow=(
+                    -1 if self.max_overflow is None else self.max_overflow),
+                pool_timeout=self.pool_timeout,
+                connect_args={'check_same_thread': False})
+            apply_profile(
+                self.engine,
+                PROFILE_BULK_LOAD if bulk_load else self.sqlite_profile,
+                read_only=read_only)
+            self._open_schema(exclusive)
+        except Exception:
+            if self.engine is not None:
+                self.engine.dispose()
+                self.engine = None
+            self._unlock()
+            self.bulk_load = False
+            self.read_only = False
+            raise
+        if exclusive:
+            # let readers in now that the schema is up to date
+            self._shared_lock.acquire(shared=True, blocking=True)
+        self.sessionmaker = sessionmaker(bind=self.engine)
+        if self.thread_safe:
+            self.session = scoped_session(self._thread_session)
+        else:
+            self.session = self.sessionmaker()
+        # A reader can not tell whether the writer will compress the items
+        # it adds so it always checks how an item is stored.
+        self._codecs_in_use = self.compression is not None or read_only or \
+            self.session.query(Digest.digest).filter(
+                Digest.codec.isnot(None)).first() is not None
+        self._load_dictionaries()
+        if read_only:
+            if self.packs is not None:
+                self.packs.read_only = True
+            self.storage = ReadOnlyStorage(self.storage)
+        self.storage.open()
+        if not read_only:
+            self._open_bloom()
+
+    def _lock(self, read_only: bool) -> bool:
+        '''
+        Acquire the locks that let a process open the database.
 
-        # create lock file
-        with open(self.lock_file, 'w'):
-            pass
+        A writer holds an exclusive lock on the ``lock_file`` so there is
+        only ever one writer. Every process that has the database open holds
+        a shared lock on the ``shared_lock_file``. A writer that finds no
+        other process holding it takes it exclusively until the schema has
+        been created or migrated.
 
-        self.engine = create_engine(self.db_url)
-        Base.metadata.create_all(self.engine)  # creates the table metadata
-        self.sessionmaker = sessionmaker(bind=self.engine)
-        self.session = self.sessionmaker()
+        :return: True if the shared lock was taken exclusively.
+        '''
+        if not read_only:
+            self._write_lock = FileLock(self.lock_file)
+            if not self._write_lock.acquire():
+                owner = self._write_lock.owner()
+                self._write_lock = None
+                raise Exception(
+                    'Database is already open for writing{}. Close the '
+                    'database or open it read only: {}'.format(
+                        ' by process {}'.format(owner) if owner else '',
+                        self.lock_file))
+        self._shared_lock = FileLock(self.shared_lock_file)
+        exclusive = not read_only and self._shared_lock.acquire()
+        if not exclusive:
+            # only waits while a writer creates or migrates the schema
+            self._shared_lock.acquire(shared=True, blocking=True)
+        return exclusive
+
+    def _unlock(self) -> None:
+        ''' Release the locks acquired by :meth:`_lock` '''
+        for lock in (self._shared_lock, self._write_lock):
+            if lock is not None:
+                lock.release()
+        self._shared_lock = None
+        self._write_lock = None
+
+    def _open_schema(self, exclusive: bool) -> None:
+        '''
+        Create or migrate the database schema if this process is allowed to,
+        otherwise check that the schema is already up to date.
+
+        :param exclusive: no other process has the database open.
+        '''
+        if exclusive:
+            migrate(self.engine, without_rowid=self.without_rowid)
+            return
+        version = stored_schema_version(self.engine)
+        if version == SCHEMA_VERSION:
+            return
+        if self.read_only:
+            raise Exception(
+                'Database schema version {} can not be read. Open the '
+                'database for writing to create or migrate it'.format(
+                    version))
+        raise Exception(
+            'Database schema version {} must be migrated to version {} but '
+            'the database is open by readers'.format(version, SCHEMA_VERSION))
+
+    def _load_dictionaries(self) -> None:
+        '''
+        Load the latest compression dictionary of each category that was
+        trained for the configured codec.
+        '''
+        self._dictionaries = {}
+        self._current_dictionaries = {}
+        if not self.compression:
+            return
+        query = self.session.query(
+            Dictionary.id, Dictionary.category_label, Dictionary.data).filter_by(
+                codec=self.compression).order_by(Dictionary.version)
+        for dictionary_id, category, data in query:
+            self._current_dictionaries[category] = (dictionary_id, data)
+            self._dictionaries[dictionary_id] = data
+
+    def _open_bloom(self) -> None:
+        '''
+        Load the Bloom filter saved when the database was last closed or, if
+        there isn't one, build it from the digests table.
+
+        The saved filter file is removed once it is loaded and is only
+        written again when the database is closed. A filter file is therefore
+        only ever present when it is known to be up to date. After a crash,
+        or after the database was opened with the filter disabled, the filter
+        is rebuilt.
+        '''
+        if not self.bloom_capacity:
+            if os.path.exists(self.bloom_file):
+                os.remove(self.bloom_file)
+            return
+
+        try:
+            self.bloom = BloomFilter.load(self.bloom_file)
+        except Exception:
+            self.bloom = None
+        finally:
+            if os.path.exists(self.bloom_file):
+                os.remove(self.bloom_file)
+
+        if self.bloom is not None and self.bloom.count <= self.bloom_capacity:
+            return
+
+        count = self.count_data()
+        self.bloom = BloomFilter(
+            max(self.bloom_capacity, count * 2), self.bloom_error_rate)
+        self.bloom.update(
+            row[0] for row in self.session.query(
+                Digest.digest).yield_per(10000))
+        logger.debug('Built bloom filter from %s digests', count)
 
     def close(self) -> None:
         ''' Close the database '''
+        if self.bloom is not None:
+            self.bloom.save(self.bloom_file)
+            self.bloom = None
+        self.storage.close()
+        if isinstance(self.storage, ReadOnlyStorage):
+            self.storage = self.storage.storage
+            if self.packs is not None:
+                self.packs.read_only = False
         if self.session:
-            self.session.close()
+            self.release_session()
+            # other threads may not have released their sessions
+            with self._sessions_lock:
+                sessions = list(self._sessions)
+                self._sessions.clear()
+            for session in sessions:
+                session.close()
+            if self.bulk_load:
+                checkpoint(
+                    self.engine, synchronous=self.sqlite_profile.synchronous)
             self.engine.dispose()
-        os.remove(self.lock_file)
+        self._unlock()
         self.session = None
         self.engine = None
         self.sessionmaker = None
+        self.bulk_load = False
+        self.read_only = False
+
+    def _thread_session(self) -> Session:
+        ''' Create a session for a thread in thread safe mode '''
+        session = self.sessionmaker()
+        with self._sessions_lock:
+            self._sessions.add(session)
+        return session
+
+    def release_session(self) -> None:
+        '''
+        Close the calling thread's session, rolling back anything that it
+        has not committed, and return its connection to the pool. The
+        thread is given a new session the next time it uses the database.
+        '''
+        if isinstance(self.session, scoped_session):
+            self.session.remove()
+        elif self.session is not None:
+            self.session.close()
 
     @contextmanager
     def session_scope(self):
@@ -233,15 +718,143 @@ class DigestDB(object):
                 session.add(item)
 
         When with statement is exited the session is commited. If an error
-        occurs the session is rolled back.
+        occurs the session is rolled back. The session is then closed so its
+        connection is returned to the pool.
         '''
+        session = self.sessionmaker()
         try:
-            session = self.sessionmaker()
             yield session
             session.commit()
         except:
             session.rollback()
             raise
+        finally:
+            session.close()
+
+    def compact(self, min_dead_ratio: float = 0.5) -> int:
+        '''
+        Reclaim the space left in storage by deleted data items, such as the
+        space in pack files.
+
+        :param min_dead_ratio: the proportion of a pack file that must be
+          unused before it is compacted.
+
+        :return: the number of bytes reclaimed.
+        '''
+        return self.storage.compact(min_dead_ratio=min_dead_ratio)
+
+    def reconcile(self,
+                  workers: int = 8,
+                  state_file: str = None,
+                  incremental: bool = False) -> SyncReport:
+        '''
+        Compare the digests table with the items in storage and report the
+        items that are only found in one of them. See :class:`sync.Reconciler`.
+
+        :param workers: the number of threads used to list storage shards.
+
+        :param state_file: an optional file used to checkpoint progress, so
+          an interrupted run resumes where it stopped, and to remember which
+          shards were consistent.
+
+        :param incremental: skip shards that have not changed since they
+          were last found to be consistent. Requires a ``state_file``.
+
+        :return: a :class:`sync.SyncReport` listing the ``untracked`` items
+          found in storage but not in the database and the ``missing`` items
+          found in the database but not in storage.
+        '''
+        return reconcile(
+            self, workers=workers, state_file=state_file,
+            incremental=incremental)
+
+    def scrub(self,
+              rate: float = None,
+              workers: int = 4,
+              max_age: float = None,
+              limit: int = None,
+              quarantine: bool = False,
+              batch_size: int = 256) -> ScrubReport:
+        '''
+        Verify that the data items in storage still hash to their digests
+        and have the sizes recorded for them. See :class:`scrub.Scrubber`.
+
+        .. code-block:: python
+
+            # check items not verified in the last week, reading at most
+            # 10 MB/s, and move any damaged items out of storage.
+            report = db.scrub(
+                rate=10 * 2**20, max_age=7 * 86400, quarantine=True)
+
+        :param rate: the maximum number of bytes per second to read from
+          storage. If None then reads are not limited.
+
+        :param workers: the number of threads used to read items.
+
+        :param max_age: skip items verified within this many seconds. If
+          None then every item is checked.
+
+        :param limit: the maximum number of items to check.
+
+        :param quarantine: move damaged items into the ``quarantine_dir``.
+
+        :param batch_size: the number of items checked per batch.
+
+        :return: a :class:`scrub.ScrubReport` listing the problems found.
+        '''
+        scrubber = Scrubber(
+            self, rate=rate, max_age=max_age, limit=limit,
+            quarantine=quarantine, batch_size=batch_size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return scrubber.run(executor)
+
+    def collect_garbage(self,
+                        categories: Iterable[str] = None,
+                        rate: float = None,
+                        limit: int = None,
+                        batch_size: int = 1000) -> GCReport:
+        '''
+        Delete the occurrences that fall outside the retention policies of
+        their categories, and the data items left unreferenced, oldest
+        first. See :class:`gc.Collector`.
+
+        .. code-block:: python
+
+            db.set_retention('js', max_age=30 * 86400, max_bytes=2**30)
+            # delete at most 5000 occurrences per second
+            report = db.collect_garbage(rate=5000)
+
+        :param categories: the labels of the categories to collect. If None
+          then every category with a retention policy is collected.
+
+        :param rate: the maximum number of occurrences deleted per second.
+          If None then deletes are not limited.
+
+        :param limit: the maximum number of occurrences to delete.
+
+        :param batch_size: the number of occurrences deleted per
+          transaction.
+
+        :return: a :class:`gc.GCReport` counting what was reclaimed.
+        '''
+        return Collector(
+            self, categories=categories, rate=rate, limit=limit,
+            batch_size=batch_size).run()
+
+    def last_verified(
+            self,
+            digest: bytes) -> Optional[Tuple[datetime.datetime, Optional[str]]]:
+        '''
+        Return when a data item was last verified by :meth:`scrub` and the
+        problem found, if any.
+
+        :return: a 2-tuple of (timestamp, problem), or None if the item has
+          not been verified.
+        '''
+        row = self.session.query(
+            Verification.timestamp, Verification.problem).filter_by(
+                digest=digest).first()
+        return tuple(row) if row is not None else None
 
     # ------------------------------------------------------------------------
     # Category methods
@@ -290,6 +903,51 @@ class DigestDB(object):
             raise Exception(
                 'Category {} not found in database'.format(label)) from None
 
+    def set_retention(self,
+                      label: str,
+                      max_age: float = None,
+                      max_bytes: int = None,
+                      max_count: int = None) -> None:
+        '''
+        Set the retention policy of a category. The policy is enforced by
+        :meth:`collect_garbage`. Limits left as None are removed.
+
+        :param label: a short string that uniquely identifies a category.
+
+        :param max_age: the maximum age, in seconds, of the occurrences kept.
+
+        :param max_bytes: the maximum total size of the occurrences kept.
+
+        :param max_count: the maximum number of occurrences kept.
+
+        :raises: an exception is raised if the category is not found.
+        '''
+        policy = RetentionPolicy(max_age, max_bytes, max_count)
+        check_policy(policy)
+        updated = self.session.query(Category).filter_by(label=label).update(
+            policy._asdict(), synchronize_session=False)
+        self.session.commit()
+        if not updated:
+            raise Exception('Category {} not found in database'.format(label))
+
+    def get_retention(self,
+                      label: str) -> RetentionPolicy:
+        '''
+        Return the retention policy of a category.
+
+        :param label: a short string that uniquely identifies a category.
+
+        :return: a :class:`gc.RetentionPolicy`.
+
+        :raises: an exception is raised if the category is not found.
+        '''
+        row = self.session.query(
+            Category.max_age, Category.max_bytes, Category.max_count).filter_by(
+                label=label).first()
+        if row is None:
+            raise Exception('Category {} not found in database'.format(label))
+        return RetentionPolicy(*row)
+
     def query_category(self,
                        **filters: Dict[str, str]) -> List[Tuple[str, str]]:
         ''' Query the categories in the database.
@@ -306,7 +964,26 @@ class DigestDB(object):
           category label and description
 
         '''
-        query = self.session.query(Category)
+        return list(self.iter_query_category(**filters))
+
+    def iter_query_category(
+            self,
+            batch_size: int = 1000,
+            **filters: Dict[str, str]) -> Iterator[Tuple[str, str]]:
+        '''
+        Return an iterator over the categories matching a query. See
+        :meth:`query_category` for the supported filter keywords.
+
+        Rows are fetched from the database in batches as the iterator is
+        consumed so memory use does not grow with the number of matches.
+
+        :param batch_size: the number of rows fetched from the database at
+          a time.
+
+        :return: an iterator of 2-tuples containing the category label and
+          description.
+        '''
+        query = self.session.query(Category.label, Category.description)
 
         label = filters.get('label')
         if label:
@@ -316,12 +993,313 @@ class DigestDB(object):
         if description:
             query = query.filter(Category.description.contains(description))
 
-        return [(c.label, c.description) for c in query]
+        return (tuple(row) for row in query.yield_per(batch_size))
 
     def count_category(self) -> int:
         ''' Return the number of category items in the database. '''
         return self.session.query(Category).count()
 
+    # ------------------------------------------------------------------------
+    # Compression dictionary methods
+    #
+
+    def train_dictionary(self,
+                         category: str,
+                         samples: int = 1000,
+                         size: int = 16384) -> int:
+        '''
+        Train a new version of a category's compression dictionary from the
+        category's most recently added data items.
+
+        Data items subsequently added to the category are compressed using
+        the new dictionary. Existing data items keep using the dictionary
+        they were compressed with until they are recompressed, see
+        :meth:`recompress_category`.
+
+        :param category: a category label that must match an existing
+          category in the database.
+
+        :param samples: the maximum number of data items to train from.
+
+        :param size: the maximum size of the dictionary in bytes.
+
+        :return: the version number of the new dictionary.
+
+        :raises: Exception if the database is not configured with a
+          compression codec that supports dictionaries or if the category
+          does not have enough data items to train from.
+        '''
+        if not self.compression or \
+                not get_codec(self.compression).supports_dictionary:
+            raise Exception(
+                'Dictionary training requires a compression codec that '
+                'supports dictionaries, got: {}'.format(self.compression))
+        self.get_category(category)  # raises if the category is not found
+
+        query = self.session.query(Occurrence.digest).filter_by(
+            category_label=category).group_by(Occurrence.digest).order_by(
+                func.max(Occurrence.timestamp).desc()).limit(samples)
+        blobs = []  # type: List[bytes]
+        for digest, in query.all():
+            data = self.get_data(digest)
+            if data:
+                blobs.append(data)
+        if len(blobs) < MIN_DICTIONARY_SAMPLES:
+            raise Exception(
+                'Not enough data items to train a dictionary for category '
+                '{}. Need at least {} but got {}'.format(
+                    category, MIN_DICTIONARY_SAMPLES, len(blobs)))
+        dictionary = train_dictionary(blobs, self.compression, size=size)
+
+        version = (self.session.query(func.max(Dictionary.version)).filter_by(
+            category_label=category).scalar() or 0) + 1
+        d = Dictionary(
+            category_label=category, version=version, codec=self.compression,
+            data=dictionary)
+        self.session.add(d)
+        self.session.commit()
+        self._dictionaries[d.id] = dictionary
+        self._current_dictionaries[category] = (d.id, dictionary)
+        logger.debug(
+            'Trained %s byte dictionary version %s for category %s from %s '
+            'items', len(dictionary), version, category, len(blobs))
+        return version
+
+    def query_dictionaries(
+            self,
+            category: str = None) -> List[Tuple[str, int, str, int]]:
+        '''
+        Return the compression dictionaries stored in the database.
+
+        :param category: an optional category label to use as a query filter.
+
+        :return: a list of 4-tuples containing the category label, version,
+          codec and size of each dictionary.
+        '''
+        query = self.session.query(
+            Dictionary.category_label, Dictionary.version, Dictionary.codec,
+            func.length(Dictionary.data))
+        if category:
+            query = query.filter_by(category_label=category)
+        query = query.order_by(Dictionary.category_label, Dictionary.version)
+        return [tuple(row) for row in query]
+
+    def recompress_category(self,
+                            category: str,
+                            batch_size: int = 1000,
+                            executor: Executor = None) -> int:
+        '''
+        Recompress a category's data items that were not compressed with
+        the category's current dictionary.
+
+        Dictionary versions that are no longer used by any data item are
+        removed once the category has been recompressed.
+
+        Recompressed items are stored framed, with a header recording their
+        codec and dictionary (see :func:`compression.frame`), before their
+        metadata is updated. Readers that looked up an item's metadata
+        before it was recompressed still read it correctly, as does the
+        database if the process is killed before the metadata is updated.
+
+        :param category: a category label.
+
+        :param batch_size: the number of data items recompressed per
+          metadata transaction.
+
+        :param executor: an optional executor used to compress items in
+          parallel.
+
+        :return: the number of data items recompressed.
+        '''
+        count = 0
+        after = b''
+        while True:
+            candidates = self._recompress_candidates(
+                category, after, batch_size)
+            if not candidates:
+                break
+            after = candidates[-1][0]
+            updates = self._recompress_items(
+                category, candidates, executor=executor)
+            self._update_encodings(updates)
+            count += len(updates)
+        self._prune_dictionaries(category)
+        logger.debug('Recompressed %s items in category %s', count, category)
+        return count
+
+    def retrain_dictionaries(self,
+                             categories: Iterable[str] = None,
+                             samples: int = 1000,
+                             size: int = 16384,
+                             recompress: bool = True,
+                             batch_size: int = 1000,
+                             executor: Executor = None) -> Dict[str, int]:
+        '''
+        Train a new dictionary for each category and, optionally, recompress
+        the existing data items in the category using it.
+
+        This is a maintenance operation that is intended to be run
+        periodically as the data stored in each category evolves. See
+        :meth:`AsyncDigestDB.retrain_dictionaries` to run it in the
+        background.
+
+        :param categories: the category labels to retrain. If None then all
+          categories are retrained. Categories with too few data items to
+          train from are skipped.
+
+        :param samples: the maximum number of data items to train from.
+
+        :param size: the maximum size of each dictionary in bytes.
+
+        :param recompress: recompress existing data items after training.
+
+        :param batch_size: see :meth:`recompress_category`.
+
+        :param executor: see :meth:`recompress_category`.
+
+        :return: a dict mapping each retrained category label to the version
+          of its new dictionary.
+        '''
+        versions = {}  # type: Dict[str, int]
+        for category in self._dictionary_categories(categories):
+            versions[category] = self.train_dictionary(
+                category, samples=samples, size=size)
+            if recompress:
+                self.recompress_category(
+                    category, batch_size=batch_size, executor=executor)
+        return versions
+
+    def _dictionary_categories(
+            self,
+            categories: Iterable[str] = None) -> List[str]:
+        ''' Return the categories with enough items to train from '''
+        query = self.session.query(
+            Occurrence.category_label,
+            func.count(Occurrence.digest.distinct())).group_by(
+                Occurrence.category_label)
+        counts = dict(query.all())
+        if categories is None:
+            categories = sorted(label for label in counts if label)
+        trainable = []
+        for category in categories:
+            if counts.get(category, 0) < MIN_DICTIONARY_SAMPLES:
+                logger.debug(
+                    'Skipping dictionary training for category %s', category)
+                continue
+            trainable.append(category)
+        return trainable
+
+    def _recompress_candidates(
+            self,
+            category: str,
+            after: bytes,
+            limit: int) -> List[Tuple[bytes, Optional[str], Optional[bytes]]]:
+        '''
+        Return up to ``limit`` data items in a category, with digests after
+        ``after``, that were not compressed with the category's current
+        dictionary. Items that also occur in other categories and that were
+        compressed with another category's dictionary are left alone so
+        that shared items are not recompressed back and forth.
+
+        :return: a list of 3-tuples of (digest, codec, dictionary) describing
+          how each item is currently stored.
+        '''
+        current = self._current_dictionaries.get(category)
+        if current is None:
+            return []
+        previous = self.session.query(Dictionary.id).filter(
+            Dictionary.category_label == category,
+            Dictionary.id != current[0])
+        outdated = or_(
+            Digest.dictionary_id.is_(None),
+            Digest.dictionary_id.in_(previous))
+        query = self.session.query(
+            Digest.digest, Digest.codec, Digest.dictionary_id).join(
+                Occurrence, Occurrence.digest == Digest.digest).filter(
+                    Occurrence.category_label == category,
+                    Digest.digest > after,
+                    outdated).distinct().order_by(
+                        Digest.digest).limit(limit)
+        return [
+            (digest, codec, self._dictionary(dictionary_id))
+            for digest, codec, dictionary_id in query.all()]
+
+    def _recompress_items(
+            self,
+            category: str,
+            candidates: List[Tuple[bytes, Optional[str], Optional[bytes]]],
+            executor: Executor = None) -> List[Dict]:
+        '''
+        Recompress data items using their category's current dictionary and
+        replace them in storage.
+
+        This method only accesses storage so it can be run by a thread other
+        than the one that owns the session.
+
+        :return: a list of the metadata updates for the items that were
+          recompressed.
+        '''
+        digests = []  # type: List[bytes]
+        blobs = []  # type: List[bytes]
+        for digest, codec, dictionary in candidates:
+            try:
+                blobs.append(self._decode(
+                    self.storage.get(digest), codec, dictionary))
+            except OSError:
+                logger.warning(
+                    'Could not recompress missing item: %s', digest.hex())
+                continue
+            digests.append(digest)
+
+        encoded = self._encode_many(
+            blobs, [category] * len(blobs), executor=executor)
+
+        updates = []  # type: List[Dict]
+        for digest, data, (stored, codec, dictionary_id) in zip(
+                digests, blobs, encoded):
+            if dictionary_id is None:
+                continue  # the dictionary did not help, leave it as it is
+            stored = frame(stored, codec, dictionary_id)
+            if len(stored) >= len(data):
+                continue  # the saving does not cover the frame's header
+            self.storage.replace(digest, stored)
+            updates.append(dict(
+                b_digest=digest, codec=codec, dictionary_id=dictionary_id))
+        return updates
+
+    def _update_encodings(self, updates: List[Dict]) -> None:
+        ''' Record the new codec and dictionary of recompressed items '''
+        if not updates:
+            return
+        table = Digest.__table__
+        statement = table.update().where(
+            table.c.digest == bindparam('b_digest')).values(
+                codec=bindparam('codec'),
+                dictionary_id=bindparam('dictionary_id'))
+        self.session.execute(statement, updates)
+        self.session.commit()
+
+    def _prune_dictionaries(self, category: str) -> None:
+        '''
+        Remove a category's old dictionary versions that are no longer used
+        by any data item.
+        '''
+        current = self._current_dictionaries.get(category)
+        in_use = self.session.query(Digest.dictionary_id).filter(
+            Digest.dictionary_id.isnot(None)).distinct()
+        query = self.session.query(Dictionary.id).filter(
+            Dictionary.category_label == category,
+            ~Dictionary.id.in_(in_use))
+        if current is not None:
+            query = query.filter(Dictionary.id != current[0])
+        unused = [row[0] for row in query.all()]
+        if unused:
+            self.session.query(Dictionary).filter(
+                Dictionary.id.in_(unused)).delete(synchronize_session=False)
+            self.session.commit()
+            for dictionary_id in unused:
+                self._dictionaries.pop(dictionary_id, None)
+
     # ------------------------------------------------------------------------
     # Data methods
     #
@@ -330,7 +1308,9 @@ class DigestDB(object):
                          category: str,
                          digest: bytes,
                          size: int,
-                         timestamp: datetime.datetime = None):
+                         timestamp: datetime.datetime = None,
+                         codec: str = None,
+                         dictionary_id: int = None):
         '''
         Add an item, with a pre-computed hash, to the database.
 
@@ -349,12 +1329,28 @@ class DigestDB(object):
           instead of the default `now` timestamp used if this field if left
           as its default of None.
 
+        :param codec: the name of the compression codec the stored data item
+          was compressed with, if any.
+
+        :param dictionary_id: the identifier of the compression dictionary
+          the stored data item was compressed with, if any.
+
         :return: a bytes object representing the hash digest of the data item
         '''
-        b = Digest(digest=digest, category_label=category,
-                   byte_size=size, timestamp=timestamp)
-        self.session.add(b)
-        self.session.commit()
+        try:
+            self.session.add(Digest(
+                digest=digest, byte_size=size, codec=codec,
+                dictionary_id=dictionary_id, refcount=1))
+            self.session.add(Occurrence(
+                digest=digest, category_label=category, timestamp=timestamp))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        if self.bloom is not None:
+            self.bloom.add(digest)
+        if self.cache is not None:
+            self.cache.put(digest, True)
         return digest
 
     def put_data(self,
@@ -376,16 +1372,213 @@ class DigestDB(object):
         :return: a bytes object representing the hash digest of the data item
         '''
         digest = data_digest(data, hash_name=self.hash_name)
-        write_database_file(digest, data, self.data_dir, self.dir_depth)
+        if self._is_recorded(digest) and self._is_damaged(digest):
+            # the scrubber found the stored copy damaged or quarantined it
+            self._repair(category, digest, data, occurrence=dict(
+                digest=digest, category_label=category,
+                timestamp=timestamp or datetime.datetime.now()))
+            return digest
+        stored, codec, dictionary_id = self._encode(data, category)
+        self.storage.put(digest, stored)
         self._put_data_digest(
-            category, digest, len(data), timestamp=timestamp)
+            category, digest, len(data), timestamp=timestamp, codec=codec,
+            dictionary_id=dictionary_id)
         return digest
 
+    def put_data_dedup(self,
+                       category: str,
+                       data: bytes,
+                       timestamp: datetime.datetime = None,
+                       digest: bytes = None,
+                       reference: bool = False) -> PutResult:
+        '''
+        Add a data item to the database unless it is already stored.
+
+        Unlike :meth:`put_data`, storing an item that is already present is
+        not an error. The item is not encoded or written again, which makes
+        storing duplicates much cheaper than storing new items. When the
+        database has a Bloom filter, items that are definitely new are
+        recognised without querying the database.
+
+        :param category: a category label that must match an existing
+          category in the database.
+
+        :param data: the binary data to be stored in the database.
+
+        :param timestamp: a specific timestamp to store alongside the metadata
+          instead of the default `now` timestamp used if this field if left
+          as its default of None.
+
+        :param digest: the digest of the data, if the caller already knows
+          it, in which case the data is not hashed. The digest must have been
+          calculated using the database's ``hash_name``.
+
+        :param reference: if the item is already stored, record this
+          additional occurrence of it (see :meth:`query_occurrences`). The
+          item is then only removed from storage once every occurrence of it
+          has been deleted.
+
+        :return: a :class:`PutResult` with a ``stored`` status if the item
+          was added, or rewritten because the scrubber found the stored copy
+          damaged or quarantined it, or a ``duplicate`` status if it was
+          already stored.
+        '''
+        if digest is None:
+            digest = data_digest(data, hash_name=self.hash_name)
+        if self._is_recorded(digest):
+            if self._is_damaged(digest):
+                occurrence = None
+                if reference:
+                    occurrence = dict(
+                        digest=digest, category_label=category,
+                        timestamp=timestamp or datetime.datetime.now())
+                self._repair(category, digest, data, occurrence=occurrence)
+                return PutResult(digest, PUT_STORED, None)
+            if reference:
+                self._add_references([dict(
+                    digest=digest, category_label=category,
+                    timestamp=timestamp or datetime.datetime.now())])
+            return PutResult(digest, PUT_DUPLICATE, None)
+        stored, codec, dictionary_id = self._encode(data, category)
+        self._put_or_replace(digest, stored)
+        self._put_data_digest(
+            category, digest, len(data), timestamp=timestamp, codec=codec,
+            dictionary_id=dictionary_id)
+        return PutResult(digest, PUT_STORED, None)
+
+    def _put_or_replace(self, digest: bytes, stored: bytes) -> None:
+        '''
+        Add an item to storage, replacing any copy left behind by an earlier
+        put that failed to record it. The copy may have been encoded
+        differently so it can not be reused. This method does not use the
+        session.
+        '''
+        if self.storage.exists(digest):
+            self.storage.replace(digest, stored)
+        else:
+            self.storage.put(digest, stored)
+
+    def _is_damaged(self, digest: bytes) -> bool:
+        '''
+        Return True if the scrubber found a data item's stored copy damaged
+        or missing, which includes items it quarantined.
+        '''
+        return self.session.query(Verification.digest).filter(
+            Verification.digest == digest,
+            Verification.problem.isnot(None)).first() is not None
+
+    def _damaged_digests(self,
+                         digests: Iterable[bytes]) -> Set[bytes]:
+        '''
+        Return the subset of ``digests`` whose stored copies the scrubber
+        found damaged or missing (see :meth:`_is_damaged`).
+        '''
+        found = set()  # type: Set[bytes]
+        for chunk in chunked(set(digests), MAX_SQL_VARIABLES):
+            query = self.session.query(Verification.digest).filter(
+                Verification.digest.in_(chunk),
+                Verification.problem.isnot(None))
+            found.update(row[0] for row in query)
+        return found
+
+    def _repair(self,
+                category: str,
+                digest: bytes,
+                data: bytes,
+                occurrence: Dict = None) -> None:
+        '''
+        Store a damaged data item again and clear the problem recorded for
+        it so that it is verified afresh by the next scrub. The item keeps
+        its occurrences.
+
+        :param occurrence: a dict of the digest, category_label and
+          timestamp of an occurrence to record along with the repair.
+        '''
+        stored, codec, dictionary_id = self._encode(data, category)
+        self._put_or_replace(digest, stored)
+        self._record_repair(
+            digest, len(data), codec, dictionary_id, occurrence=occurrence)
+
+    def _record_repair(self,
+                       digest: bytes,
+                       size: int,
+                       codec: Optional[str],
+                       dictionary_id: Optional[int],
+                       occurrence: Dict = None) -> None:
+        ''' Record the encoding of a data item stored by :meth:`_repair` '''
+        try:
+            self.session.query(Digest).filter_by(digest=digest).update(
+                dict(byte_size=size, codec=codec,
+                     dictionary_id=dictionary_id),
+                synchronize_session=False)
+            self.session.query(Verification).filter_by(
+                digest=digest).delete(synchronize_session=False)
+            if occurrence is not None:
+                self._add_references([occurrence], commit=False)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        if codec is not None:
+            self._codecs_in_use = True
+        if self.cache is not None:
+            self.cache.put(digest, True)
+        logger.info('Repaired %s', digest.hex())
+
+    def _is_recorded(self, digest: bytes) -> bool:
+        ''' Return True if the digests table holds a row for digest '''
+        if self.bloom is not None and digest not in self.bloom:
+            return False
+        return self.session.query(Digest.digest).filter_by(
+            digest=digest).first() is not None
+
+    def _add_references(self,
+                        rows: List[Dict],
+                        commit: bool = True) -> None:
+        '''
+        Record additional occurrences of data items that are stored and
+        count them in the items' refcounts.
+
+        :param rows: a list of dicts of the digest, category_label and
+          timestamp of each occurrence.
+        '''
+        self.session.execute(Occurrence.__table__.insert(), rows)
+        counts = collections.Counter(row['digest'] for row in rows)
+        table = Digest.__table__
+        self.session.execute(
+            table.update().where(
+                table.c.digest == bindparam('b_digest')).values(
+                    refcount=table.c.refcount + bindparam('b_count')),
+            [dict(b_digest=digest, b_count=count)
+             for digest, count in counts.items()])
+        if commit:
+            self.session.commit()
+
+    def query_occurrences(
+            self,
+            digest: bytes) -> List[Tuple[str, datetime.datetime]]:
+        '''
+        Return each time a data item was stored, including the first.
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :return: a list of 2-tuples of (category_label, timestamp) ordered by
+          timestamp. The list is empty if the item is not stored.
+        '''
+        query = self.session.query(
+            Occurrence.category_label, Occurrence.timestamp).filter_by(
+                digest=digest).order_by(Occurrence.timestamp, Occurrence.id)
+        return [tuple(row) for row in query]
+
     def put_data_many(self,
                       *items: PutItem) -> List[bytes]:
         '''
         Add a list of data items to the database.
 
+        This is a convenience wrapper around :meth:`put_data_batch`. Items
+        that are already stored in the database are not treated as an error.
+
         :param items: a list of items to add to the database. Items are
           expected to be 3-tuples of (category_id, data, timestamp). If
           timestamp is None then the current time will be used as the
@@ -393,37 +1586,339 @@ class DigestDB(object):
 
         :return: a list of bytes object representing the hash digest of the
           data items
+
+        :raises: the error associated with the first item that could not be
+          added to the database.
+        '''
+        results = self.put_data_batch(items)
+        for result in results:
+            if result.status == PUT_FAILED:
+                raise result.error
+        return [result.digest for result in results]
+
+    def put_data_batch(self,
+                       items: Iterable[PutItem],
+                       batch_size: int = 1000,
+                       executor: Executor = None,
+                       reference: bool = False) -> List[PutResult]:
+        '''
+        Add many data items to the database using a bulk ingest strategy.
+
+        Items are consumed from ``items`` in batches of ``batch_size``. Each
+        batch is hashed, the blob files are written and then all of the
+        metadata rows for the batch are inserted using a single executemany
+        statement within one transaction. This avoids a commit (and hence a
+        disk sync) per item which is what limits the ingest rate of
+        :meth:`put_data`.
+
+        Items whose digest is already present in the database, or which
+        appear earlier in the same batch, are not written again and are
+        reported with a ``duplicate`` status. Items that can not be hashed or
+        written are reported with a ``failed`` status along with the error.
+
+        :param items: an iterable (e.g. a list or a generator) of 3-tuples of
+          (category, data, timestamp). If timestamp is None then the current
+          time will be used as the timestamp field in the database.
+
+        :param batch_size: the maximum number of items to insert per
+          transaction.
+
+        :param executor: an executor to use for hashing items and writing
+          blob files. Defaults to the executor the database was created with.
+          When no executor is available the work is performed serially on
+          the calling thread.
+
+        :param reference: record each duplicate item as an additional
+          occurrence of the stored item (see :meth:`query_occurrences`).
+
+        :return: a list of :class:`PutResult` items, one per input item and
+          in the same order, containing the digest, a status and an error
+          (if any) for each item.
+
+        :raises: an exception if the metadata for a batch could not be
+          committed. Files written for that batch are removed.
+        '''
+        results = []  # type: List[PutResult]
+        executor = executor or self.executor
+        for batch in chunked(items, batch_size):
+            results.extend(self._put_data_batch(batch, executor, reference))
+        return results
+
+    def _put_data_batch(self,
+                        batch: List[PutItem],
+                        executor: Executor = None,
+                        reference: bool = False) -> List[PutResult]:
+        '''
+        Add a single batch of data items to the database.
+
+        :param batch: a list of 3-tuples of (category, data, timestamp).
+
+        :param executor: an optional executor used to hash and write items.
+
+        :param reference: record duplicate items as occurrences.
+
+        :return: a list of :class:`PutResult` items.
+        '''
+        results = [None] * len(batch)  # type: List[PutResult]
+
+        blobs = [data for category, data, timestamp in batch]
+        if executor:
+            hashed = executor.map(
+                hash_data_item, blobs, itertools.repeat(self.hash_name),
+                chunksize=_chunksize(len(blobs)))
+        else:
+            hashed = (hash_data_item(data, self.hash_name) for data in blobs)
+
+        digests = [None] * len(batch)  # type: List[bytes]
+        for index, (digest, error) in enumerate(hashed):
+            if error:
+                results[index] = PutResult(None, PUT_FAILED, error)
+            digests[index] = digest
+
+        candidates = [d for d in digests if d]
+        if self.bloom is not None:
+            # only digests the filter may hold need to be looked up
+            candidates = [d for d in candidates if d in self.bloom]
+        existing = self._existing_digests(candidates)
+        # items the scrubber found damaged or quarantined are stored again
+        damaged = self._damaged_digests(existing)
+
+        pending = []  # type: List[int]
+        duplicates = []  # type: List[int]
+        seen = set()  # type: Set[bytes]
+        for index, digest in enumerate(digests):
+            if results[index]:
+                continue
+            if digest in seen or (digest in existing and digest not in damaged):
+                results[index] = PutResult(digest, PUT_DUPLICATE, None)
+                duplicates.append(index)
+                continue
+            seen.add(digest)
+            pending.append(index)
+
+        # damaged copies that were not quarantined are replaced
+        self.storage.delete_many(damaged)
+
+        encoded = self._encode_many(
+            [batch[i][1] for i in pending],
+            [batch[i][0] for i in pending],
+            executor=executor)
+
+        writes = self.storage.put_many(
+            [(digests[i], stored)
+             for i, (stored, codec, dictionary_id) in zip(pending, encoded)],
+            executor=executor)
+
+        rows = []  # type: List[Dict]
+        occurrences = []  # type: List[Dict]
+        repairs = []  # type: List[Dict]
+        written = []  # type: List[bytes]
+        for index, error, (stored, codec, dictionary_id) in zip(
+                pending, writes, encoded):
+            digest = digests[index]
+            if error:
+                results[index] = PutResult(digest, PUT_FAILED, error)
+                continue
+            category, data, timestamp = batch[index]
+            written.append(digest)
+            results[index] = PutResult(digest, PUT_STORED, None)
+            if digest in damaged:
+                repairs.append(dict(
+                    b_digest=digest,
+                    byte_size=len(data),
+                    codec=codec,
+                    dictionary_id=dictionary_id))
+                if reference:
+                    duplicates.append(index)
+                continue
+            rows.append(dict(
+                digest=digest,
+                byte_size=len(data),
+                codec=codec,
+                dictionary_id=dictionary_id,
+                refcount=1))
+            occurrences.append(dict(
+                digest=digest,
+                category_label=category,
+                timestamp=timestamp or datetime.datetime.now()))
+
+        references = []  # type: List[Dict]
+        if reference:
+            # duplicates of items that failed to be written are not recorded
+            stored = existing.difference(damaged).union(written)
+            references = [
+                dict(digest=digests[index], category_label=batch[index][0],
+                     timestamp=batch[index][2] or datetime.datetime.now())
+                for index in duplicates if digests[index] in stored]
+
+        if rows or repairs or references:
+            try:
+                if rows:
+                    self.session.execute(Digest.__table__.insert(), rows)
+                    self.session.execute(
+                        Occurrence.__table__.insert(), occurrences)
+                if repairs:
+                    self._record_repairs(repairs)
+                if references:
+                    self._add_references(references, commit=False)
+                self.session.commit()
+                if self.bloom is not None:
+                    self.bloom.update(written)
+                if repairs:
+                    logger.info('Repaired %s items', len(repairs))
+                if self.cache is not None:
+                    for digest in written:
+                        self.cache.put(digest, True)
+            except Exception:
+                self.session.rollback()
+                self.storage.delete_many(written)
+                raise
+
+        return results
+
+    def _record_repairs(self, rows: List[Dict]) -> None:
+        '''
+        Record the encodings of repaired data items and clear the problems
+        recorded for them, without committing.
+
+        :param rows: a list of dicts of the b_digest, byte_size, codec and
+          dictionary_id of each item.
+        '''
+        table = Digest.__table__
+        self.session.execute(
+            table.update().where(
+                table.c.digest == bindparam('b_digest')).values(
+                    byte_size=bindparam('byte_size'),
+                    codec=bindparam('codec'),
+                    dictionary_id=bindparam('dictionary_id')),
+            rows)
+        for chunk in chunked(
+                [row['b_digest'] for row in rows], MAX_SQL_VARIABLES):
+            self.session.query(Verification).filter(
+                Verification.digest.in_(chunk)).delete(
+                    synchronize_session=False)
+        if any(row['codec'] is not None for row in rows):
+            self._codecs_in_use = True
+
+    def _existing_digests(self,
+                          digests: Iterable[bytes]) -> Set[bytes]:
         '''
-        digests = []
-        for item in items:
-            category, data, timestamp = item
-            digests.append(self.put_data(category, data, timestamp))
-        return digests
+        Return the subset of ``digests`` that are present in the database.
+
+        The lookup is performed using as few ``IN`` queries as possible
+        rather than a query per digest.
+
+        :param digests: an iterable of digests to check.
+
+        :return: a set of the digests found in the database.
+        '''
+        found = set()  # type: Set[bytes]
+        for chunk in chunked(set(digests), MAX_SQL_VARIABLES):
+            query = self.session.query(Digest.digest).filter(
+                Digest.digest.in_(chunk))
+            found.update(row[0] for row in query)
+        return found
 
     def put_file(self,
                  category: str,
                  filepath: str,
-                 timestamp: datetime.datetime = None) -> bytes:
+                 timestamp: datetime.datetime = None,
+                 link: bool = False) -> bytes:
         '''
         Add the contents of a file to digestdb.
 
+        The file is hashed and then copied into the database without being
+        read into memory. The copy is performed by the kernel (e.g. using a
+        reflink, ``copy_file_range`` or ``sendfile``) where possible.
+
         :param category: a category label that must match an existing
           category that was previously added to the database.
 
+        :param filepath: the path of the file to add.
+
         :param timestamp: a specific timestamp to store alongside the metadata
           instead of the default `now` timestamp used if this field if left
           as its default of None.
 
+        :param link: when True the file is hard linked into the database if
+          it is on the same file system. The file must then never be modified
+          in place as that would corrupt the database item.
+
         :return: a bytes object representing the hash digest of the data item
         '''
         digest = file_digest(filepath, hash_name=self.hash_name)
-        with open(filepath, 'rb') as fd:
-            data = fd.read()
-        write_database_file(digest, data, self.data_dir, self.dir_depth)
-        self._put_data_digest(
-            category, digest, len(data), timestamp=timestamp)
+        if self._is_recorded(digest) and self._is_damaged(digest):
+            # replace the damaged copy, unless it was quarantined
+            self.storage.delete(digest)
+        size = self.storage.put_file(filepath, digest, link=link)
+        self._frame_copied(digest)
+        self._record_copied(category, digest, size, timestamp=timestamp)
+        return digest
+
+    def put_stream(self,
+                   category: str,
+                   source: Union[BinaryIO, Iterable[bytes]],
+                   timestamp: datetime.datetime = None,
+                   chunk_size: int = 2**20) -> bytes:
+        '''
+        Add a stream of data to digestdb.
+
+        The data is hashed while it is copied into the database so the
+        source is only read once and the memory used is constant regardless
+        of the size of the data.
+
+        :param category: a category label that must match an existing
+          category that was previously added to the database.
+
+        :param source: a binary file object or an iterable (e.g. a generator)
+          of bytes objects.
+
+        :param timestamp: a specific timestamp to store alongside the metadata
+          instead of the default `now` timestamp used if this field if left
+          as its default of None.
+
+        :param chunk_size: the number of bytes to read from a file object
+          source per iteration.
+
+        :return: a bytes object representing the hash digest of the data item
+        '''
+        if hasattr(source, 'read'):
+            chunks = iter(
+                lambda: source.read(chunk_size), b'')  # type: ignore
+        else:
+            chunks = iter(source)  # type: ignore
+        digest, size = self.storage.put_stream(
+            chunks, hash_name=self.hash_name)
+        self._frame_copied(digest)
+        self._record_copied(category, digest, size, timestamp=timestamp)
         return digest
 
+    def _record_copied(self,
+                       category: str,
+                       digest: bytes,
+                       size: int,
+                       timestamp: datetime.datetime = None) -> None:
+        '''
+        Record an item copied into storage as it is. An item the scrubber
+        found damaged or quarantined is repaired (see :meth:`_repair`).
+        '''
+        if self._is_recorded(digest) and self._is_damaged(digest):
+            self._record_repair(digest, size, None, None, occurrence=dict(
+                digest=digest, category_label=category,
+                timestamp=timestamp or datetime.datetime.now()))
+        else:
+            self._put_data_digest(category, digest, size, timestamp=timestamp)
+
+    def _frame_copied(self, digest: bytes) -> None:
+        '''
+        Frame an item copied into storage as it is if its contents could be
+        mistaken for a frame (see :func:`compression.frame_plain`).
+        '''
+        with self.storage.open_file(digest) as fd:
+            if not is_framed(fd.read(len(FRAME_MAGIC))):
+                return
+        self.storage.replace(digest, frame_plain(self.storage.get(digest)))
+
     def get_data(self, digest: bytes) -> bytes:
         ''' Return the contents of a data item.
 
@@ -432,89 +1927,774 @@ class DigestDB(object):
 
         :return: bytes
         '''
-        # Go straight to the filesystem to fetch a data item.
-        # Depending on the size of the objects it may be useful to
-        # fetch the metadata from the database first as the size could
-        # be used to choose an optimal chunk_size value.
+        codec, dictionary = self._encoding(digest)
+        return self._read_data(digest, codec, dictionary)
+
+    def get_data_many(self,
+                      digests: Iterable[bytes],
+                      ordered: bool = True,
+                      workers: int = 4,
+                      window: int = 64) -> Iterator[GetResult]:
+        '''
+        Return the contents of many data items.
+
+        Duplicate digests are only read once. The items are read
+        concurrently by a pool of threads in the order the storage reads
+        them most efficiently (e.g. by file path, so items sharing a
+        directory are read together, or by position within pack files).
+
+        .. code-block:: python
+
+            for digest, data, error in db.get_data_many(digests):
+                if error:
+                    print('Could not read {}: {}'.format(digest.hex(), error))
+
+        :param digests: an iterable of digests of the data items to return.
+
+        :param ordered: if True then results are returned in the order the
+          digests were first requested. If False then results are returned
+          as soon as each item has been read.
+
+        :param workers: the number of threads used to read items.
+
+        :param window: the maximum number of items read ahead of the
+          consumer, which bounds the memory held by items that have been
+          read but not yet returned. In ordered mode the window is refilled
+          in batches, once half of it has been consumed, and each batch is
+          read in the storage's order.
+
+        :return: an iterator of :class:`GetResult` 3-tuples of (digest, data,
+          error), one for each distinct digest. If an item could not be read,
+          for example because it does not exist, then data is None and error
+          is the exception raised.
+
+        :raises: Exception, immediately, if an invalid argument is used.
+        '''
+        if window < 1:
+            raise Exception(
+                'Invalid window. Expected at least 1 but got {}'.format(
+                    window))
+        requested = list(collections.OrderedDict.fromkeys(digests))
+        encodings = self._encodings(requested)
+        return self._get_data_many(
+            requested, encodings, ordered, workers, window)
+
+    def _get_data_many(
+            self,
+            requested: List[bytes],
+            encodings: Dict[bytes, Tuple[str, Optional[bytes]]],
+            ordered: bool,
+            workers: int,
+            window: int) -> Iterator[GetResult]:
+        if not requested:
+            return
+        pending = collections.OrderedDict()  # type: Dict[bytes, Future]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            def submit(digest: bytes) -> Future:
+                return executor.submit(
+                    self._get_item, digest,
+                    *encodings.get(digest, (None, None)))
+
+            try:
+                if ordered:
+                    position = 0
+                    while pending or position < len(requested):
+                        if len(pending) <= window // 2:
+                            batch = requested[
+                                position:position + window - len(pending)]
+                            position += len(batch)
+                            futures = dict(
+                                (digest, submit(digest))
+                                for digest in self.storage.read_order(batch))
+                            for digest in batch:
+                                pending[digest] = futures[digest]
+                        _, future = pending.popitem(last=False)
+                        yield future.result()
+                else:
+                    order = iter(self.storage.read_order(requested))
+                    while True:
+                        for digest in itertools.islice(
+                                order, window - len(pending)):
+                            pending[digest] = submit(digest)
+                        if not pending:
+                            break
+                        done, _ = wait(
+                            pending.values(), return_when=FIRST_COMPLETED)
+                        for digest in [
+                                d for d, f in pending.items() if f in done]:
+                            yield pending.pop(digest).result()
+            finally:
+                for future in pending.values():
+                    future.cancel()
+
+    def _get_item(self,
+                  digest: bytes,
+                  codec: Optional[str],
+                  dictionary: Optional[bytes]) -> GetResult:
+        '''
+        Return the contents of a data item, or the error raised reading it,
+        as a GetResult. This method does not use the session.
+        '''
         try:
-            return b''.join(
-                chunk for chunk in read_database_file(
-                    digest, self.data_dir, self.dir_depth))
-        except OSError:
-            logger.exception('Could not get file matching: {}'.format(digest))
+            data = self._decode(self.storage.get(digest), codec, dictionary)
+        except Exception as exc:
+            return GetResult(digest, None, exc)
+        return GetResult(digest, data, None)
+
+    def _encodings(
+            self,
+            digests: Iterable[bytes]) -> Dict[bytes, Tuple[str, Optional[bytes]]]:
+        '''
+        Return the codec and dictionary of each compressed data item in
+        ``digests`` using as few queries as possible. See :meth:`_encoding`.
+        '''
+        encodings = {}  # type: Dict[bytes, Tuple[str, Optional[bytes]]]
+        if not self._codecs_in_use:
+            return encodings
+        for chunk in chunked(digests, MAX_SQL_VARIABLES):
+            query = self.session.query(
+                Digest.digest, Digest.codec, Digest.dictionary_id).filter(
+                    Digest.digest.in_(chunk), Digest.codec.isnot(None))
+            for digest, codec, dictionary_id in query:
+                encodings[digest] = (codec, self._dictionary(dictionary_id))
+        return encodings
+
+    def _encode(self,
+                data: bytes,
+                category: str = None) -> Tuple[bytes, Optional[str],
+                                               Optional[int]]:
+        '''
+        Return the form of data to store, the codec used, if any, and the
+        identifier of the category's dictionary, if one was used.
+        '''
+        return self._encode_many([data], [category])[0]
+
+    def _encode_many(self,
+                     blobs: List[bytes],
+                     categories: List[str],
+                     executor: Executor = None) -> List[Tuple[
+                         bytes, Optional[str], Optional[int]]]:
+        '''
+        Encode many data items for storage, see :meth:`_encode`.
+
+        Compression is CPU bound so it is performed by the executor, if
+        one is supplied.
+        '''
+        if not self.compression:
+            return [(frame_plain(data), None, None) for data in blobs]
+        current = [
+            self._current_dictionaries.get(category, (None, None))
+            for category in categories]
+        dictionaries = [dictionary for _, dictionary in current]
+        thresholds = [
+            self.compression_threshold if dictionary is None
+            else self.dictionary_threshold for dictionary in dictionaries]
+        if executor:
+            encoded = executor.map(
+                encode, blobs,
+                itertools.repeat(self.compression),
+                thresholds,
+                itertools.repeat(self.compression_level),
+                dictionaries,
+                chunksize=_chunksize(len(blobs)))
+        else:
+            encoded = (
+                encode(data, self.compression, threshold=threshold,
+                       level=self.compression_level, dictionary=dictionary)
+                for data, threshold, dictionary in zip(
+                    blobs, thresholds, dictionaries))
+        return [
+            (stored, codec, dictionary_id if codec else None)
+            for (stored, codec), (dictionary_id, _) in zip(encoded, current)]
+
+    def _encoding(self,
+                  digest: bytes) -> Tuple[Optional[str], Optional[bytes]]:
+        '''
+        Return the name of the codec a data item was compressed with and
+        the dictionary used, if any. The codec is None if the item is stored
+        uncompressed.
+
+        The metadata is only consulted if some data items may be compressed
+        so reads from databases that do not use compression are unaffected.
+        '''
+        if not self._codecs_in_use:
+            return None, None
+        row = self.session.query(Digest.codec, Digest.dictionary_id).filter_by(
+            digest=digest).first()
+        if row is None:
+            return None, None
+        codec, dictionary_id = row
+        return codec, self._dictionary(dictionary_id)
+
+    def _dictionary(self, dictionary_id: Optional[int]) -> Optional[bytes]:
+        '''
+        Return the contents of a compression dictionary. Dictionaries that
+        are not cached are loaded using a session of their own so this
+        method can be called by any thread.
+        '''
+        if dictionary_id is None:
             return None
+        dictionary = self._dictionaries.get(dictionary_id)
+        if dictionary is None:
+            with self.session_scope() as session:
+                dictionary = session.query(Dictionary.data).filter_by(
+                    id=dictionary_id).scalar()
+            self._dictionaries[dictionary_id] = dictionary
+        return dictionary
+
+    def _decode(self,
+                stored: bytes,
+                codec: Optional[str],
+                dictionary: bytes = None) -> bytes:
+        ''' Return the original form of a stored data item '''
+        return decode(
+            stored, codec, dictionary=dictionary,
+            dictionaries=self._dictionary)
+
+    def _iter_stored(self,
+                     digest: bytes,
+                     chunk_size: int,
+                     codec: Optional[str],
+                     dictionary: bytes = None) -> Iterator[bytes]:
+        return iter_decode(
+            self.storage.iter_chunks(digest, chunk_size=chunk_size), codec,
+            dictionary=dictionary, dictionaries=self._dictionary)
+
+    def get_data_view(self, digest: bytes) -> memoryview:
+        '''
+        Return a read-only, memory mapped, view of the contents of a data
+        item.
+
+        This is useful for large data items as no copies of the data are
+        made. Slices of the view are also views and do not copy data.
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :return: a memoryview
+
+        :raises: OSError exception if the item does not exist.
+        '''
+        codec, dictionary = self._encoding(digest)
+        if codec:
+            # compressed items must be decompressed into memory
+            return memoryview(
+                self._decode(self.storage.get(digest), codec, dictionary))
+        view = self.storage.view(digest)
+        if is_framed(view):
+            # the item was recompressed after its encoding was looked up
+            return memoryview(self._decode(view, None))
+        return view
+
+    def open_data(self, digest: bytes) -> BinaryIO:
+        '''
+        Return a read-only binary file object for the contents of a data
+        item.
+
+        The caller is responsible for closing the returned file object.
+
+        .. code-block:: python
+
+            with db.open_data(digest) as fd:
+                header = fd.read(16)
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :return: a binary file object
+
+        :raises: OSError exception if the item does not exist.
+        '''
+        codec, dictionary = self._encoding(digest)
+        if not codec:
+            fd = self.storage.open_file(digest)
+            try:
+                framed = is_framed(fd.read(len(FRAME_MAGIC)))
+                fd.seek(0)
+            except Exception:
+                fd.close()
+                raise
+            if not framed:
+                return fd
+            fd.close()
+        return io.BytesIO(
+            self._decode(self.storage.get(digest), codec, dictionary))
+
+    def read_into(self, digest: bytes, buffer: bytearray) -> int:
+        '''
+        Read the contents of a data item into a caller supplied buffer.
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :param buffer: a writable buffer (e.g. a bytearray) that is large
+          enough to hold the entire data item.
+
+        :return: the number of bytes read into the buffer.
+
+        :raises: OSError exception if the item does not exist.
+
+        :raises: Exception if the buffer is too small to hold the data item.
+        '''
+        codec, dictionary = self._encoding(digest)
+        if codec:
+            stored = self.storage.get(digest)
+        else:
+            size = self.storage.read_into(digest, buffer)
+            if not is_framed(memoryview(buffer)[:size]):
+                return size
+            stored = bytes(memoryview(buffer)[:size])
+        data = self._decode(stored, codec, dictionary)
+        if len(data) > len(buffer):
+            raise Exception(
+                'Buffer too small. Expected at least {} bytes but got '
+                '{}'.format(len(data), len(buffer)))
+        memoryview(buffer)[:len(data)] = data
+        return len(data)
+
+    def iter_data(self,
+                  digest: bytes,
+                  chunk_size: int = 2**20) -> Iterator[bytes]:
+        '''
+        Return an iterator over the contents of a data item.
+
+        This avoids reading large data items completely into memory.
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :param chunk_size: the number of bytes to read per iteration.
+
+        :raises: OSError exception, when iterated, if the item does not
+          exist.
+        '''
+        return self._iter_stored(
+            digest, chunk_size, *self._encoding(digest))
 
     def query_data(self,
-                   **filters: Dict[str, str]) -> QueryResult:
+                   **filters: Any) -> QueryResult:
         ''' Query data items in the database.
 
-        This query supports a limited number of filter keyword arguments.
+        All of the filters are performed by the database, using the
+        digests table's indexes, rather than in Python.
+
         The supported query keywords are:
 
-        :keyword category: a label to use as a category query filter.
+        :keyword category: a category label, or a list of category labels,
+          to use as a category query filter.
+
+        :keyword since: only match items with a timestamp at or after this
+          datetime.
+
+        :keyword until: only match items with a timestamp before this
+          datetime.
+
+        :keyword min_size: only match items of at least this many bytes.
+
+        :keyword max_size: only match items of at most this many bytes.
+
+        :keyword order: 'asc' or 'desc' to order the matches by timestamp,
+          then digest and then occurrence id. If not specified the order is
+          undefined unless ``after`` is used, in which case the order is
+          'asc'.
+
+        :keyword after: a 3-tuple of (timestamp, digest, occurrence_id),
+          usually taken from the last match of the previous page, to only
+          match items that come after it in the requested order. This
+          provides efficient (keyset) pagination when used with ``limit``.
+          A 2-tuple of (timestamp, digest) skips every occurrence of the
+          item at that timestamp.
+
+        :keyword limit: the maximum number of matches to return.
+
+        .. code-block:: python
+
+            page = db.query_data(category='js', since=start, limit=100)
+            while page:
+                process(page)
+                last = page[-1]
+                page = db.query_data(
+                    category='js', since=start, limit=100,
+                    after=(last.timestamp, last.digest, last.occurrence_id))
+
+        :return: a list of matched blobs as :class:`QueryRow` 5-tuples
+          containing the digest, category_label, byte_size, timestamp and
+          occurrence_id.
 
-        :return: a list of matched blobs as 4-tuple containing the
-          digest, category_label, byte_size, timestamp.
+        :raises: Exception if an unsupported filter keyword or value is
+          used.
+        '''
+        return list(self.iter_query_data(**filters))
 
+    def iter_query_data(self,
+                        batch_size: int = 1000,
+                        **filters: Any) -> Iterator[QueryRow]:
         '''
-        query = self.session.query(Digest)
+        Return an iterator over the data items matching a query. See
+        :meth:`query_data` for the supported filter keywords.
+
+        Rows are fetched from the database in batches as the iterator is
+        consumed so memory use does not grow with the number of matches and
+        the first match is available as soon as the database finds it.
+
+        The iterator holds a read cursor open on the database until it is
+        exhausted or closed.
+
+        :param batch_size: the number of rows fetched from the database at
+          a time.
+
+        :return: an iterator of :class:`QueryRow` items.
+
+        :raises: Exception, immediately, if an unsupported filter keyword or
+          value is used.
+        '''
+        query = self._data_query(**filters)
+        return (QueryRow(*row) for row in query.yield_per(batch_size))
+
+    def _data_query(self,
+                    category: Union[str, Iterable[str]] = None,
+                    since: datetime.datetime = None,
+                    until: datetime.datetime = None,
+                    min_size: int = None,
+                    max_size: int = None,
+                    order: str = None,
+                    after: Tuple = None,
+                    limit: int = None,
+                    **unsupported: Any) -> Query:
+        ''' Return the query for the filters described in :meth:`query_data` '''
+        if unsupported:
+            raise Exception(
+                'Unsupported query filter: {}'.format(
+                    ', '.join(sorted(unsupported))))
+
+        query = self.session.query(
+            Occurrence.digest, Occurrence.category_label, Digest.byte_size,
+            Occurrence.timestamp, Occurrence.id).join(
+                Digest, Digest.digest == Occurrence.digest)
 
-        category = filters.get('category')
         if category:
-            query = query.filter_by(category_label=category)
+            if isinstance(category, str):
+                query = query.filter(Occurrence.category_label == category)
+            else:
+                query = query.filter(Occurrence.category_label.in_(category))
+        if since is not None:
+            query = query.filter(Occurrence.timestamp >= since)
+        if until is not None:
+            query = query.filter(Occurrence.timestamp < until)
+        if min_size is not None:
+            query = query.filter(Digest.byte_size >= min_size)
+        if max_size is not None:
+            query = query.filter(Digest.byte_size <= max_size)
+
+        if order is None and after is not None:
+            order = 'asc'
+        if order == 'asc':
+            query = query.order_by(
+                Occurrence.timestamp, Occurrence.digest, Occurrence.id)
+        elif order == 'desc':
+            query = query.order_by(
+                Occurrence.timestamp.desc(), Occurrence.digest.desc(),
+                Occurrence.id.desc())
+        elif order is not None:
+            raise Exception(
+                'Invalid order. Expected asc or desc but got {}'.format(
+                    order))
+
+        if after is not None:
+            # A row value comparison lets SQLite seek straight to the start
+            # of the page using the timestamp indexes.
+            if len(after) not in (2, 3):
+                raise Exception(
+                    'Invalid after. Expected (timestamp, digest, '
+                    'occurrence_id) but got {}'.format(after))
+            columns = [Occurrence.timestamp, Occurrence.digest]
+            values = [
+                literal(after[0], EpochTimestamp),
+                literal(after[1], LargeBinary)]
+            if len(after) == 3:
+                columns.append(Occurrence.id)
+                values.append(literal(after[2], Integer))
+            key, position = tuple_(*columns), tuple_(*values)
+            query = query.filter(
+                key > position if order == 'asc' else key < position)
+
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def replay(self,
+               category: Union[str, Iterable[str]] = None,
+               since: datetime.datetime = None,
+               until: datetime.datetime = None,
+               window: int = 32,
+               workers: int = 4,
+               speed: float = None,
+               **filters: Any) -> Iterator[ReplayItem]:
+        '''
+        Return an iterator that replays data items in timestamp order.
 
-        return [
-            (b.digest, b.category_label, b.byte_size, b.timestamp) for b in query]
+        The contents of upcoming items are read by a pool of threads ahead
+        of the consumer so that storage reads overlap with each other and
+        with the consumer's processing of earlier items.
+
+        .. code-block:: python
+
+            for timestamp, category, data in db.replay(
+                    category='msgs', since=start, speed=1.0):
+                dispatch(category, data)
+
+        :param category: a category label, or a list of category labels, to
+          replay. If None then all categories are replayed.
+
+        :param since: only replay items with a timestamp at or after this
+          datetime.
+
+        :param until: only replay items with a timestamp before this
+          datetime.
+
+        :param window: the maximum number of items read ahead of the
+          consumer.
+
+        :param workers: the number of threads used to read items.
+
+        :param speed: if specified then items are yielded at the pace they
+          were originally added, as recorded by their timestamps, multiplied
+          by this factor. For example 1.0 is real time and 2.0 is twice as
+          fast. If None then items are yielded as fast as they are consumed.
+
+        :param filters: any other filter keywords supported by
+          :meth:`query_data`, except for ``order``.
+
+        :return: an iterator of :class:`ReplayItem` 3-tuples of (timestamp,
+          category, data). The data is None if the item could not be read
+          from storage.
+
+        :raises: Exception, immediately, if an invalid argument is used.
+        '''
+        if window < 1:
+            raise Exception(
+                'Invalid window. Expected at least 1 but got {}'.format(
+                    window))
+        if speed is not None and speed <= 0:
+            raise Exception(
+                'Invalid speed. Expected a positive number but got {}'.format(
+                    speed))
+        if 'order' in filters:
+            raise Exception(
+                'Invalid filter. Items are always replayed in ascending '
+                'timestamp order but got order={}'.format(filters['order']))
+        query = self._data_query(
+            category=category, since=since, until=until, order='asc',
+            **filters).add_columns(Digest.codec, Digest.dictionary_id)
+        return self._replay(query, window, workers, speed)
+
+    def _read_data(self,
+                   digest: bytes,
+                   codec: Optional[str],
+                   dictionary: Optional[bytes]) -> Optional[bytes]:
+        '''
+        Return the contents of a data item given its encoding, or None if it
+        could not be read. This method does not use the session so it can be
+        run by a thread other than the one that owns the session.
+        '''
+        try:
+            return self._decode(self.storage.get(digest), codec, dictionary)
+        except OSError:
+            logger.exception('Could not get file matching: {}'.format(digest))
+            return None
+
+    def _replay(self,
+                query: Query,
+                window: int,
+                workers: int,
+                speed: Optional[float]) -> Iterator[ReplayItem]:
+        pending = collections.deque()  # type: collections.deque
+        rows = iter(query.yield_per(max(window, 100)))
+        start = None  # type: Tuple[datetime.datetime, float]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    # keep the read ahead window full
+                    for row in itertools.islice(rows, window - len(pending)):
+                        (digest, category, _, timestamp, _, codec,
+                         dictionary_id) = row
+                        future = executor.submit(
+                            self._read_data, digest, codec,
+                            self._dictionary(dictionary_id))
+                        pending.append((timestamp, category, future))
+                    if not pending:
+                        break
+
+                    timestamp, category, future = pending.popleft()
+                    if speed is not None:
+                        if start is None:
+                            start = (timestamp, time.monotonic())
+                        due = (timestamp - start[0]).total_seconds() / speed
+                        delay = due - (time.monotonic() - start[1])
+                        if delay > 0:
+                            time.sleep(delay)
+                    yield ReplayItem(timestamp, category, future.result())
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
 
     def delete_data(self,
-                    digest: bytes) -> None:
-        ''' Delete a data item from the database '''
+                    digest: bytes,
+                    category: str = None) -> None:
+        '''
+        Delete a data item, or its occurrences in a category, from the
+        database.
+
+        The item is only removed from storage once all of its occurrences
+        have been deleted. See :meth:`delete_data_many`.
+
+        :param digest: a bytes object representing the hash digest of the
+          data item.
+
+        :param category: if set, only the item's occurrences in this
+          category are deleted.
+        '''
+        result = self.delete_data_many([digest], category=category)
+        if not result.occurrences:
+            # Remove anything left in storage by a put that failed to record
+            # the item.
+            if not self._is_recorded(digest):
+                self.storage.delete(digest)
+
+    def delete_data_many(self,
+                         digests: Iterable[bytes],
+                         category: str = None) -> DeleteResult:
+        '''
+        Delete many data items, or their occurrences in a category, from the
+        database.
+
+        :param digests: an iterable of digests of the data items to delete.
+
+        :param category: if set, only the items' occurrences in this category
+          are deleted. Items that also occur in other categories are kept.
+
+        :return: a :class:`DeleteResult` counting the occurrences deleted and
+          the items, and their bytes, removed from storage.
+        '''
+        ids = []  # type: List[int]
+        for chunk in chunked(set(digests), MAX_SQL_VARIABLES):
+            query = self.session.query(Occurrence.id).filter(
+                Occurrence.digest.in_(chunk))
+            if category is not None:
+                query = query.filter(Occurrence.category_label == category)
+            ids.extend(row[0] for row in query)
+        return self.delete_occurrences(ids)
+
+    def delete_occurrences(self, ids: Iterable[int]) -> DeleteResult:
+        '''
+        Delete occurrences of data items by their identifiers, decrementing
+        each item's reference count. Items left without any occurrences are
+        removed from the database and then from storage.
+
+        The metadata is updated in a single transaction using bulk
+        statements. Items are only removed from storage once the transaction
+        has committed so a crash can leave an untracked item in storage (see
+        :meth:`reconcile`) but never a tracked item that is missing.
+
+        :param ids: an iterable of occurrence identifiers.
+
+        :return: a :class:`DeleteResult` counting the occurrences deleted and
+          the items, and their bytes, removed from storage.
+        '''
+        counts = collections.Counter()  # type: collections.Counter
+        deleted = 0
+        table = Digest.__table__
         try:
-            b = self.session.query(Digest).filter_by(digest=digest).one()
-            self.session.delete(b)
+            for chunk in chunked(set(ids), MAX_SQL_VARIABLES):
+                query = self.session.query(
+                    Occurrence.digest, func.count()).filter(
+                        Occurrence.id.in_(chunk)).group_by(Occurrence.digest)
+                counts.update(dict(query.all()))
+                deleted += self.session.query(Occurrence).filter(
+                    Occurrence.id.in_(chunk)).delete(
+                        synchronize_session=False)
+            if counts:
+                self.session.execute(
+                    table.update().where(
+                        table.c.digest == bindparam('b_digest')).values(
+                            refcount=table.c.refcount - bindparam('b_count')),
+                    [dict(b_digest=digest, b_count=count)
+                     for digest, count in counts.items()])
+            released = []  # type: List[bytes]
+            byte_count = 0
+            for chunk in chunked(list(counts), MAX_SQL_VARIABLES):
+                query = self.session.query(
+                    Digest.digest, Digest.byte_size).filter(
+                        Digest.digest.in_(chunk), Digest.refcount <= 0)
+                for digest, byte_size in query:
+                    released.append(digest)
+                    byte_count += byte_size or 0
+            for chunk in chunked(released, MAX_SQL_VARIABLES):
+                for model in (Digest, Verification):
+                    self.session.query(model).filter(
+                        model.digest.in_(chunk)).delete(
+                            synchronize_session=False)
             self.session.commit()
         except Exception:
-            pass
+            self.session.rollback()
+            raise
 
-        try:
-            os.remove(
-                os.path.join(self.data_dir, digest_filepath(
-                    digest, dir_depth=self.dir_depth)))
-        except OSError:
-            pass
+        if self.cache is not None:
+            for digest in released:
+                self.cache.put(digest, False)
+        self.storage.delete_many(released)
+        return DeleteResult(deleted, len(released), byte_count)
 
     def exists(self, digest: bytes) -> bool:
         ''' Check if an entry exists in the database for the digest.
 
-        This will check both the database and the file system.
+        This will check both the database and the file system. If the
+        database was created with a Bloom filter then items that are
+        definitely not present are reported without any I/O. If the
+        database was created with a cache then the result is served from
+        the cache when possible.
 
         :param digest: a bytes object representing the hash digest of the
           data item.
 
         :return: a boolean indicating if the item is present in the database.
         '''
-        present_in_db = False
-        present_in_fs = False
+        if self.bloom is not None and digest not in self.bloom:
+            # definitely not present
+            return False
 
-        try:
-            self.session.query(Digest).filter_by(digest=digest).one()
-            present_in_db = True
-        except Exception:
-            pass
+        if self.cache is not None:
+            result = self.cache.get(digest)
+            if result is not MISSING:
+                return result
 
-        present_in_fs = os.path.exists(
-            os.path.join(self.data_dir, digest_filepath(
-                digest, dir_depth=self.dir_depth)))
+        # Only the key column is selected which avoids building a Digest
+        # object. The blob storage is only checked if the row exists.
+        present_in_db = self.session.query(Digest.digest).filter_by(
+            digest=digest).first() is not None
+        present_in_fs = present_in_db and self.storage.exists(digest)
 
         result = present_in_db and present_in_fs
 
         if not result:
             logger.debug(
-                '%x not found in database. db=%s, fs=%s',
-                digest, present_in_db, present_in_fs)
+                '%s not found in database. db=%s, fs=%s',
+                digest.hex(), present_in_db, present_in_fs)
+
+        if self.cache is not None:
+            self.cache.put(digest, result)
 
         return result
 
+    def cache_info(self) -> Optional[CacheInfo]:
+        '''
+        Return the hit and miss statistics for the existence cache.
+
+        :return: a CacheInfo named tuple, or None if caching is disabled.
+        '''
+        return self.cache.info() if self.cache is not None else None
+
     def count_data(self) -> int:
         ''' Return the number of data items in the database. '''
         return self.session.query(Digest).count()
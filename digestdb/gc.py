@@ -0,0 +1,238 @@
+''' This module enforces the retention policies of categories '''
+
+import datetime
+import logging
+
+from sqlalchemy import func, or_
+
+from .model import Category, Digest, Occurrence
+from .scrub import RateLimiter
+
+# type annotations
+from typing import (
+    Any, Iterable, Iterator, List, NamedTuple, Optional, Tuple)
+from sqlalchemy.orm.query import Query
+
+
+logger = logging.getLogger(__name__)
+
+
+RetentionPolicy = NamedTuple('RetentionPolicy', [
+    # the maximum age, in seconds, of the occurrences kept
+    ('max_age', Optional[float]),
+    # the maximum total size of the occurrences kept
+    ('max_bytes', Optional[int]),
+    # the maximum number of occurrences kept
+    ('max_count', Optional[int])])
+
+GCReport = NamedTuple('GCReport', [
+    # the number of occurrences deleted
+    ('occurrences', int),
+    # the number of data items removed from storage
+    ('items', int),
+    # the total size of the data items removed from storage
+    ('byte_count', int),
+    # the categories that had occurrences deleted
+    ('categories', List[str])])
+
+
+def check_policy(policy: RetentionPolicy) -> None:
+    ''' Raise an exception if a retention policy has an invalid limit '''
+    for name, value in zip(policy._fields, policy):
+        if value is not None and value < 0:
+            raise Exception(
+                'Invalid {}. Expected at least 0 but got {}'.format(
+                    name, value))
+
+
+class Collector(object):
+    '''
+    This class deletes the occurrences of data items that fall outside the
+    retention policies of their categories. Data items left without any
+    occurrences are removed from storage (see
+    :meth:`DigestDB.delete_occurrences`).
+
+    The oldest occurrences in a category are deleted first. Occurrences
+    older than the category's ``max_age`` are deleted, then the oldest are
+    deleted until no more than ``max_count`` remain and the sizes of those
+    remaining add up to no more than ``max_bytes``. The size of an
+    occurrence is the size of its data item, so an item shared by several
+    occurrences counts towards the total once for each of them.
+
+    Occurrences are deleted in batches. Each batch is deleted in its own
+    short transaction and its items are unlinked once it has committed, so
+    the database is never locked for long. The rate at which occurrences
+    are deleted can be limited so a collection can run alongside ingest.
+    '''
+
+    def __init__(self,
+                 db: 'DigestDB',
+                 categories: Iterable[str] = None,
+                 rate: float = None,
+                 limit: int = None,
+                 batch_size: int = 1000) -> None:
+        '''
+
+        :param db: an open database.
+
+        :param categories: the labels of the categories to collect. If None
+          then every category with a retention policy is collected.
+
+        :param rate: the maximum number of occurrences deleted per second.
+          If None then deletes are not limited.
+
+        :param limit: the maximum number of occurrences to delete.
+
+        :param batch_size: the number of occurrences deleted per
+          transaction.
+        '''
+        if limit is not None and limit < 0:
+            raise Exception(
+                'Invalid limit. Expected at least 0 but got {}'.format(limit))
+        if batch_size < 1:
+            raise Exception(
+                'Invalid batch_size. Expected at least 1 but got {}'.format(
+                    batch_size))
+        self.db = db
+        self.categories = None if categories is None else list(categories)
+        self.limiter = RateLimiter(
+            rate, burst=batch_size) if rate is not None else None
+        self.remaining = limit
+        self.batch_size = batch_size
+        self.now = datetime.datetime.now()
+        self.occurrences = 0
+        self.items = 0
+        self.byte_count = 0
+        self.collected = []  # type: List[str]
+
+    def policies(self) -> List[Tuple[str, RetentionPolicy]]:
+        '''
+        Return the labels and retention policies of the categories to
+        collect. This method uses the session.
+        '''
+        query = self.db.session.query(
+            Category.label, Category.max_age, Category.max_bytes,
+            Category.max_count).filter(
+                or_(Category.max_age.isnot(None),
+                    Category.max_bytes.isnot(None),
+                    Category.max_count.isnot(None)))
+        if self.categories is not None:
+            query = query.filter(Category.label.in_(self.categories))
+        return [
+            (label, RetentionPolicy(max_age, max_bytes, max_count))
+            for label, max_age, max_bytes, max_count in query.order_by(
+                Category.label)]
+
+    def _size(self) -> int:
+        size = self.batch_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        return size
+
+    def _oldest(self, label: str, *columns: Any) -> Query:
+        ''' Return a query of a category's occurrences, oldest first '''
+        return self.db.session.query(Occurrence.id, *columns).filter(
+            Occurrence.category_label == label).order_by(
+                Occurrence.timestamp, Occurrence.id)
+
+    def expired(self,
+                label: str,
+                policy: RetentionPolicy) -> Iterator[List[int]]:
+        '''
+        Generate batches of the identifiers of a category's occurrences that
+        should be deleted. Each batch must be deleted before the next one
+        is requested. This generator uses the session.
+        '''
+        if policy.max_age is not None:
+            cutoff = self.now - datetime.timedelta(seconds=policy.max_age)
+            while self._size():
+                ids = [row[0] for row in self._oldest(label).filter(
+                    Occurrence.timestamp < cutoff).limit(self._size())]
+                if not ids:
+                    break
+                yield ids
+
+        if policy.max_count is not None:
+            excess = self.db.session.query(func.count(Occurrence.id)).filter(
+                Occurrence.category_label == label).scalar() - policy.max_count
+            while excess > 0 and self._size():
+                ids = [row[0] for row in self._oldest(label).limit(
+                    min(excess, self._size()))]
+                if not ids:
+                    break
+                excess -= len(ids)
+                yield ids
+
+        if policy.max_bytes is not None:
+            total = self.db.session.query(
+                func.coalesce(func.sum(Digest.byte_size), 0)).join(
+                    Occurrence, Occurrence.digest == Digest.digest).filter(
+                        Occurrence.category_label == label).scalar()
+            excess = total - policy.max_bytes
+            while excess > 0 and self._size():
+                ids = []
+                query = self._oldest(label, Digest.byte_size).join(
+                    Digest, Digest.digest == Occurrence.digest).limit(
+                        self._size())
+                for occurrence_id, byte_size in query:
+                    ids.append(occurrence_id)
+                    excess -= byte_size or 0
+                    if excess <= 0:
+                        break
+                if not ids:
+                    break
+                yield ids
+
+    def batches(self) -> Iterator[Tuple[str, List[int]]]:
+        '''
+        Generate the batches of occurrences to delete from every category
+        being collected, as 2-tuples of (label, ids). This generator uses
+        the session.
+        '''
+        for label, policy in self.policies():
+            for ids in self.expired(label, policy):
+                yield label, ids
+
+    def collect(self, label: str, ids: List[int]) -> None:
+        '''
+        Delete a batch of occurrences and their unreferenced items. This
+        method uses the session.
+        '''
+        result = self.db.delete_occurrences(ids)
+        self.occurrences += result.occurrences
+        self.items += result.items
+        self.byte_count += result.byte_count
+        if result.occurrences and label not in self.collected:
+            self.collected.append(label)
+        if self.remaining is not None:
+            self.remaining -= len(ids)
+
+    def throttle(self, count: int) -> None:
+        '''
+        Sleep for long enough to keep deletes within the rate limit. This
+        method does not use the session.
+        '''
+        if self.limiter is not None:
+            self.limiter.consume(count)
+
+    def report(self) -> GCReport:
+        ''' Return a report of what has been reclaimed so far '''
+        return GCReport(
+            self.occurrences, self.items, self.byte_count,
+            list(self.collected))
+
+    def run(self) -> GCReport:
+        '''
+        Enforce the retention policies.
+
+        :return: a :class:`GCReport`.
+        '''
+        for label, ids in self.batches():
+            self.collect(label, ids)
+            self.throttle(len(ids))
+        report = self.report()
+        logger.debug(
+            'Collected %s occurrences from %s categories: %s items '
+            '(%s bytes) removed', report.occurrences, len(report.categories),
+            report.items, report.byte_count)
+        return report
@@ -2,6 +2,9 @@
 import hashlib
 import os
 
+# type annotations
+from typing import Iterable
+
 
 def data_digest(data: bytes, hash_name: str = 'sha256') -> bytes:
     '''
@@ -39,10 +42,25 @@ def file_digest(filename: str,
 
     :return: a bytes object representing the digest of the data.
     '''
-    h = hashlib.new(hash_name)
     with open(filename, 'rb') as fd:
-        for chunk in iter(lambda: fd.read(chunk_size), b''):
-            h.update(chunk)
+        return chunks_digest(
+            iter(lambda: fd.read(chunk_size), b''), hash_name=hash_name)
+
+
+def chunks_digest(chunks: Iterable[bytes],
+                  hash_name: str = 'sha256') -> bytes:
+    '''
+    Return a hash representing the data in a stream of chunks.
+
+    :param chunks: an iterable of bytes objects.
+
+    :param hash_name: the name of a hash calculator. Defaults to sha256.
+
+    :return: a bytes object representing the digest of the data.
+    '''
+    h = hashlib.new(hash_name)
+    for chunk in chunks:
+        h.update(chunk)
     return h.digest()
 
 
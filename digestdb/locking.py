@@ -0,0 +1,123 @@
+''' This module coordinates the processes that open a database '''
+
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock(object):
+    '''
+    This class holds an advisory shared or exclusive lock on a file using
+    ``flock``.
+
+    The operating system releases the lock when the file is closed, which
+    includes when the process holding it exits or crashes, so a lock can not
+    be left held by a process that no longer exists. The lock file itself is
+    never removed as another process may be waiting to lock it.
+
+    Locks are held on open file descriptions so two locks on the same file
+    exclude each other even when they are held by the same process.
+
+    The process id of the holder of an exclusive lock is written into the
+    lock file and cleared when the lock is released. Finding a process id
+    when the lock is acquired means the previous holder did not release the
+    lock (see :attr:`stale_owner`).
+    '''
+
+    def __init__(self, path: str) -> None:
+        '''
+
+        :param path: the path of the lock file. It is created if necessary.
+        '''
+        if fcntl is None:
+            raise Exception('File locking is not supported on this platform')
+        self.path = path
+        self.shared = None  # type: bool
+        # the process id left in the lock file by a holder that crashed
+        self.stale_owner = None  # type: int
+        self._fd = None  # type: int
+
+    def __repr__(self) -> str:
+        return "<FileLock '{}'>".format(self.path)
+
+    @property
+    def locked(self) -> bool:
+        ''' Return True if the lock is held '''
+        return self._fd is not None
+
+    def owner(self) -> int:
+        '''
+        Return the process id recorded in the lock file, or None if there
+        isn't one.
+        '''
+        try:
+            with open(self.path, 'r') as fd:
+                return int(fd.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self, shared: bool = False, blocking: bool = False) -> bool:
+        '''
+        Acquire the lock, or change the kind of lock held.
+
+        Changing the kind of lock held is not atomic. Another process may
+        acquire the lock while it is being changed.
+
+        :param shared: acquire a shared lock, which can be held by several
+          holders at once, rather than an exclusive lock.
+
+        :param blocking: wait until the lock can be acquired rather than
+          giving up immediately.
+
+        :return: True if the lock was acquired.
+        '''
+        fd = self._fd
+        if fd is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        elif shared and not self.shared:
+            # the exclusive lock is being released
+            os.ftruncate(fd, 0)
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            if self._fd is None:
+                os.close(fd)
+            return False
+        except Exception:
+            if self._fd is None:
+                os.close(fd)
+            raise
+        self._fd = fd
+        self.shared = shared
+        if not shared:
+            self.stale_owner = self.owner()
+            if self.stale_owner is not None:
+                logger.warning(
+                    'Recovered lock %s left by process %s', self.path,
+                    self.stale_owner)
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(os.getpid()).encode(), 0)
+        return True
+
+    def release(self) -> None:
+        ''' Release the lock if it is held '''
+        if self._fd is None:
+            return
+        try:
+            if not self.shared:
+                os.ftruncate(self._fd, 0)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            self.shared = None
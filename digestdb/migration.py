@@ -0,0 +1,358 @@
+''' This module creates and upgrades the database schema '''
+
+import logging
+
+from sqlalchemy import (
+    Column, Float, ForeignKey, Index, Integer, LargeBinary, MetaData, String,
+    Table)
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+
+from .model import Base, Digest
+
+# type annotations
+from typing import Callable, List, Optional, Tuple
+import sqlite3
+from sqlalchemy.engine import Dialect, Engine
+
+
+logger = logging.getLogger(__name__)
+
+
+# The schema version is stored in the SQLite user_version header field. It
+# is incremented each time a migration is added to MIGRATIONS.
+SCHEMA_VERSION = 7
+
+# The digests table as it was from schema version 1 until version 5 moved
+# the category and timestamp of each item into the occurrences table.
+# Migrations must not depend on the current model, which changes over time,
+# so the tables they create are defined here.
+DIGESTS_V1 = Table(
+    'digests', MetaData(),
+    Column('digest', LargeBinary, primary_key=True),
+    Column('category_label', String),
+    Column('timestamp', Integer),
+    Column('byte_size', Integer),
+    Column('codec', String),
+    Column('dictionary_id', Integer),
+    Index('ix_digests_category_timestamp',
+          'category_label', 'timestamp', 'digest'),
+    Index('ix_digests_timestamp', 'timestamp', 'digest'))
+
+# The indexes of the occurrences table from schema version 5 until version 7
+# added the occurrence id to the timestamp indexes.
+OCCURRENCES_V5 = Table(
+    'occurrences', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('digest', LargeBinary),
+    Column('category_label', String),
+    Column('timestamp', Integer),
+    Index('ix_occurrences_category_timestamp',
+          'category_label', 'timestamp', 'digest'),
+    Index('ix_occurrences_timestamp', 'timestamp', 'digest'),
+    Index('ix_occurrences_digest', 'digest'))
+
+# The digests table as schema version 5 rebuilt it, holding only how each
+# item is stored and its refcount. The dictionaries table is only defined
+# so that the foreign key to it can be created.
+_METADATA_V5 = MetaData()
+Table(
+    'dictionaries', _METADATA_V5,
+    Column('id', Integer, primary_key=True))
+DIGESTS_V5 = Table(
+    'digests', _METADATA_V5,
+    Column('digest', LargeBinary, primary_key=True),
+    Column('byte_size', Integer),
+    Column('codec', String),
+    Column('dictionary_id', Integer, ForeignKey('dictionaries.id')),
+    Column('refcount', Integer, nullable=False))
+
+# The retention policy columns schema version 6 added to the categories
+# table.
+CATEGORY_RETENTION_V6 = [
+    Column('max_age', Float),
+    Column('max_bytes', Integer),
+    Column('max_count', Integer)]
+
+# The indexes of the occurrences table from schema version 7, which added
+# the occurrence id to the timestamp indexes.
+OCCURRENCES_V7 = Table(
+    'occurrences', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('digest', LargeBinary),
+    Column('category_label', String),
+    Column('timestamp', Integer),
+    Index('ix_occurrences_category_timestamp',
+          'category_label', 'timestamp', 'digest', 'id'),
+    Index('ix_occurrences_timestamp', 'timestamp', 'digest', 'id'),
+    Index('ix_occurrences_digest', 'digest'))
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    ''' Return the schema version recorded in the database file '''
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _set_schema_version(conn: sqlite3.Connection, version: int) -> None:
+    # PRAGMA statements do not accept bound parameters
+    conn.execute('PRAGMA user_version = {:d}'.format(version))
+
+
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (name,)).fetchone() is not None
+
+
+def _rename_table(conn: sqlite3.Connection, name: str, new_name: str) -> None:
+    '''
+    Rename a table without rewriting the foreign keys of other tables that
+    refer to it. The table is about to be replaced by a new table with the
+    original name which the foreign keys should continue to refer to.
+    '''
+    conn.execute('PRAGMA legacy_alter_table = ON')
+    try:
+        conn.execute('ALTER TABLE {} RENAME TO {}'.format(name, new_name))
+    finally:
+        conn.execute('PRAGMA legacy_alter_table = OFF')
+
+
+def _recreate_indexes(conn: sqlite3.Connection,
+                      dialect: Dialect,
+                      table: Table) -> None:
+    for index in table.indexes:
+        conn.execute('DROP INDEX IF EXISTS {}'.format(index.name))
+        conn.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+
+def _create_tables(conn: sqlite3.Connection, dialect: Dialect) -> None:
+    ''' Create any missing tables other than the digests table '''
+    for table in Base.metadata.sorted_tables:
+        if table is Digest.__table__ or _has_table(conn, table.name):
+            continue
+        conn.execute(str(CreateTable(table).compile(dialect=dialect)))
+        for index in table.indexes:
+            conn.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+
+def _create_digests_table(conn: sqlite3.Connection,
+                          dialect: Dialect,
+                          without_rowid: bool,
+                          table: Table = Digest.__table__) -> None:
+    '''
+    Create the digests table and its indexes.
+
+    A WITHOUT ROWID table stores each row in the primary key index, keyed on
+    the digest, rather than in a separate table keyed on a hidden rowid.
+    This saves the space of a second b-tree and a lookup for every query
+    by digest.
+    '''
+    ddl = str(CreateTable(table).compile(dialect=dialect)).strip()
+    if without_rowid:
+        ddl += ' WITHOUT ROWID'
+    conn.execute(ddl)
+    for index in table.indexes:
+        conn.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+
+def _migrate_v1(conn: sqlite3.Connection,
+                dialect: Dialect,
+                without_rowid: bool) -> None:
+    '''
+    Rebuild the digests table with integer epoch timestamps and indexes.
+
+    Earlier versions stored timestamps as SQLAlchemy's text datetimes in the
+    form 'YYYY-MM-DD HH:MM:SS.ffffff'. They are converted to microseconds
+    since the epoch within SQLite so the rows never pass through Python.
+    '''
+    columns = set(
+        row[1] for row in conn.execute('PRAGMA table_info(digests)'))
+    codec = 'codec' if 'codec' in columns else 'NULL'
+    dictionary_id = 'dictionary_id' if 'dictionary_id' in columns else 'NULL'
+
+    _rename_table(conn, 'digests', 'digests_v0')
+    _create_digests_table(conn, dialect, without_rowid, table=DIGESTS_V1)
+    conn.execute(
+        'INSERT INTO digests '
+        '(digest, category_label, timestamp, byte_size, codec, dictionary_id) '
+        'SELECT digest, category_label, '
+        "CAST(strftime('%s', timestamp) AS INTEGER) * 1000000 + "
+        'CAST(substr(timestamp, 21, 6) AS INTEGER), '
+        'byte_size, {}, {} FROM digests_v0'.format(codec, dictionary_id))
+    conn.execute('DROP TABLE digests_v0')
+
+
+def _migrate_v2(conn: sqlite3.Connection,
+                dialect: Dialect,
+                without_rowid: bool) -> None:
+    '''
+    Recreate the timestamp indexes with the digest as their last column so
+    that queries ordered by (timestamp, digest) do not need a sort.
+    '''
+    _recreate_indexes(conn, dialect, DIGESTS_V1)
+
+
+def _migrate_v3(conn: sqlite3.Connection,
+                dialect: Dialect,
+                without_rowid: bool) -> None:
+    '''
+    Add the verifications table used by the scrubber. New tables are
+    created by :func:`_create_tables` before each migration is applied so
+    there is nothing else to do.
+    '''
+
+
+def _migrate_v4(conn: sqlite3.Connection,
+                dialect: Dialect,
+                without_rowid: bool) -> None:
+    '''
+    Add the occurrences table used to record additional references to data
+    items. It is created by :func:`_create_tables`.
+    '''
+
+
+def _migrate_v5(conn: sqlite3.Connection,
+                dialect: Dialect,
+                without_rowid: bool) -> None:
+    '''
+    Move the category and timestamp of each item into the occurrences table
+    and count the references to each item.
+
+    Until now the digests table held an item's first occurrence and the
+    occurrences table only held any later ones, so the first occurrences
+    are added to it and each item's refcount is one more than the number
+    of later occurrences.
+    '''
+    _rename_table(conn, 'digests', 'digests_v4')
+    _create_digests_table(conn, dialect, without_rowid, table=DIGESTS_V5)
+    conn.execute(
+        'INSERT INTO digests '
+        '(digest, byte_size, codec, dictionary_id, refcount) '
+        'SELECT digest, byte_size, codec, dictionary_id, 1 + ('
+        'SELECT COUNT(*) FROM occurrences WHERE '
+        'occurrences.digest = digests_v4.digest) FROM digests_v4')
+    conn.execute(
+        'INSERT INTO occurrences (digest, category_label, timestamp) '
+        'SELECT digest, category_label, timestamp FROM digests_v4')
+    conn.execute('DROP TABLE digests_v4')
+    _recreate_indexes(conn, dialect, OCCURRENCES_V5)
+
+
+def _migrate_v6(conn: sqlite3.Connection,
+                dialect: Dialect,
+                without_rowid: bool) -> None:
+    '''
+    Add the retention policy columns to the categories table.
+    '''
+    columns = set(
+        row[1] for row in conn.execute('PRAGMA table_info(categories)'))
+    for column in CATEGORY_RETENTION_V6:
+        if column.name not in columns:
+            conn.execute('ALTER TABLE categories ADD COLUMN {}'.format(
+                CreateColumn(column).compile(dialect=dialect)))
+
+
+def _migrate_v7(conn: sqlite3.Connection,
+                dialect: Dialect,
+                without_rowid: bool) -> None:
+    '''
+    Recreate the timestamp indexes of the occurrences table with the
+    occurrence id as their last column. An item can occur more than once
+    with the same timestamp so the id is needed to order occurrences
+    completely, and queries ordered by (timestamp, digest, id) do not need
+    a sort.
+    '''
+    _recreate_indexes(conn, dialect, OCCURRENCES_V7)
+
+
+# Each migration upgrades the schema from the previous version to the
+# version it is listed with.
+MIGRATIONS = [
+    (1, _migrate_v1),
+    (2, _migrate_v2),
+    (3, _migrate_v3),
+    (4, _migrate_v4),
+    (5, _migrate_v5),
+    (6, _migrate_v6),
+    (7, _migrate_v7),
+]  # type: List[Tuple[int, Callable[[sqlite3.Connection, Dialect, bool], None]]]
+
+
+def stored_schema_version(engine: Engine) -> Optional[int]:
+    '''
+    Return the schema version of the database an engine connects to without
+    changing it.
+
+    :return: the schema version, or None if the schema has not been created.
+    '''
+    raw = engine.raw_connection()
+    try:
+        conn = raw.driver_connection  # type: sqlite3.Connection
+        if not _has_table(conn, Digest.__tablename__):
+            return None
+        return schema_version(conn)
+    finally:
+        raw.close()
+
+
+def migrate(engine: Engine, without_rowid: bool = False) -> Optional[int]:
+    '''
+    Create the database schema, or upgrade an existing database to the
+    current schema version.
+
+    Each migration is applied in its own transaction so a failure leaves
+    the database at the last version that was applied successfully.
+
+    :param engine: the engine for the database.
+
+    :param without_rowid: create the digests table as a WITHOUT ROWID table.
+      This only takes effect when the digests table is created, either in a
+      new database or when a migration rebuilds it.
+
+    :return: the schema version the database was at before it was migrated,
+      or None if the database was created.
+
+    :raises: Exception if the database was created by a newer version.
+    '''
+    dialect = engine.dialect
+    raw = engine.raw_connection()
+    conn = raw.driver_connection  # type: sqlite3.Connection
+    # Transactions are managed explicitly so that DDL statements are part
+    # of them. The sqlite3 module would otherwise commit before each one.
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        if not _has_table(conn, Digest.__tablename__):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                _create_tables(conn, dialect)
+                _create_digests_table(conn, dialect, without_rowid)
+                _set_schema_version(conn, SCHEMA_VERSION)
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return None
+
+        version = schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise Exception(
+                'Database schema version {} is newer than the supported '
+                'version {}'.format(version, SCHEMA_VERSION))
+
+        for target, migration in MIGRATIONS:
+            if target <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                _create_tables(conn, dialect)
+                migration(conn, dialect, without_rowid)
+                _set_schema_version(conn, target)
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            logger.info('Migrated database schema to version %s', target)
+        return version
+    finally:
+        conn.isolation_level = isolation_level
+        raw.close()
@@ -8,13 +8,49 @@ from sqlalchemy import (
     LargeBinary,
     Column,
     DateTime,
+    Float,
+    Index,
     Integer,
     String,
-    ForeignKey)
+    ForeignKey,
+    TypeDecorator,
+    UniqueConstraint)
 
 
 logger = logging.getLogger(__name__)
 
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class EpochTimestamp(TypeDecorator):
+    '''
+    This column type stores a datetime as an integer number of microseconds
+    since the Unix epoch.
+
+    Integers are smaller than the text representation SQLite otherwise uses
+    for datetimes and compare faster, which keeps timestamp indexes compact.
+
+    Naive datetimes are stored as they are, without any timezone conversion,
+    so they are returned unchanged. Timezone aware datetimes are converted to
+    UTC and returned as naive UTC datetimes.
+    '''
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, int):
+            return value
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return (value - EPOCH) // MICROSECOND
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+        return EPOCH + value * MICROSECOND
+
 
 # _Base = declarative_base()
 
@@ -47,6 +83,11 @@ class Category(Base):
     - when storing web requests the catoegories might be route paths.
     - when storing web server resources the categories might represent
       images, css, javascript, etc.
+
+    A category can also hold a retention policy which limits how long, and
+    how much, data is kept in it. Each limit is optional. The oldest
+    occurrences in the category are deleted by the garbage collector (see
+    :mod:`digestdb.gc`) until the category is within all of its limits.
     '''
 
     __tablename__ = 'categories'
@@ -55,19 +96,117 @@ class Category(Base):
 
     description = Column(String)
 
+    # the maximum age, in seconds, of the occurrences kept
+    max_age = Column(Float)
+
+    # the maximum total size of the occurrences kept
+    max_bytes = Column(Integer)
+
+    # the maximum number of occurrences kept
+    max_count = Column(Integer)
+
+
+class Dictionary(Base):
+    '''
+    This table definition stores the compression dictionaries trained for
+    each category.
+
+    Data items within a category usually share a lot of structure so a
+    dictionary trained from a category's items compresses them much better
+    than compressing each item on its own. Dictionaries are versioned as a
+    category is retrained over time. Old versions are kept for as long as
+    data items compressed with them remain.
+    '''
+
+    __tablename__ = 'dictionaries'
+    __table_args__ = (UniqueConstraint('category_label', 'version'),)
+
+    id = Column(Integer, primary_key=True)
+
+    category_label = Column(
+        String, ForeignKey('categories.label'), nullable=False)
+
+    version = Column(Integer, nullable=False)
+
+    codec = Column(String, nullable=False)
+
+    data = Column(LargeBinary, nullable=False)
+
+    timestamp = Column(DateTime, default=datetime.datetime.now)
+
 
 class Digest(Base):
     '''
-    This table definition stores a timestamp, object identifier and the hash
-    for a binary blob.
+    This table definition stores the hash of each distinct binary blob held
+    in storage along with how it is stored.
+
+    Each time a blob is stored, under a category and at a timestamp, is an
+    occurrence (see :class:`Occurrence`). Identical content is only stored
+    once however many times it occurs. The ``refcount`` is the number of
+    occurrences of the blob and the blob is removed from storage when its
+    last occurrence is deleted.
     '''
 
     __tablename__ = 'digests'
 
     digest = Column(LargeBinary, primary_key=True)
 
+    byte_size = Column(Integer)
+
+    # The name of the compression codec used to store the blob, or None if
+    # the blob is stored uncompressed. The digest and byte_size always
+    # describe the uncompressed data.
+    codec = Column(String)
+
+    # The dictionary the blob was compressed with, if any.
+    dictionary_id = Column(Integer, ForeignKey('dictionaries.id'))
+
+    # The number of occurrences of the blob.
+    refcount = Column(Integer, nullable=False, default=1)
+
+
+class Occurrence(Base):
+    '''
+    This table definition records each time a data item was stored: the
+    category it was stored under and its timestamp. An item stored under
+    several categories, or stored again later, has several occurrences.
+    '''
+
+    __tablename__ = 'occurrences'
+    # Queries for a category's items over a time range, e.g. for replay, are
+    # index range scans. The digest and id are included so results ordered
+    # by (timestamp, digest, id), as used for pagination, do not need
+    # sorting.
+    __table_args__ = (
+        Index('ix_occurrences_category_timestamp',
+              'category_label', 'timestamp', 'digest', 'id'),
+        Index('ix_occurrences_timestamp', 'timestamp', 'digest', 'id'),
+        Index('ix_occurrences_digest', 'digest'))
+
+    id = Column(Integer, primary_key=True)
+
+    digest = Column(LargeBinary, ForeignKey('digests.digest'), nullable=False)
+
     category_label = Column(String, ForeignKey('categories.label'))
 
-    timestamp = Column(DateTime, default=datetime.datetime.now)
+    timestamp = Column(EpochTimestamp, default=datetime.datetime.now)
 
-    byte_size = Column(Integer)
+
+class Verification(Base):
+    '''
+    This table definition records when each data item was last verified by
+    the scrubber (see :mod:`scrub`) and the problem found, if any.
+
+    It is kept apart from the digests table so that scrubbing, which updates
+    a row for every item it checks, does not rewrite the digests table or
+    its indexes.
+    '''
+
+    __tablename__ = 'verifications'
+
+    digest = Column(LargeBinary, primary_key=True)
+
+    timestamp = Column(EpochTimestamp, nullable=False)
+
+    # None if the item was found to be intact.
+    problem = Column(String)
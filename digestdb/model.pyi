@@ -1,13 +1,35 @@
-from sqlalchemy import Column, DateTime, Integer, LargeBinary, String
+from sqlalchemy import (
+    Column, DateTime, Float, Integer, LargeBinary, String, TypeDecorator)
 from sqlalchemy.schema import MetaData
 class Base:
   metadata = None  # type: MetaData
   def __init__(self, *args, **kwargs) -> None: ...
+class EpochTimestamp(TypeDecorator): ...
 class Category(Base):
     label = Column(String, primary_key=True)
     description = Column(String)
-class Digest(Base):
-    digest = Column(LargeBinary, primary_key=True)
+    max_age = Column(Float)
+    max_bytes = Column(Integer)
+    max_count = Column(Integer)
+class Dictionary(Base):
+    id = Column(Integer, primary_key=True)
     category_label = Column(String)
+    version = Column(Integer)
+    codec = Column(String)
+    data = Column(LargeBinary)
     timestamp = Column(DateTime)
+class Digest(Base):
+    digest = Column(LargeBinary, primary_key=True)
     byte_size = Column(Integer)
+    codec = Column(String)
+    dictionary_id = Column(Integer)
+    refcount = Column(Integer)
+class Occurrence(Base):
+    id = Column(Integer, primary_key=True)
+    digest = Column(LargeBinary)
+    category_label = Column(String)
+    timestamp = Column(EpochTimestamp)
+class Verification(Base):
+    digest = Column(LargeBinary, primary_key=True)
+    timestamp = Column(EpochTimestamp)
+    problem = Column(String)
@@ -0,0 +1,474 @@
+''' This module implements pack file storage for small binary blobs '''
+
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import urllib.parse
+
+from concurrent.futures import Executor
+
+from .storage import (
+    DURABILITY_NONE, Storage, _not_found, check_durability, fsync_directory)
+
+# type annotations
+from typing import (
+    Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple)
+
+
+logger = logging.getLogger(__name__)
+
+
+PACK_FILE_FORMAT = '{:08d}.pack'
+PACK_FILE_REGEX = re.compile(r'^(\d{8})\.pack$')
+INDEX_FILENAME = 'index.db'
+
+# Keep 'IN' queries below SQLite's host parameter limit.
+MAX_SQL_VARIABLES = 900
+
+# Location of a blob within the pack files.
+PackLocation = NamedTuple('PackLocation', [
+    ('pack_id', int),
+    ('offset', int),
+    ('length', int)])
+
+PackStats = NamedTuple('PackStats', [
+    ('packs', int),
+    ('items', int),
+    ('total_bytes', int),
+    ('live_bytes', int)])
+
+
+class PackStore(Storage):
+    '''
+    This class stores lots of small binary blobs by appending them to a
+    small number of large pack files.
+
+    Storing each small blob in its own file costs an inode, a directory
+    entry and at least one file system block per blob. A pack store instead
+    appends blobs to the current pack file and records the location
+    (pack_id, offset, length) of each blob, keyed by its digest, in an index.
+    The index is a small SQLite database stored alongside the pack files.
+
+    Blobs are read through memory maps of the pack files so reading a blob
+    does not require a system call or a copy.
+
+    Deleting a blob only removes its index entry. The space it used is
+    reclaimed later by :meth:`compact` which copies the remaining blobs from
+    mostly empty pack files into the current pack file and then removes the
+    old pack files.
+    '''
+
+    def __init__(self,
+                 pack_dir: str,
+                 max_pack_size: int = 256 * 2**20,
+                 durability: str = DURABILITY_NONE,
+                 read_only: bool = False) -> None:
+        '''
+
+        :param pack_dir: the directory in which pack files and the index are
+          stored. It is created when the store is opened if necessary.
+
+        :param max_pack_size: the size at which a new pack file is started.
+
+        :param durability: one of the storage DURABILITY modes. Unless it is
+          DURABILITY_NONE the pack file is flushed to disk after each write,
+          and before the index refers to the new data. Bulk writes are
+          already flushed together so DURABILITY_FSYNC and DURABILITY_BATCH
+          behave the same.
+
+        :param read_only: open the store without creating or changing
+          anything, so that it can be read while another process writes to
+          it. Blobs written by the other process are found through the
+          shared index. Writes to a read only store fail.
+        '''
+        check_durability(durability)
+        self.pack_dir = pack_dir
+        self.max_pack_size = max_pack_size
+        self.durability = durability
+        self.read_only = read_only
+        self.index_file = os.path.join(pack_dir, INDEX_FILENAME)
+        self.active_pack_id = None  # type: int
+        self._active_fd = None
+        self._maps = {}  # type: Dict[int, mmap.mmap]
+        self._conn = None  # type: sqlite3.Connection
+        self._lock = threading.RLock()
+
+    def __repr__(self) -> str:
+        return "<PackStore '{}'>".format(self.pack_dir)
+
+    def _pack_path(self, pack_id: int) -> str:
+        return os.path.join(self.pack_dir, PACK_FILE_FORMAT.format(pack_id))
+
+    def pack_ids(self) -> List[int]:
+        ''' Return the identifiers of the pack files on disk, in order '''
+        ids = []
+        for filename in os.listdir(self.pack_dir):
+            match = PACK_FILE_REGEX.match(filename)
+            if match:
+                ids.append(int(match.group(1)))
+        return sorted(ids)
+
+    def open(self) -> None:
+        ''' Open the pack store, creating it if necessary '''
+        # The store may be used by several threads, access is serialised
+        # using the store's lock.
+        if self.read_only:
+            if os.path.exists(self.index_file):
+                self._conn = sqlite3.connect(
+                    'file:{}?mode=ro'.format(
+                        urllib.parse.quote(self.index_file)),
+                    uri=True, check_same_thread=False)
+            else:
+                # Nothing has been packed yet. Blobs packed after the store
+                # is opened are only found once it is opened again.
+                self._conn = sqlite3.connect(
+                    ':memory:', check_same_thread=False)
+                self._create_index()
+            return
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self._conn = sqlite3.connect(
+            self.index_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._create_index()
+        ids = self.pack_ids()
+        self._open_active(ids[-1] if ids else 1)
+
+    def _create_index(self) -> None:
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'digest BLOB PRIMARY KEY, '
+            'pack_id INTEGER NOT NULL, '
+            'offset INTEGER NOT NULL, '
+            'length INTEGER NOT NULL) WITHOUT ROWID')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS entries_pack_id '
+            'ON entries (pack_id, offset)')
+        self._conn.commit()
+
+    def close(self) -> None:
+        ''' Close the pack store '''
+        with self._lock:
+            if self._active_fd:
+                self._active_fd.close()
+                self._active_fd = None
+            for mm in self._maps.values():
+                try:
+                    mm.close()
+                except BufferError:
+                    # views of the map are still in use, the map is
+                    # released when they are.
+                    pass
+            self._maps = {}
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def _open_active(self, pack_id: int) -> None:
+        if self._active_fd:
+            self._sync()
+            self._active_fd.close()
+        self.active_pack_id = pack_id
+        path = self._pack_path(pack_id)
+        created = not os.path.exists(path)
+        self._active_fd = open(path, 'ab')
+        if created and self.durability != DURABILITY_NONE:
+            fsync_directory(self.pack_dir)
+
+    def _sync(self) -> None:
+        ''' Flush the active pack file, to disk if durability requires it '''
+        self._active_fd.flush()
+        if self.durability != DURABILITY_NONE:
+            os.fsync(self._active_fd.fileno())
+
+    def _append(self, data: bytes) -> Tuple[int, int]:
+        '''
+        Append data to the active pack file, starting a new pack file if the
+        active pack file is full.
+
+        :return: a 2-tuple of the (pack_id, offset) the data was written at.
+        '''
+        offset = self._active_fd.tell()
+        if offset and offset + len(data) > self.max_pack_size:
+            self._open_active(self.active_pack_id + 1)
+            offset = 0
+        self._active_fd.write(data)
+        return self.active_pack_id, offset
+
+    def put(self, digest: bytes, data: bytes) -> None:
+        '''
+        Add a blob to the store.
+
+        :param digest: a bytes object representing a hash of the data.
+
+        :param data: a bytes object containing the blob.
+
+        :raises: Exception if the digest is already stored.
+        '''
+        error = self.put_many([(digest, data)])[0]
+        if error:
+            raise error
+
+    def put_many(self,
+                 items: Iterable[Tuple[bytes, bytes]],
+                 executor: Executor = None) -> List[Optional[Exception]]:
+        '''
+        Add many blobs to the store using a single index transaction.
+
+        :param items: an iterable of 2-tuples of (digest, data).
+
+        :param executor: unused. Appends are always performed serially.
+
+        :return: a list containing, for each item, None if the item was
+          stored otherwise the error that prevented it being stored.
+        '''
+        results = []  # type: List[Optional[Exception]]
+        rows = []
+        added = set()
+        with self._lock:
+            for digest, data in items:
+                if digest in added or self._locate(digest):
+                    results.append(Exception(
+                        'Duplicate pack entry detected: {}'.format(
+                            digest.hex())))
+                    continue
+                pack_id, offset = self._append(data)
+                rows.append((digest, pack_id, offset, len(data)))
+                added.add(digest)
+                results.append(None)
+            # Data must reach the pack file before the index refers to it. A
+            # crash in between leaves unreferenced bytes that are reclaimed
+            # by compaction.
+            self._sync()
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT INTO entries VALUES (?, ?, ?, ?)', rows)
+        return results
+
+    def replace(self, digest: bytes, data: bytes) -> None:
+        '''
+        Replace the stored form of a blob.
+
+        The new data is appended and the index entry updated to refer to it.
+        The space used by the old data is reclaimed by :meth:`compact`.
+
+        :param digest: a bytes object representing a hash of the data.
+
+        :param data: a bytes object containing the blob.
+
+        :raises: FileNotFoundError if the digest is not stored.
+        '''
+        with self._lock:
+            if self._locate(digest) is None:
+                raise _not_found(digest)
+            pack_id, offset = self._append(data)
+            self._sync()
+            with self._conn:
+                self._conn.execute(
+                    'UPDATE entries SET pack_id = ?, offset = ?, length = ? '
+                    'WHERE digest = ?', (pack_id, offset, len(data), digest))
+
+    def _locate(self, digest: bytes) -> Optional[PackLocation]:
+        row = self._conn.execute(
+            'SELECT pack_id, offset, length FROM entries WHERE digest = ?',
+            (digest,)).fetchone()
+        return PackLocation(*row) if row else None
+
+    def locate(self, digest: bytes) -> Optional[PackLocation]:
+        '''
+        Return the location of a blob.
+
+        :param digest: a bytes object representing a hash of the data.
+
+        :return: a PackLocation or None if the digest is not stored.
+        '''
+        with self._lock:
+            return self._locate(digest)
+
+    def read_order(self, digests: Iterable[bytes]) -> List[bytes]:
+        '''
+        Return digests sorted by their position in the pack files so that
+        reads move forward through each pack file. Digests that are not
+        stored are placed last.
+        '''
+        digests = set(digests)
+        located = []  # type: List[Tuple[int, int, bytes]]
+        with self._lock:
+            items = list(digests)
+            for i in range(0, len(items), MAX_SQL_VARIABLES):
+                chunk = items[i:i + MAX_SQL_VARIABLES]
+                located.extend(
+                    (pack_id, offset, digest)
+                    for digest, pack_id, offset in self._conn.execute(
+                        'SELECT digest, pack_id, offset FROM entries '
+                        'WHERE digest IN ({})'.format(
+                            ', '.join('?' * len(chunk))), chunk))
+        located.sort()
+        ordered = [digest for _, _, digest in located]
+        return ordered + sorted(digests.difference(ordered))
+
+    def exists(self, digest: bytes) -> bool:
+        ''' Return True if the digest is stored in the pack store '''
+        return self.locate(digest) is not None
+
+    def _map(self, pack_id: int, end: int) -> mmap.mmap:
+        '''
+        Return a read-only memory map of a pack file covering at least the
+        first ``end`` bytes.
+
+        The active pack file grows as blobs are appended so its map is
+        recreated when a blob beyond the end of the current map is read.
+        Maps that are replaced are not closed explicitly because views of
+        them may still be in use.
+        '''
+        mm = self._maps.get(pack_id)
+        if mm is None or len(mm) < end:
+            with open(self._pack_path(pack_id), 'rb') as fd:
+                mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack_id] = mm
+        return mm
+
+    def view(self, digest: bytes) -> memoryview:
+        '''
+        Return a read-only view of a blob.
+
+        The view references a memory map of the pack file so no data is
+        copied.
+
+        :param digest: a bytes object representing a hash of the data.
+
+        :raises: FileNotFoundError if the digest is not stored.
+        '''
+        with self._lock:
+            location = self._locate(digest)
+            if location is None:
+                raise _not_found(digest)
+            pack_id, offset, length = location
+            if not length:
+                return memoryview(b'')
+            mm = self._map(pack_id, offset + length)
+            return memoryview(mm)[offset:offset + length]
+
+    def stat(self, digest: bytes) -> int:
+        ''' Return the size of a blob '''
+        location = self.locate(digest)
+        if location is None:
+            raise _not_found(digest)
+        return location.length
+
+    def delete(self, digest: bytes) -> bool:
+        '''
+        Remove a blob from the store.
+
+        The space used by the blob is reclaimed by :meth:`compact`.
+
+        :param digest: a bytes object representing a hash of the data.
+
+        :return: True if the digest was stored.
+        '''
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'DELETE FROM entries WHERE digest = ?', (digest,))
+            return cursor.rowcount > 0
+
+    def digests(self) -> Iterator[bytes]:
+        ''' Return an iterator over the digests in the store, in order '''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT digest FROM entries ORDER BY digest').fetchall()
+        return (row[0] for row in rows)
+
+    def _shard_range(self, shard: str) -> Tuple[str, Tuple]:
+        ''' Return the SQL condition selecting a shard's entries '''
+        low = bytes.fromhex(shard)
+        if shard == 'ff':
+            return 'digest >= ?', (low,)
+        high = bytes([low[0] + 1])
+        return 'digest >= ? AND digest < ?', (low, high)
+
+    def shard_digests(self, shard: str) -> List[bytes]:
+        condition, args = self._shard_range(shard)
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT digest FROM entries WHERE {} ORDER BY digest'.format(
+                    condition), args)]
+
+    def shard_signature(self, shard: str) -> Optional[str]:
+        '''
+        Return a summary of a shard's index entries. Appending a blob always
+        moves the position of the newest entry so any change is detected.
+        '''
+        condition, args = self._shard_range(shard)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(length), 0), '
+                'COALESCE(MAX(pack_id * 4294967296 + offset), 0) '
+                'FROM entries WHERE {}'.format(condition), args).fetchone()
+        return '{}:{}:{}'.format(*row)
+
+    def stats(self) -> PackStats:
+        ''' Return the number of pack files, items and bytes used '''
+        with self._lock:
+            items, live_bytes = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(length), 0) '
+                'FROM entries').fetchone()
+            ids = self.pack_ids()
+            total_bytes = sum(
+                os.path.getsize(self._pack_path(i)) for i in ids)
+        return PackStats(len(ids), items, total_bytes, live_bytes)
+
+    def compact(self, min_dead_ratio: float = 0.5) -> int:
+        '''
+        Reclaim the space used by deleted blobs.
+
+        Each pack file, other than the active one, where at least
+        ``min_dead_ratio`` of its bytes are no longer referenced has its
+        remaining blobs copied into the active pack file. The old pack file
+        is then removed.
+
+        :param min_dead_ratio: the proportion of a pack file that must be
+          unused before it is compacted.
+
+        :return: the number of bytes reclaimed.
+        '''
+        reclaimed = 0
+        with self._lock:
+            live = dict(
+                (row[0], row[1]) for row in self._conn.execute(
+                    'SELECT pack_id, SUM(length) FROM entries '
+                    'GROUP BY pack_id'))
+            for pack_id in self.pack_ids():
+                if pack_id == self.active_pack_id:
+                    continue
+                size = os.path.getsize(self._pack_path(pack_id))
+                live_bytes = live.get(pack_id, 0)
+                if size and (size - live_bytes) / size < min_dead_ratio:
+                    continue
+                self._compact_pack(pack_id)
+                reclaimed += size - live_bytes
+        if reclaimed:
+            logger.debug('Compaction reclaimed %s bytes', reclaimed)
+        return reclaimed
+
+    def _compact_pack(self, pack_id: int) -> None:
+        ''' Move the live blobs out of a pack file and remove it '''
+        entries = self._conn.execute(
+            'SELECT digest, offset, length FROM entries WHERE pack_id = ? '
+            'ORDER BY offset', (pack_id,)).fetchall()
+        if entries:
+            end = max(offset + length for _, offset, length in entries)
+            mm = self._map(pack_id, end)
+            rows = []
+            for digest, offset, length in entries:
+                new_pack_id, new_offset = self._append(
+                    mm[offset:offset + length])
+                rows.append((new_pack_id, new_offset, digest))
+            self._sync()
+            with self._conn:
+                self._conn.executemany(
+                    'UPDATE entries SET pack_id = ?, offset = ? '
+                    'WHERE digest = ?', rows)
+        self._maps.pop(pack_id, None)
+        os.remove(self._pack_path(pack_id))
@@ -0,0 +1,381 @@
+''' This module verifies the integrity of the data items held in storage '''
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import Executor
+from sqlalchemy import or_
+
+from .compression import iter_decode
+from .hashify import chunks_digest
+from .model import Digest, Verification
+from .storage import Storage
+
+# type annotations
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+# The problems a scrub can find with a data item
+SCRUB_MISSING = 'missing'
+SCRUB_UNREADABLE = 'unreadable'
+SCRUB_DIGEST_MISMATCH = 'digest_mismatch'
+SCRUB_SIZE_MISMATCH = 'size_mismatch'
+
+# Problems that mean the stored blob itself is damaged. Blobs with these
+# problems are moved to the quarantine directory when quarantining.
+DAMAGED = (SCRUB_UNREADABLE, SCRUB_DIGEST_MISMATCH)
+
+ScrubIssue = NamedTuple('ScrubIssue', [
+    ('digest', bytes),
+    ('problem', str),
+    ('detail', str)])
+
+ScrubReport = NamedTuple('ScrubReport', [
+    # the number of data items that were checked
+    ('checked', int),
+    # the number of stored bytes that were read
+    ('bytes_read', int),
+    # the problems found
+    ('issues', List[ScrubIssue]),
+    # the digests of the items moved to the quarantine directory
+    ('quarantined', List[bytes])])
+
+# digest, byte_size, codec, dictionary
+ScrubRow = Tuple[bytes, int, Optional[str], Optional[bytes]]
+# digest, bytes_read, issue, quarantined
+ScrubResult = Tuple[bytes, int, Optional[ScrubIssue], bool]
+
+
+class RateLimiter(object):
+    '''
+    A thread safe limit on the rate at which bytes are consumed.
+
+    Callers report the number of bytes they have consumed and are made to
+    sleep for long enough to keep the average rate at or below ``rate``.
+    Up to ``burst`` bytes can be consumed without delay after a quiet period.
+    '''
+
+    def __init__(self,
+                 rate: float,
+                 burst: float = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        '''
+
+        :param rate: the maximum average number of bytes per second.
+
+        :param burst: the number of bytes that can be consumed at once.
+          Defaults to one second's worth.
+
+        :param clock: a function returning the current time in seconds.
+
+        :param sleep: a function that sleeps for a number of seconds.
+        '''
+        if rate <= 0:
+            raise Exception(
+                'Invalid rate. Expected a positive number but got {}'.format(
+                    rate))
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.clock = clock
+        self.sleep = sleep
+        # the time at which all the bytes consumed so far are paid for
+        self._paid = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, count: int) -> None:
+        ''' Record that count bytes were consumed, sleeping if necessary '''
+        with self._lock:
+            now = self.clock()
+            self._paid = max(self._paid, now) + count / self.rate
+            delay = self._paid - self.burst / self.rate - now
+        if delay > 0:
+            self.sleep(delay)
+
+
+class _Meter(object):
+    '''
+    An iterator of chunks that counts, and optionally rate limits, the bytes
+    passing through it.
+    '''
+
+    def __init__(self,
+                 chunks: Iterable[bytes],
+                 limiter: RateLimiter = None) -> None:
+        self.chunks = iter(chunks)
+        self.limiter = limiter
+        self.count = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        chunk = next(self.chunks)
+        self.count += len(chunk)
+        if self.limiter is not None:
+            self.limiter.consume(len(chunk))
+        return chunk
+
+
+def check_item(storage: Storage,
+               digest: bytes,
+               byte_size: int,
+               codec: Optional[str] = None,
+               dictionary: bytes = None,
+               hash_name: str = 'sha256',
+               limiter: RateLimiter = None,
+               chunk_size: int = 2**20,
+               dictionaries: Callable[[int], bytes] = None) -> Tuple[
+                   int, Optional[ScrubIssue]]:
+    '''
+    Check that a stored data item still hashes to its digest and has the
+    size recorded for it.
+
+    The item is streamed from storage, and decompressed if necessary, so
+    large items are not held in memory.
+
+    :param dictionaries: a function that returns a compression dictionary
+      given its identifier, used for framed items (see
+      :func:`compression.decode`).
+
+    :return: a 2-tuple of the number of stored bytes read and the problem
+      found, or None if the item is intact.
+    '''
+    stored = _Meter((), limiter)
+    try:
+        stored = _Meter(
+            storage.iter_chunks(digest, chunk_size=chunk_size), limiter)
+        data = _Meter(iter_decode(
+            stored, codec, dictionary=dictionary, dictionaries=dictionaries))
+        actual = chunks_digest(data, hash_name=hash_name)
+    except FileNotFoundError as exc:
+        return stored.count, ScrubIssue(digest, SCRUB_MISSING, str(exc))
+    except Exception as exc:
+        return stored.count, ScrubIssue(
+            digest, SCRUB_UNREADABLE, '{}: {}'.format(
+                exc.__class__.__name__, exc))
+    if actual != digest:
+        return stored.count, ScrubIssue(
+            digest, SCRUB_DIGEST_MISMATCH,
+            'Data hashes to {}'.format(actual.hex()))
+    if data.count != byte_size:
+        return stored.count, ScrubIssue(
+            digest, SCRUB_SIZE_MISMATCH,
+            'Expected {} bytes but got {}'.format(byte_size, data.count))
+    return stored.count, None
+
+
+def quarantine_item(storage: Storage,
+                    digest: bytes,
+                    quarantine_dir: str) -> str:
+    '''
+    Move a stored blob, exactly as it is stored, out of storage and into a
+    quarantine directory where it can be inspected.
+
+    :return: the path of the quarantined file.
+    '''
+    os.makedirs(quarantine_dir, exist_ok=True)
+    path = os.path.join(quarantine_dir, digest.hex())
+    with open(path, 'wb') as fd:
+        for chunk in storage.iter_chunks(digest):
+            fd.write(chunk)
+    storage.delete(digest)
+    return path
+
+
+class Scrubber(object):
+    '''
+    This class re-reads the data items in storage and checks that each one
+    still hashes to its digest and has the size recorded in the digests
+    table. This finds items damaged by bit rot or by partial writes, which
+    are otherwise only noticed when an item is next read.
+
+    Items are checked in batches, in digest order. Each batch is read by a
+    pool of threads, in the order that suits the storage, while the
+    database is only used by the calling thread. The rate at which bytes
+    are read can be limited so a scrub can run alongside other work.
+
+    The time each item is checked is recorded in the verifications table.
+    Items verified more recently than ``max_age`` seconds ago are skipped,
+    so running a scrub periodically with a ``max_age`` and a ``limit``
+    spreads the work over many runs and an interrupted run resumes where it
+    stopped.
+
+    Damaged items are reported. If ``quarantine`` is set they are also
+    moved out of storage into the database's quarantine directory. Their
+    metadata is kept so they are reported as missing by
+    :meth:`DigestDB.reconcile` until they are replaced or deleted.
+    '''
+
+    def __init__(self,
+                 db: 'DigestDB',
+                 rate: float = None,
+                 max_age: float = None,
+                 limit: int = None,
+                 quarantine: bool = False,
+                 batch_size: int = 256,
+                 chunk_size: int = 2**20) -> None:
+        '''
+
+        :param db: an open database.
+
+        :param rate: the maximum number of bytes per second to read from
+          storage. If None then reads are not limited.
+
+        :param max_age: skip items verified within this many seconds. If
+          None then every item is checked.
+
+        :param limit: the maximum number of items to check.
+
+        :param quarantine: move damaged items to the quarantine directory.
+
+        :param batch_size: the number of items checked per batch.
+
+        :param chunk_size: the number of bytes read from storage at a time.
+        '''
+        if limit is not None and limit < 0:
+            raise Exception(
+                'Invalid limit. Expected at least 0 but got {}'.format(limit))
+        self.db = db
+        self.limiter = RateLimiter(rate) if rate is not None else None
+        self.quarantine = quarantine
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        # Items verified before the cutoff are checked. Items checked by
+        # this scrub are verified after it, so they are never checked twice.
+        self.cutoff = datetime.datetime.now()
+        if max_age is not None:
+            self.cutoff -= datetime.timedelta(seconds=max_age)
+        self.remaining = limit
+        self.after = b''
+        self.checked = 0
+        self.bytes_read = 0
+        self.issues = []  # type: List[ScrubIssue]
+        self.quarantined = []  # type: List[bytes]
+
+    def next_batch(self) -> List[ScrubRow]:
+        '''
+        Return the next batch of items to check, or an empty list when the
+        scrub is complete. This method uses the session.
+        '''
+        size = self.batch_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if not size:
+                return []
+        db = self.db
+        query = db.session.query(
+            Digest.digest, Digest.byte_size, Digest.codec,
+            Digest.dictionary_id).outerjoin(
+                Verification, Verification.digest == Digest.digest).filter(
+                    Digest.digest > self.after,
+                    or_(Verification.timestamp.is_(None),
+                        Verification.timestamp < self.cutoff)).order_by(
+                            Digest.digest).limit(size)
+        rows = [
+            (digest, byte_size, codec, db._dictionary(dictionary_id))
+            for digest, byte_size, codec, dictionary_id in query]
+        if rows:
+            self.after = rows[-1][0]
+        return rows
+
+    def check_row(self, row: ScrubRow) -> ScrubResult:
+        '''
+        Check an item and quarantine it if it is damaged and quarantining
+        is enabled. This method does not use the session.
+        '''
+        digest, byte_size, codec, dictionary = row
+        db = self.db
+        bytes_read, issue = check_item(
+            db.storage, digest, byte_size, codec, dictionary,
+            hash_name=db.hash_name, limiter=self.limiter,
+            chunk_size=self.chunk_size, dictionaries=db._dictionary)
+        quarantined = False
+        if issue is not None and self.quarantine and issue.problem in DAMAGED:
+            try:
+                path = quarantine_item(db.storage, digest, db.quarantine_dir)
+                logger.warning('Quarantined %s to %s', digest.hex(), path)
+                quarantined = True
+            except OSError:
+                logger.exception('Could not quarantine %s', digest.hex())
+        return digest, bytes_read, issue, quarantined
+
+    def check(self,
+              rows: List[ScrubRow],
+              executor: Executor = None) -> List[ScrubResult]:
+        '''
+        Check a batch of items. This method does not use the session so it
+        can be run by a thread other than the one that owns the session.
+
+        :param executor: an optional thread pool used to check the items
+          concurrently.
+        '''
+        by_digest = {row[0]: row for row in rows}
+        ordered = [
+            by_digest[digest]
+            for digest in self.db.storage.read_order(list(by_digest))]
+        if executor is None:
+            return [self.check_row(row) for row in ordered]
+        return list(executor.map(self.check_row, ordered))
+
+    def record(self, results: List[ScrubResult]) -> None:
+        '''
+        Record the outcome of checking a batch of items. This method uses
+        the session.
+        '''
+        db = self.db
+        timestamp = datetime.datetime.now()
+        if results:
+            db.session.execute(
+                Verification.__table__.insert().prefix_with('OR REPLACE'),
+                [{'digest': digest, 'timestamp': timestamp,
+                  'problem': issue.problem if issue else None}
+                 for digest, _, issue, _ in results])
+            db.session.commit()
+        for digest, bytes_read, issue, quarantined in results:
+            self.checked += 1
+            self.bytes_read += bytes_read
+            if issue is not None:
+                logger.warning(
+                    'Scrub found %s %s: %s', issue.problem, digest.hex(),
+                    issue.detail)
+                self.issues.append(issue)
+            if quarantined:
+                self.quarantined.append(digest)
+                if db.cache is not None:
+                    db.cache.put(digest, False)
+        if self.remaining is not None:
+            self.remaining -= len(results)
+
+    def report(self) -> ScrubReport:
+        ''' Return a report of the items checked so far '''
+        return ScrubReport(
+            self.checked, self.bytes_read, list(self.issues),
+            list(self.quarantined))
+
+    def run(self, executor: Executor = None) -> ScrubReport:
+        '''
+        Check the items in the database.
+
+        :param executor: an optional thread pool used to check the items in
+          each batch concurrently.
+
+        :return: a :class:`ScrubReport`.
+        '''
+        while True:
+            rows = self.next_batch()
+            if not rows:
+                break
+            self.record(self.check(rows, executor))
+        report = self.report()
+        logger.debug(
+            'Scrubbed %s items (%s bytes): %s issues, %s quarantined',
+            report.checked, report.bytes_read, len(report.issues),
+            len(report.quarantined))
+        return report
@@ -0,0 +1,1422 @@
+''' This module defines the blob storage backends used by the DigestDB '''
+
+import hashlib
+import io
+import itertools
+import logging
+import mmap
+import os
+import sys
+import tempfile
+import time
+
+from concurrent.futures import Executor
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+from .compression import iter_decode
+from .hashify import data_digest, digest_filepath
+
+# type annotations
+from typing import (
+    Any, BinaryIO, Callable, Dict, Generator, Iterable, Iterator, List,
+    Optional, Set, Tuple)
+
+
+logger = logging.getLogger(__name__)
+
+# Temporary files are created in the data directory, so that they can be
+# atomically renamed into place, using this filename prefix. The prefix can
+# not be mistaken for the hex digest filename of a stored item.
+TEMP_FILE_PREFIX = '.tmp-'
+
+# Items are divided into 256 shards by the first byte of their digest. For
+# the file storage a shard is one of the top level directories.
+SHARDS = ['{:02x}'.format(i) for i in range(256)]
+
+# A shard's signature is not reported while its directories have been
+# modified this recently, in seconds. File system timestamps are coarse so a
+# change made just after a signature is taken could otherwise go unnoticed.
+SIGNATURE_SETTLE_TIME = 2.0
+
+# Linux ioctl request used to clone (reflink) a file on copy-on-write file
+# systems such as btrfs and XFS.
+FICLONE = 0x40049409 if sys.platform.startswith('linux') else None
+
+# Durability modes. Blobs are always written to a temporary file that is
+# renamed into place, so a crash never leaves a partially written blob at
+# a digest path. The modes control whether the data is flushed to disk:
+#
+# - DURABILITY_NONE leaves flushing to the operating system. A blob that
+#   was written shortly before a power failure may be lost.
+# - DURABILITY_FSYNC flushes each blob and its directory before the write
+#   returns.
+# - DURABILITY_BATCH flushes all the blobs written by a bulk write, and then
+#   each of their directories once, before the bulk write returns. This
+#   costs far fewer flushes than DURABILITY_FSYNC for large batches.
+DURABILITY_NONE = 'none'
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_BATCH = 'batch'
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_FSYNC, DURABILITY_BATCH)
+
+
+def check_durability(durability: str) -> None:
+    ''' Raise an exception if durability is not a known mode '''
+    if durability not in DURABILITY_MODES:
+        raise Exception(
+            'Invalid durability. Expected one of {} but got {}'.format(
+                ', '.join(DURABILITY_MODES), durability))
+
+
+def fsync_directory(path: str) -> None:
+    '''
+    Flush a directory so that the files created in, or renamed into, it
+    persist after a crash.
+
+    Platforms that can not open directories (e.g. Windows) are ignored.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_temp_file(dirname: str, data: bytes, sync: bool) -> str:
+    '''
+    Write data to a new temporary file in a directory, optionally flushing
+    it to disk, and return its path.
+    '''
+    fd, temp_path = tempfile.mkstemp(dir=dirname, prefix=TEMP_FILE_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception:
+        _remove_temp_file(temp_path)
+        raise
+    return temp_path
+
+
+def _remove_temp_file(temp_path: str) -> None:
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+
+def write_database_file(digest: bytes,
+                        data: bytes,
+                        data_dir: str,
+                        dir_depth: int,
+                        durability: str = DURABILITY_NONE) -> None:
+    '''
+    Writes a binary database item to the file system.
+
+    This function first creates the filename and file path from the digest
+    information. It creates the directory tree is necessary and then writes
+    the data into a temporary file which is renamed into place, so the item
+    only becomes visible once its contents are complete.
+
+    :param digest: a bytes object representing a hash of some data.
+
+    :param data: a bytes object containing the binary data to be stored by the
+      database.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :param durability: one of the DURABILITY modes. DURABILITY_BATCH
+      flushes the file but leaves flushing its directory to the caller, so
+      a caller writing many files can flush each directory once.
+
+    :raises: Exception if a duplicate filename is detected.
+    '''
+    fpath = os.path.join(
+        data_dir, digest_filepath(digest, dir_depth=dir_depth))
+    dirname = os.path.dirname(fpath)
+
+    # Create directories as required
+    os.makedirs(dirname, exist_ok=True)
+
+    if os.path.exists(fpath):
+        raise Exception(
+            'Duplicate file detected: {}'.format(fpath))
+
+    temp_path = _write_temp_file(
+        dirname, data, durability != DURABILITY_NONE)
+    try:
+        os.replace(temp_path, fpath)
+    except Exception:
+        _remove_temp_file(temp_path)
+        raise
+    if durability == DURABILITY_FSYNC:
+        fsync_directory(dirname)
+
+
+def commit_database_file(temp_path: str,
+                         digest: bytes,
+                         data_dir: str,
+                         dir_depth: int,
+                         durability: str = DURABILITY_NONE) -> None:
+    '''
+    Move a fully written temporary file to its database file path.
+
+    The file is renamed into place so the item only becomes visible once
+    its contents are complete.
+
+    :param temp_path: the path to a temporary file in the ``data_dir``.
+
+    :param digest: a bytes object representing a hash of the file's data.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :param durability: one of the DURABILITY modes. Unless it is
+      DURABILITY_NONE the directory is flushed once the file is renamed.
+      The caller is responsible for flushing the file itself.
+
+    :raises: Exception if a duplicate filename is detected.
+    '''
+    fpath = os.path.join(
+        data_dir, digest_filepath(digest, dir_depth=dir_depth))
+
+    # Create directories as required
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+
+    if os.path.exists(fpath):
+        raise Exception(
+            'Duplicate file detected: {}'.format(fpath))
+
+    os.replace(temp_path, fpath)
+    if durability != DURABILITY_NONE:
+        fsync_directory(os.path.dirname(fpath))
+
+
+def write_database_stream(chunks: Iterable[bytes],
+                          data_dir: str,
+                          dir_depth: int,
+                          hash_name: str = 'sha256',
+                          durability: str = DURABILITY_NONE) -> Tuple[bytes, int]:
+    '''
+    Writes a stream of binary data to the file system.
+
+    The digest of the data is not known until all of the data has been
+    consumed so the data is hashed as it is copied into a temporary file in
+    the ``data_dir``. The temporary file is then renamed to the database file
+    path for the digest. This means the source is only read once and memory
+    use is constant regardless of the size of the data.
+
+    :param chunks: an iterable of bytes objects.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :param hash_name: the name of a hash calculator. Defaults to sha256.
+
+    :param durability: one of the DURABILITY modes.
+
+    :return: a 2-tuple of (digest, size) for the data written.
+
+    :raises: Exception if a duplicate filename is detected.
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    h = hashlib.new(hash_name)
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=data_dir, prefix=TEMP_FILE_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                if not isinstance(chunk, bytes):
+                    raise Exception(
+                        'Invalid data type. Expected bytes but got {}'.format(
+                            type(chunk)))
+                h.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            if durability != DURABILITY_NONE:
+                f.flush()
+                os.fsync(f.fileno())
+        digest = h.digest()
+        commit_database_file(
+            temp_path, digest, data_dir, dir_depth, durability=durability)
+    except Exception:
+        _remove_temp_file(temp_path)
+        raise
+    return digest, size
+
+
+def copy_database_file(filepath: str,
+                       digest: bytes,
+                       data_dir: str,
+                       dir_depth: int,
+                       link: bool = False,
+                       durability: str = DURABILITY_NONE) -> int:
+    '''
+    Copy an existing file into the database file system.
+
+    The file contents are copied by the kernel rather than through user
+    space where possible. A copy-on-write clone (reflink) is attempted first,
+    followed by ``copy_file_range``, then ``sendfile`` and finally a plain
+    read and write loop.
+
+    :param filepath: the path of the file to copy.
+
+    :param digest: a bytes object representing a hash of the file's data.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :param link: when True, and the source file is on the same file system
+      as the database, the source is hard linked into the database instead
+      of being copied. The source must then never be modified in place.
+
+    :param durability: one of the DURABILITY modes.
+
+    :return: the size of the file.
+
+    :raises: Exception if a duplicate filename is detected.
+    '''
+    fpath = os.path.join(
+        data_dir, digest_filepath(digest, dir_depth=dir_depth))
+
+    # Create directories as required
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+
+    if os.path.exists(fpath):
+        raise Exception(
+            'Duplicate file detected: {}'.format(fpath))
+
+    if link:
+        try:
+            os.link(filepath, fpath)
+            if durability != DURABILITY_NONE:
+                fsync_directory(os.path.dirname(fpath))
+            return os.stat(fpath).st_size
+        except OSError:
+            logger.debug(
+                'Could not link %s, falling back to a copy', filepath)
+
+    fd, temp_path = tempfile.mkstemp(dir=data_dir, prefix=TEMP_FILE_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(filepath, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            _copy_file_contents(src.fileno(), dst.fileno(), size)
+            if durability != DURABILITY_NONE:
+                os.fsync(dst.fileno())
+        commit_database_file(
+            temp_path, digest, data_dir, dir_depth, durability=durability)
+    except Exception:
+        _remove_temp_file(temp_path)
+        raise
+    return size
+
+
+def _copy_file_contents(src_fd: int, dst_fd: int, size: int) -> None:
+    '''
+    Copy ``size`` bytes from the start of one file descriptor to another
+    using the most efficient mechanism the platform supports.
+    '''
+    if FICLONE is not None and fcntl is not None:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            offset = 0
+            while offset < size:
+                count = os.copy_file_range(  # type: ignore
+                    src_fd, dst_fd, size - offset, offset, offset)
+                if not count:
+                    break
+                offset += count
+            if offset == size:
+                return
+        except OSError:
+            pass
+
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            offset = 0
+            while offset < size:
+                count = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if not count:
+                    break
+                offset += count
+            if offset == size:
+                return
+        except OSError:
+            pass
+
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    os.lseek(dst_fd, 0, os.SEEK_SET)
+    for chunk in iter(lambda: os.read(src_fd, 2**20), b''):
+        os.write(dst_fd, chunk)
+
+
+def write_database_files(items: Iterable[Tuple[bytes, bytes]],
+                         data_dir: str,
+                         dir_depth: int,
+                         durability: str = DURABILITY_NONE) -> Iterator[Optional[Exception]]:
+    '''
+    Writes many binary database items to the file system.
+
+    This function behaves like :func:`write_database_file` for each item but
+    only creates each parent directory once per call, which avoids repeating
+    the directory creation system calls when writing lots of small items.
+
+    This function is implemented as a generator that yields the outcome of
+    each write, in item order, as it is performed. A value of None indicates
+    that the item was written successfully otherwise the exception raised
+    while writing the item is yielded.
+
+    :param items: an iterable of 2-tuples of (digest, data).
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :param durability: one of the DURABILITY modes. With DURABILITY_BATCH
+      the outcomes are only yielded once all of the items are written and
+      flushed, see :func:`_write_database_files_batch`.
+    '''
+    if durability == DURABILITY_BATCH:
+        yield from _write_database_files_batch(items, data_dir, dir_depth)
+        return
+
+    sync = durability != DURABILITY_NONE
+    created_dirs = set()  # type: Set[str]
+    for digest, data in items:
+        try:
+            fpath = os.path.join(
+                data_dir, digest_filepath(digest, dir_depth=dir_depth))
+
+            dirname = os.path.dirname(fpath)
+            if dirname not in created_dirs:
+                os.makedirs(dirname, exist_ok=True)
+                created_dirs.add(dirname)
+
+            if os.path.exists(fpath):
+                raise Exception(
+                    'Duplicate file detected: {}'.format(fpath))
+
+            temp_path = _write_temp_file(dirname, data, sync)
+            try:
+                os.replace(temp_path, fpath)
+            except Exception:
+                _remove_temp_file(temp_path)
+                raise
+            if sync:
+                fsync_directory(dirname)
+        except Exception as exc:
+            yield exc
+        else:
+            yield None
+
+
+def _write_database_files_batch(
+        items: Iterable[Tuple[bytes, bytes]],
+        data_dir: str,
+        dir_depth: int) -> List[Optional[Exception]]:
+    '''
+    Write many binary database items using a group commit.
+
+    Every item is first written to a temporary file. The temporary files are
+    then flushed, giving the operating system the chance to write them out
+    together, and renamed into place. Finally each directory that received
+    an item is flushed once. A file is always flushed before it is renamed
+    so a crash can never expose a partially written item.
+    '''
+    results = []  # type: List[Optional[Exception]]
+    pending = []  # type: List[Tuple[int, str, str]]
+    written = set()  # type: Set[str]
+    created_dirs = set()  # type: Set[str]
+    for digest, data in items:
+        try:
+            fpath = os.path.join(
+                data_dir, digest_filepath(digest, dir_depth=dir_depth))
+
+            dirname = os.path.dirname(fpath)
+            if dirname not in created_dirs:
+                os.makedirs(dirname, exist_ok=True)
+                created_dirs.add(dirname)
+
+            if fpath in written or os.path.exists(fpath):
+                raise Exception(
+                    'Duplicate file detected: {}'.format(fpath))
+
+            pending.append(
+                (len(results), _write_temp_file(dirname, data, False), fpath))
+            written.add(fpath)
+        except Exception as exc:
+            results.append(exc)
+        else:
+            results.append(None)
+
+    synced_dirs = set()  # type: Set[str]
+    for index, temp_path, fpath in pending:
+        try:
+            fd = os.open(temp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(temp_path, fpath)
+        except Exception as exc:
+            _remove_temp_file(temp_path)
+            results[index] = exc
+        else:
+            synced_dirs.add(os.path.dirname(fpath))
+    for dirname in synced_dirs:
+        fsync_directory(dirname)
+    return results
+
+
+def write_data_item(digest: bytes,
+                    data: bytes,
+                    data_dir: str,
+                    dir_depth: int,
+                    durability: str = DURABILITY_NONE) -> Optional[Exception]:
+    '''
+    Write a data item to the file system, returning any error raised.
+
+    This function is suitable for submitting to a thread or process pool
+    executor as it never raises an exception itself.
+
+    :param digest: a bytes object representing a hash of some data.
+
+    :param data: a bytes object containing the binary data to be stored by the
+      database.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :param durability: one of the DURABILITY modes, see
+      :func:`write_database_file`.
+
+    :return: None if the item was written successfully otherwise the error.
+    '''
+    try:
+        write_database_file(
+            digest, data, data_dir, dir_depth, durability=durability)
+    except Exception as exc:
+        return exc
+    return None
+
+
+def _chunksize(count: int) -> int:
+    '''
+    Return a chunksize to use when mapping ``count`` items over an executor.
+
+    Process pool executors send work to workers in chunks. Sending a few
+    chunks per worker, rather than one item at a time, amortises the
+    inter-process communication overhead across many small items.
+    '''
+    return max(1, count // ((os.cpu_count() or 1) * 4))
+
+
+def read_database_file(digest: bytes,
+                       data_dir: str,
+                       dir_depth: int,
+                       chunk_size: int = 2**20,
+                       codec: str = None,
+                       dictionary: bytes = None,
+                       dictionaries: Callable[[int], bytes] = None,
+                       decode: bool = False) -> Generator[bytes, None, None]:
+    '''
+    Return the binary data associated with the digest.
+
+    This method is implemented as a generator that returns one chunk per
+    iteration. This is to avoid reading large files completely into memory.
+
+    .. code-block:: python
+
+        for chunk in read_database_file():
+            print(chunk)
+
+    :param digest: a bytes object representing a hash of some data.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :param chunk_size: the number of bytes to read from the file per
+      iteration.
+
+    :param codec: the name of the compression codec recorded for the data,
+      if any. Specifying a codec implies ``decode``.
+
+    :param dictionary: the compression dictionary recorded for the data, if
+      any.
+
+    :param dictionaries: a function that returns a dictionary given its
+      identifier, used to decode framed data compressed with a dictionary.
+
+    :param decode: return the original form of the data rather than its
+      stored form. The data is decoded as its frame header describes, if it
+      has one, otherwise using ``codec`` and ``dictionary`` (see
+      :func:`compression.iter_decode`). The size of the decoded chunks may
+      differ from ``chunk_size``.
+
+    :raises: OSError exception if the resolved file does not exist.
+    '''
+    fpath = os.path.join(data_dir, digest_filepath(
+        digest, dir_depth=dir_depth))
+    with open(fpath, 'rb') as fd:
+        chunks = iter(lambda: fd.read(chunk_size), b'')
+        if decode or codec:
+            chunks = iter_decode(
+                chunks, codec, dictionary=dictionary,
+                dictionaries=dictionaries)
+        for chunk in chunks:
+            yield chunk
+
+
+def read_database_file_all(digest: bytes,
+                           data_dir: str,
+                           dir_depth: int) -> bytes:
+    '''
+    Return the binary data associated with the digest as a single bytes
+    object.
+
+    The file is read using a single read call which avoids accumulating a
+    list of chunks and then copying them into a new bytes object.
+
+    :param digest: a bytes object representing a hash of some data.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :raises: OSError exception if the resolved file does not exist.
+    '''
+    fpath = os.path.join(data_dir, digest_filepath(
+        digest, dir_depth=dir_depth))
+    with open(fpath, 'rb') as fd:
+        return fd.read()
+
+
+def map_database_file(digest: bytes,
+                      data_dir: str,
+                      dir_depth: int) -> memoryview:
+    '''
+    Return a read-only memory mapped view of the binary data associated with
+    the digest.
+
+    No data is copied into the Python process. Pages of the file are loaded
+    on demand by the operating system as the view is accessed. The mapping
+    remains valid for as long as the returned view (or any slice of it) is
+    referenced. Call ``release`` on the view to free it deterministically.
+
+    :param digest: a bytes object representing a hash of some data.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :raises: OSError exception if the resolved file does not exist.
+    '''
+    fpath = os.path.join(data_dir, digest_filepath(
+        digest, dir_depth=dir_depth))
+    with open(fpath, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            # Empty files can not be memory mapped.
+            return memoryview(b'')
+        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm)
+
+
+def read_database_file_into(digest: bytes,
+                            buffer: bytearray,
+                            data_dir: str,
+                            dir_depth: int) -> int:
+    '''
+    Read the binary data associated with the digest into a caller supplied
+    buffer.
+
+    This allows a caller to reuse a single buffer across many reads which
+    avoids allocating new objects for each item read.
+
+    :param digest: a bytes object representing a hash of some data.
+
+    :param buffer: a writable buffer (e.g. a bytearray) to read data into.
+      It must be large enough to hold the entire data item.
+
+    :param data_dir: the database's root directory path where binary data is
+      being stored.
+
+    :param dir_depth: the number of directories to being used to spread files.
+
+    :return: the number of bytes read into the buffer.
+
+    :raises: OSError exception if the resolved file does not exist.
+
+    :raises: Exception if the buffer is too small to hold the data item.
+    '''
+    fpath = os.path.join(data_dir, digest_filepath(
+        digest, dir_depth=dir_depth))
+    view = memoryview(buffer)
+    with open(fpath, 'rb', buffering=0) as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size > len(view):
+            raise Exception(
+                'Buffer too small. Expected at least {} bytes but got '
+                '{}'.format(size, len(view)))
+        total = 0
+        while total < size:
+            count = fd.readinto(view[total:size])
+            if not count:
+                break
+            total += count
+    return total
+
+
+def _not_found(digest: bytes) -> FileNotFoundError:
+    return FileNotFoundError(
+        'Item not found in storage: {}'.format(digest.hex()))
+
+
+class Storage(object):
+    '''
+    This class defines the interface implemented by blob storage backends.
+
+    A storage backend stores binary blobs keyed by the digest of their
+    contents. It knows nothing about categories or other metadata, which are
+    managed by the :class:`DigestDB`.
+
+    Methods that read an item raise a FileNotFoundError (an OSError) if the
+    item is not stored. Methods that add an item raise an exception if the
+    item is already stored.
+
+    Subclasses must implement :meth:`put`, :meth:`view`, :meth:`exists`,
+    :meth:`stat`, :meth:`delete` and :meth:`digests`. The remaining methods,
+    including the bulk variants, have default implementations built on those
+    methods which subclasses can override with more efficient versions.
+    '''
+
+    def open(self) -> None:
+        ''' Prepare the storage for use '''
+        pass
+
+    def close(self) -> None:
+        ''' Release any resources held by the storage '''
+        pass
+
+    def put(self, digest: bytes, data: bytes) -> None:
+        '''
+        Add an item to the storage.
+
+        :param digest: a bytes object representing a hash of the data.
+
+        :param data: a bytes object containing the item's data.
+
+        :raises: Exception if the item is already stored.
+        '''
+        raise NotImplementedError
+
+    def put_many(self,
+                 items: Iterable[Tuple[bytes, bytes]],
+                 executor: Executor = None) -> List[Optional[Exception]]:
+        '''
+        Add many items to the storage.
+
+        :param items: an iterable of 2-tuples of (digest, data).
+
+        :param executor: an optional executor which the storage may use to
+          add items in parallel.
+
+        :return: a list containing, for each item, None if the item was
+          stored otherwise the error that prevented it being stored.
+        '''
+        results = []  # type: List[Optional[Exception]]
+        for digest, data in items:
+            try:
+                self.put(digest, data)
+            except Exception as exc:
+                results.append(exc)
+            else:
+                results.append(None)
+        return results
+
+    def replace(self, digest: bytes, data: bytes) -> None:
+        '''
+        Replace the stored form of an item, e.g. when it is recompressed.
+
+        The default implementation removes the item and then adds it again.
+        Backends that can swap the contents atomically override this so that
+        readers always see either the old or the new contents.
+
+        :param digest: a bytes object representing a hash of the item.
+
+        :param data: a bytes object containing the item's new stored form.
+        '''
+        self.delete(digest)
+        self.put(digest, data)
+
+    def put_stream(self,
+                   chunks: Iterable[bytes],
+                   hash_name: str = 'sha256') -> Tuple[bytes, int]:
+        '''
+        Add an item, whose digest is not yet known, from a stream of chunks.
+
+        :param chunks: an iterable of bytes objects.
+
+        :param hash_name: the name of a hash calculator.
+
+        :return: a 2-tuple of (digest, size) for the item.
+
+        :raises: Exception if the item is already stored.
+        '''
+        data = b''.join(chunks)
+        digest = data_digest(data, hash_name=hash_name)
+        self.put(digest, data)
+        return digest, len(data)
+
+    def put_file(self,
+                 filepath: str,
+                 digest: bytes,
+                 link: bool = False) -> int:
+        '''
+        Add an item from the contents of a file.
+
+        :param filepath: the path of the file to add.
+
+        :param digest: a bytes object representing a hash of the file's data.
+
+        :param link: a hint that the storage may link to the file rather
+          than copy it.
+
+        :return: the size of the item.
+
+        :raises: Exception if the item is already stored.
+        '''
+        with open(filepath, 'rb') as fd:
+            data = fd.read()
+        self.put(digest, data)
+        return len(data)
+
+    def get(self, digest: bytes) -> bytes:
+        ''' Return the contents of an item '''
+        return bytes(self.view(digest))
+
+    def get_many(
+            self,
+            digests: Iterable[bytes]) -> Iterator[Tuple[bytes, Optional[bytes]]]:
+        '''
+        Return the contents of many items.
+
+        :param digests: an iterable of digests.
+
+        :return: an iterator of 2-tuples of (digest, data) where data is None
+          if the item is not stored.
+        '''
+        for digest in digests:
+            try:
+                yield digest, self.get(digest)
+            except OSError:
+                yield digest, None
+
+    def view(self, digest: bytes) -> memoryview:
+        '''
+        Return a read-only view of the contents of an item. Backends avoid
+        copying the data where they can.
+        '''
+        raise NotImplementedError
+
+    def read_order(self, digests: Iterable[bytes]) -> List[bytes]:
+        '''
+        Return digests sorted into the order in which the items are most
+        efficiently read.
+
+        The default order is by digest. For the file storage this is the
+        order of the items' paths, so items sharing a directory are read
+        together.
+        '''
+        return sorted(digests)
+
+    def open_file(self, digest: bytes) -> BinaryIO:
+        ''' Return a read-only binary file object for an item '''
+        return io.BytesIO(self.view(digest))
+
+    def iter_chunks(self,
+                    digest: bytes,
+                    chunk_size: int = 2**20) -> Iterator[bytes]:
+        '''
+        Return an iterator over the contents of an item.
+
+        :param digest: a bytes object representing a hash of the data.
+
+        :param chunk_size: the number of bytes to return per iteration.
+        '''
+        view = self.view(digest)
+        return (
+            bytes(view[i:i + chunk_size])
+            for i in range(0, len(view), chunk_size))
+
+    def read_into(self, digest: bytes, buffer: bytearray) -> int:
+        '''
+        Read the contents of an item into a caller supplied buffer.
+
+        :return: the number of bytes read into the buffer.
+
+        :raises: Exception if the buffer is too small to hold the item.
+        '''
+        view = self.view(digest)
+        if len(view) > len(buffer):
+            raise Exception(
+                'Buffer too small. Expected at least {} bytes but got '
+                '{}'.format(len(view), len(buffer)))
+        memoryview(buffer)[:len(view)] = view
+        return len(view)
+
+    def exists(self, digest: bytes) -> bool:
+        ''' Return True if the item is stored '''
+        raise NotImplementedError
+
+    def stat(self, digest: bytes) -> int:
+        ''' Return the size of a stored item '''
+        raise NotImplementedError
+
+    def delete(self, digest: bytes) -> bool:
+        '''
+        Remove an item from the storage.
+
+        :return: True if the item was stored.
+        '''
+        raise NotImplementedError
+
+    def delete_many(self, digests: Iterable[bytes]) -> int:
+        '''
+        Remove many items from the storage.
+
+        :return: the number of items that were removed.
+        '''
+        return sum(1 for digest in digests if self.delete(digest))
+
+    def digests(self) -> Iterator[bytes]:
+        ''' Return an iterator over the digests of all stored items '''
+        raise NotImplementedError
+
+    def shard_digests(self, shard: str) -> List[bytes]:
+        '''
+        Return the sorted digests of the stored items in a shard.
+
+        :param shard: a shard name from :data:`SHARDS`, which is the hex
+          form of the first byte of the digests in the shard.
+        '''
+        return sorted(d for d in self.digests() if d.hex().startswith(shard))
+
+    def shard_signature(self, shard: str) -> Optional[str]:
+        '''
+        Return a value that changes whenever items are added to or removed
+        from a shard. This lets unchanged shards be skipped by incremental
+        reconciliation, see :mod:`sync`.
+
+        :return: a signature string, or None if the storage can not tell
+          whether the shard has changed.
+        '''
+        return None
+
+    def compact(self, min_dead_ratio: float = 0.5) -> int:
+        '''
+        Reclaim space left behind by deleted items, if the storage needs to.
+
+        :return: the number of bytes reclaimed.
+        '''
+        return 0
+
+
+class FileStorage(Storage):
+    '''
+    This storage backend stores each item in its own file within a balanced
+    tree of directories derived from the item's digest. This is the default
+    storage used by the DigestDB. See :func:`digest_filepath`.
+    '''
+
+    def __init__(self,
+                 data_dir: str,
+                 dir_depth: int = 3,
+                 durability: str = DURABILITY_NONE) -> None:
+        '''
+
+        :param data_dir: the root directory path where items are stored.
+
+        :param dir_depth: the number of directories used to spread files.
+
+        :param durability: whether items are flushed to disk as they are
+          written. One of DURABILITY_NONE, DURABILITY_FSYNC, which flushes
+          each item and its directory, or DURABILITY_BATCH, which flushes the
+          items written by :meth:`put_many` together and each of their
+          directories once. Items written on their own are flushed as they
+          are with DURABILITY_FSYNC.
+        '''
+        check_durability(durability)
+        self.data_dir = data_dir
+        self.dir_depth = dir_depth
+        self.durability = durability
+
+    def __repr__(self) -> str:
+        return "<FileStorage '{}'>".format(self.data_dir)
+
+    def path(self, digest: bytes) -> str:
+        ''' Return the file path used to store an item '''
+        return os.path.join(
+            self.data_dir, digest_filepath(digest, dir_depth=self.dir_depth))
+
+    @property
+    def _single_durability(self) -> str:
+        ''' The durability used for items written on their own '''
+        if self.durability == DURABILITY_BATCH:
+            return DURABILITY_FSYNC
+        return self.durability
+
+    def put(self, digest: bytes, data: bytes) -> None:
+        write_database_file(
+            digest, data, self.data_dir, self.dir_depth,
+            durability=self._single_durability)
+
+    def put_many(self,
+                 items: Iterable[Tuple[bytes, bytes]],
+                 executor: Executor = None) -> List[Optional[Exception]]:
+        if executor:
+            digests, blobs = [], []  # type: List[bytes], List[bytes]
+            for digest, data in items:
+                digests.append(digest)
+                blobs.append(data)
+            # With DURABILITY_BATCH the workers flush each file and the
+            # directories are flushed once all of the files are written.
+            results = list(executor.map(
+                write_data_item, digests, blobs,
+                itertools.repeat(self.data_dir),
+                itertools.repeat(self.dir_depth),
+                itertools.repeat(self.durability),
+                chunksize=_chunksize(len(digests))))
+            if self.durability == DURABILITY_BATCH:
+                dirnames = set(
+                    os.path.dirname(self.path(digest))
+                    for digest, error in zip(digests, results) if not error)
+                for dirname in dirnames:
+                    fsync_directory(dirname)
+            return results
+        return list(write_database_files(
+            items, self.data_dir, self.dir_depth,
+            durability=self.durability))
+
+    def replace(self, digest: bytes, data: bytes) -> None:
+        fpath = self.path(digest)
+        dirname = os.path.dirname(fpath)
+        durability = self._single_durability
+        temp_path = _write_temp_file(
+            dirname, data, durability != DURABILITY_NONE)
+        try:
+            os.replace(temp_path, fpath)
+        except Exception:
+            _remove_temp_file(temp_path)
+            raise
+        if durability != DURABILITY_NONE:
+            fsync_directory(dirname)
+
+    def put_stream(self,
+                   chunks: Iterable[bytes],
+                   hash_name: str = 'sha256') -> Tuple[bytes, int]:
+        return write_database_stream(
+            chunks, self.data_dir, self.dir_depth, hash_name=hash_name,
+            durability=self._single_durability)
+
+    def put_file(self,
+                 filepath: str,
+                 digest: bytes,
+                 link: bool = False) -> int:
+        return copy_database_file(
+            filepath, digest, self.data_dir, self.dir_depth, link=link,
+            durability=self._single_durability)
+
+    def get(self, digest: bytes) -> bytes:
+        return read_database_file_all(digest, self.data_dir, self.dir_depth)
+
+    def view(self, digest: bytes) -> memoryview:
+        return map_database_file(digest, self.data_dir, self.dir_depth)
+
+    def open_file(self, digest: bytes) -> BinaryIO:
+        return open(self.path(digest), 'rb')
+
+    def iter_chunks(self,
+                    digest: bytes,
+                    chunk_size: int = 2**20) -> Iterator[bytes]:
+        return read_database_file(
+            digest, self.data_dir, self.dir_depth, chunk_size=chunk_size)
+
+    def read_into(self, digest: bytes, buffer: bytearray) -> int:
+        return read_database_file_into(
+            digest, buffer, self.data_dir, self.dir_depth)
+
+    def exists(self, digest: bytes) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def stat(self, digest: bytes) -> int:
+        return os.stat(self.path(digest)).st_size
+
+    def delete(self, digest: bytes) -> bool:
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            return False
+        return True
+
+    def digests(self) -> Iterator[bytes]:
+        for dirpath, dirnames, filenames in os.walk(self.data_dir):
+            for filename in filenames:
+                if filename.startswith(TEMP_FILE_PREFIX):
+                    continue
+                # filename is the str dump of the hex digest
+                try:
+                    yield bytes.fromhex(filename)
+                except ValueError:
+                    logger.warning(
+                        'Ignoring unexpected file: %s',
+                        os.path.join(dirpath, filename))
+
+    def shard_digests(self, shard: str) -> List[bytes]:
+        '''
+        Return the sorted digests of the items in a shard's directory tree.
+
+        Directories are listed using ``os.scandir`` which, unlike
+        ``os.walk``, does not stat each file. Temporary files and files
+        whose names are not hex digests are ignored.
+        '''
+        digests = []  # type: List[bytes]
+        paths = [os.path.join(self.data_dir, shard)]
+        while paths:
+            try:
+                entries = os.scandir(paths.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        paths.append(entry.path)
+                    elif not entry.name.startswith(TEMP_FILE_PREFIX):
+                        try:
+                            digests.append(bytes.fromhex(entry.name))
+                        except ValueError:
+                            logger.warning(
+                                'Ignoring unexpected file: %s', entry.path)
+        digests.sort()
+        return digests
+
+    def shard_signature(self, shard: str) -> Optional[str]:
+        '''
+        Return a hash of the modification times of a shard's directories.
+
+        Adding or removing a file changes the modification time of the
+        directory holding it. Only the directories above the deepest level
+        are listed, the deepest directories are just stat'ed, so this is
+        much cheaper than listing the shard's files.
+        '''
+        root = os.path.join(self.data_dir, shard)
+        try:
+            mtimes = [('', os.stat(root).st_mtime_ns)]
+        except FileNotFoundError:
+            return 'absent'
+        level = [(root, '')]
+        for _ in range(1, self.dir_depth):
+            below = []
+            for path, relpath in level:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            name = relpath + '/' + entry.name
+                            mtimes.append((name, entry.stat(
+                                follow_symlinks=False).st_mtime_ns))
+                            below.append((entry.path, name))
+            level = below
+        newest = max(mtime for _, mtime in mtimes)
+        if newest > (time.time() - SIGNATURE_SETTLE_TIME) * 1e9:
+            return None
+        h = hashlib.sha1()
+        for name, mtime in sorted(mtimes):
+            h.update('{}:{}\n'.format(name, mtime).encode())
+        return h.hexdigest()
+
+
+class MemoryStorage(Storage):
+    '''
+    This storage backend keeps items in a dict. Nothing is persisted so it
+    is intended for tests and benchmarks.
+    '''
+
+    def __init__(self) -> None:
+        self.items = {}  # type: Dict[bytes, bytes]
+
+    def __repr__(self) -> str:
+        return '<MemoryStorage items={}>'.format(len(self.items))
+
+    def put(self, digest: bytes, data: bytes) -> None:
+        if digest in self.items:
+            raise Exception(
+                'Duplicate item detected: {}'.format(digest.hex()))
+        self.items[digest] = bytes(data)
+
+    def replace(self, digest: bytes, data: bytes) -> None:
+        self.items[digest] = bytes(data)
+
+    def get(self, digest: bytes) -> bytes:
+        try:
+            return self.items[digest]
+        except KeyError:
+            raise _not_found(digest) from None
+
+    def view(self, digest: bytes) -> memoryview:
+        return memoryview(self.get(digest))
+
+    def exists(self, digest: bytes) -> bool:
+        return digest in self.items
+
+    def stat(self, digest: bytes) -> int:
+        return len(self.get(digest))
+
+    def delete(self, digest: bytes) -> bool:
+        return self.items.pop(digest, None) is not None
+
+    def digests(self) -> Iterator[bytes]:
+        return iter(list(self.items))
+
+
+class HybridStorage(Storage):
+    '''
+    This storage backend stores small items in one backend and large items
+    in another. It is typically used to keep small items in pack files and
+    large items in their own files.
+
+    Items added from a stream are always stored in the large item backend
+    as their size is not known until the stream has been consumed.
+    '''
+
+    def __init__(self,
+                 small: Storage,
+                 large: Storage,
+                 threshold: int) -> None:
+        '''
+
+        :param small: the storage used for items smaller than ``threshold``.
+
+        :param large: the storage used for all other items.
+
+        :param threshold: the size, in bytes, below which items are stored in
+          the ``small`` storage.
+        '''
+        self.small = small
+        self.large = large
+        self.threshold = threshold
+
+    def __repr__(self) -> str:
+        return '<HybridStorage small={} large={} threshold={}>'.format(
+            self.small, self.large, self.threshold)
+
+    def _choose(self, size: int) -> Storage:
+        return self.small if size < self.threshold else self.large
+
+    def open(self) -> None:
+        self.small.open()
+        self.large.open()
+
+    def close(self) -> None:
+        self.small.close()
+        self.large.close()
+
+    def put(self, digest: bytes, data: bytes) -> None:
+        self._choose(len(data)).put(digest, data)
+
+    def put_many(self,
+                 items: Iterable[Tuple[bytes, bytes]],
+                 executor: Executor = None) -> List[Optional[Exception]]:
+        items = list(items)
+        small, large = [], []  # type: List[int], List[int]
+        for index, (digest, data) in enumerate(items):
+            (small if len(data) < self.threshold else large).append(index)
+        results = [None] * len(items)  # type: List[Optional[Exception]]
+        for indices, storage in ((small, self.small), (large, self.large)):
+            if indices:
+                errors = storage.put_many(
+                    [items[i] for i in indices], executor=executor)
+                for index, error in zip(indices, errors):
+                    results[index] = error
+        return results
+
+    def replace(self, digest: bytes, data: bytes) -> None:
+        current = self._locate(digest)
+        target = self._choose(len(data))
+        if target is current:
+            target.replace(digest, data)
+        else:
+            target.put(digest, data)
+            current.delete(digest)
+
+    def put_stream(self,
+                   chunks: Iterable[bytes],
+                   hash_name: str = 'sha256') -> Tuple[bytes, int]:
+        return self.large.put_stream(chunks, hash_name=hash_name)
+
+    def put_file(self,
+                 filepath: str,
+                 digest: bytes,
+                 link: bool = False) -> int:
+        storage = self._choose(os.path.getsize(filepath))
+        return storage.put_file(filepath, digest, link=link)
+
+    def _locate(self, digest: bytes) -> Storage:
+        ''' Return the storage holding an item '''
+        if self.small.exists(digest):
+            return self.small
+        return self.large
+
+    def get(self, digest: bytes) -> bytes:
+        return self._locate(digest).get(digest)
+
+    def view(self, digest: bytes) -> memoryview:
+        return self._locate(digest).view(digest)
+
+    def open_file(self, digest: bytes) -> BinaryIO:
+        return self._locate(digest).open_file(digest)
+
+    def read_order(self, digests: Iterable[bytes]) -> List[bytes]:
+        # the small item storage orders the items it holds and places the
+        # rest after them, sorted by digest.
+        return self.small.read_order(digests)
+
+    def iter_chunks(self,
+                    digest: bytes,
+                    chunk_size: int = 2**20) -> Iterator[bytes]:
+        return self._locate(digest).iter_chunks(digest, chunk_size=chunk_size)
+
+    def read_into(self, digest: bytes, buffer: bytearray) -> int:
+        return self._locate(digest).read_into(digest, buffer)
+
+    def exists(self, digest: bytes) -> bool:
+        return self.small.exists(digest) or self.large.exists(digest)
+
+    def stat(self, digest: bytes) -> int:
+        return self._locate(digest).stat(digest)
+
+    def delete(self, digest: bytes) -> bool:
+        deleted_small = self.small.delete(digest)
+        deleted_large = self.large.delete(digest)
+        return deleted_small or deleted_large
+
+    def digests(self) -> Iterator[bytes]:
+        return itertools.chain(self.small.digests(), self.large.digests())
+
+    def shard_digests(self, shard: str) -> List[bytes]:
+        return sorted(
+            self.small.shard_digests(shard) + self.large.shard_digests(shard))
+
+    def shard_signature(self, shard: str) -> Optional[str]:
+        small = self.small.shard_signature(shard)
+        large = self.large.shard_signature(shard)
+        if small is None or large is None:
+            return None
+        return '{}/{}'.format(small, large)
+
+    def compact(self, min_dead_ratio: float = 0.5) -> int:
+        return sum(
+            backend.compact(min_dead_ratio=min_dead_ratio)
+            for backend in (self.small, self.large))
+
+
+class ReadOnlyStorage(Storage):
+    '''
+    This storage backend provides read only access to another backend.
+    Methods that would change the stored items raise an exception. It is
+    used by databases opened in read only mode so that a reader can never
+    add, replace or remove the items that a writer is managing.
+    '''
+
+    def __init__(self, storage: Storage) -> None:
+        '''
+
+        :param storage: the storage to provide read only access to.
+        '''
+        self.storage = storage
+
+    def __repr__(self) -> str:
+        return '<ReadOnlyStorage {}>'.format(self.storage)
+
+    def _read_only(self, *args: Any, **kwargs: Any) -> Any:
+        raise Exception('Storage is read only: {}'.format(self.storage))
+
+    put = put_many = replace = put_stream = put_file = _read_only
+    delete = delete_many = compact = _read_only
+
+    def open(self) -> None:
+        self.storage.open()
+
+    def close(self) -> None:
+        self.storage.close()
+
+    def get(self, digest: bytes) -> bytes:
+        return self.storage.get(digest)
+
+    def get_many(
+            self,
+            digests: Iterable[bytes]) -> Iterator[Tuple[bytes, Optional[bytes]]]:
+        return self.storage.get_many(digests)
+
+    def view(self, digest: bytes) -> memoryview:
+        return self.storage.view(digest)
+
+    def read_order(self, digests: Iterable[bytes]) -> List[bytes]:
+        return self.storage.read_order(digests)
+
+    def open_file(self, digest: bytes) -> BinaryIO:
+        return self.storage.open_file(digest)
+
+    def iter_chunks(self,
+                    digest: bytes,
+                    chunk_size: int = 2**20) -> Iterator[bytes]:
+        return self.storage.iter_chunks(digest, chunk_size=chunk_size)
+
+    def read_into(self, digest: bytes, buffer: bytearray) -> int:
+        return self.storage.read_into(digest, buffer)
+
+    def exists(self, digest: bytes) -> bool:
+        return self.storage.exists(digest)
+
+    def stat(self, digest: bytes) -> int:
+        return self.storage.stat(digest)
+
+    def digests(self) -> Iterator[bytes]:
+        return self.storage.digests()
+
+    def shard_digests(self, shard: str) -> List[bytes]:
+        return self.storage.shard_digests(shard)
+
+    def shard_signature(self, shard: str) -> Optional[str]:
+        return self.storage.shard_signature(shard)
@@ -0,0 +1,220 @@
+''' This module reconciles the digests table with the blob storage '''
+
+import collections
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .model import Digest
+from .storage import SHARDS
+
+# type annotations
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+SyncReport = NamedTuple('SyncReport', [
+    # digests of items in storage that are not in the digests table
+    ('untracked', List[bytes]),
+    # digests in the digests table whose items are not in storage
+    ('missing', List[bytes]),
+    # shards that were compared
+    ('scanned', List[str]),
+    # shards that were skipped as unchanged or already completed
+    ('skipped', List[str])])
+
+
+def diff_sorted(a: Iterable[bytes],
+                b: Iterable[bytes]) -> Tuple[List[bytes], List[bytes]]:
+    '''
+    Compare two sorted streams of digests in a single pass.
+
+    :return: a 2-tuple of lists holding the digests only found in ``a`` and
+      the digests only found in ``b``.
+    '''
+    only_a, only_b = [], []  # type: List[bytes], List[bytes]
+    a, b = iter(a), iter(b)
+    x, y = next(a, None), next(b, None)
+    while x is not None and y is not None:
+        if x == y:
+            x, y = next(a, None), next(b, None)
+        elif x < y:
+            only_a.append(x)
+            x = next(a, None)
+        else:
+            only_b.append(y)
+            y = next(b, None)
+    while x is not None:
+        only_a.append(x)
+        x = next(a, None)
+    while y is not None:
+        only_b.append(y)
+        y = next(b, None)
+    return only_a, only_b
+
+
+class Reconciler(object):
+    '''
+    This class compares the digests recorded in the database with the items
+    held in its storage and reports the differences in both directions.
+
+    The storage is divided into shards by the first byte of the digests (see
+    :data:`storage.SHARDS`). Shards are listed concurrently by a pool of
+    threads while the calling thread fetches the digests of each shard from
+    the digests table, in digest order, using the table's primary key. The
+    two sorted lists are then compared in a single pass.
+
+    If a ``state_file`` is supplied then progress is recorded in it after
+    each shard so an interrupted run resumes where it stopped. It also
+    records a signature of each shard that was found to be consistent. When
+    ``incremental`` is set, shards whose signature has not changed since
+    are skipped. Signatures are derived from storage (e.g. directory
+    modification times) so changes made to the database without going
+    through the storage are only found by a full run.
+    '''
+
+    def __init__(self,
+                 db: 'DigestDB',
+                 workers: int = 8,
+                 state_file: str = None,
+                 incremental: bool = False) -> None:
+        '''
+
+        :param db: an open database.
+
+        :param workers: the number of threads used to list shards.
+
+        :param state_file: an optional file used to checkpoint progress and
+          remember the signatures of consistent shards.
+
+        :param incremental: skip shards that have not changed since they
+          were last found to be consistent. Requires a ``state_file``.
+        '''
+        if incremental and not state_file:
+            raise Exception('Incremental reconciliation requires a state_file')
+        self.db = db
+        self.workers = workers
+        self.state_file = state_file
+        self.incremental = incremental
+        self.state = self._load_state()
+
+    def _load_state(self) -> Dict:
+        state = {'signatures': {}, 'run': None}  # type: Dict
+        if self.state_file and os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r') as fd:
+                    state.update(json.load(fd))
+            except ValueError:
+                logger.warning(
+                    'Ignoring corrupt reconciliation state file: %s',
+                    self.state_file)
+        return state
+
+    def _save_state(self) -> None:
+        if not self.state_file:
+            return
+        temp_path = '{}.tmp'.format(self.state_file)
+        with open(temp_path, 'w') as fd:
+            json.dump(self.state, fd)
+        os.replace(temp_path, self.state_file)
+
+    def _shard_rows(self, shard: str) -> List[bytes]:
+        ''' Return the sorted digests in a shard's range of the table '''
+        low = bytes.fromhex(shard)
+        query = self.db.session.query(Digest.digest).filter(
+            Digest.digest >= low)
+        if shard != SHARDS[-1]:
+            query = query.filter(Digest.digest < bytes([low[0] + 1]))
+        return [row[0] for row in query.order_by(Digest.digest)]
+
+    def _scan(self,
+              shard: str) -> Tuple[Optional[str], Optional[List[bytes]]]:
+        '''
+        Return a shard's signature and, unless the shard can be skipped, its
+        sorted digests. The signature is taken before the shard is listed
+        so changes made while it is listed alter the next signature.
+        '''
+        storage = self.db.storage
+        signature = storage.shard_signature(shard)
+        unchanged = signature is not None and \
+            self.state['signatures'].get(shard) == signature
+        if self.incremental and unchanged:
+            return signature, None
+        return signature, storage.shard_digests(shard)
+
+    def run(self) -> SyncReport:
+        '''
+        Compare the database with its storage.
+
+        :return: a :class:`SyncReport`.
+        '''
+        run = self.state['run']
+        if run is None:
+            run = {'completed': [], 'untracked': [], 'missing': []}
+            self.state['run'] = run
+        completed = set(run['completed'])
+        skipped = sorted(completed)
+        scanned = []  # type: List[str]
+
+        shards = [shard for shard in SHARDS if shard not in completed]
+        window = self.workers * 2
+        pending = collections.deque()  # type: collections.deque
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            shards_iter = iter(shards)
+            while True:
+                # keep a bounded number of shard listings in progress
+                while len(pending) < window:
+                    shard = next(shards_iter, None)
+                    if shard is None:
+                        break
+                    pending.append((shard, executor.submit(self._scan, shard)))
+                if not pending:
+                    break
+
+                shard, future = pending.popleft()
+                signature, stored = future.result()
+                if stored is None:
+                    skipped.append(shard)
+                else:
+                    untracked, missing = diff_sorted(
+                        stored, self._shard_rows(shard))
+                    run['untracked'].extend(d.hex() for d in untracked)
+                    run['missing'].extend(d.hex() for d in missing)
+                    if signature is not None and not untracked and not missing:
+                        self.state['signatures'][shard] = signature
+                    else:
+                        self.state['signatures'].pop(shard, None)
+                    scanned.append(shard)
+                run['completed'].append(shard)
+                self._save_state()
+
+        report = SyncReport(
+            [bytes.fromhex(d) for d in run['untracked']],
+            [bytes.fromhex(d) for d in run['missing']],
+            scanned, sorted(skipped))
+        self.state['run'] = None
+        self._save_state()
+        logger.debug(
+            'Reconciled %s shards (%s skipped): %s untracked, %s missing',
+            len(scanned), len(report.skipped), len(report.untracked),
+            len(report.missing))
+        return report
+
+
+def reconcile(db: 'DigestDB',
+              workers: int = 8,
+              state_file: str = None,
+              incremental: bool = False) -> SyncReport:
+    '''
+    Compare the digests in a database with the items in its storage. See
+    :class:`Reconciler`.
+
+    :return: a :class:`SyncReport`.
+    '''
+    return Reconciler(
+        db, workers=workers, state_file=state_file,
+        incremental=incremental).run()
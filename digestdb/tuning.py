@@ -0,0 +1,181 @@
+''' This module tunes the SQLite connections used by the database '''
+
+import logging
+
+from sqlalchemy import event
+
+# type annotations
+from typing import Any, Dict, List, NamedTuple, Union
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+
+SQLiteProfile = NamedTuple('SQLiteProfile', [
+    # the journal mode. In 'wal' mode readers do not block the writer and
+    # the writer does not block readers, and commits append to the write
+    # ahead log instead of rewriting pages of the database file.
+    ('journal_mode', str),
+    # when SQLite waits for writes to reach the disk: 'full' on every
+    # commit, 'normal' only at checkpoints in 'wal' mode, or 'off' never.
+    ('synchronous', str),
+    # the size of the page cache of each connection in KiB
+    ('cache_size', int),
+    # the number of bytes of the database file that are memory mapped
+    ('mmap_size', int),
+    # where temporary tables and indexes are kept: 'default', 'file' or
+    # 'memory'
+    ('temp_store', str),
+    # the number of milliseconds to wait for a lock held by another
+    # connection before giving up
+    ('busy_timeout', int)])
+
+# The names of the built in profiles
+PROFILE_DURABLE = 'durable'
+PROFILE_BALANCED = 'balanced'
+PROFILE_BULK_LOAD = 'bulk-load'
+
+PROFILES = {
+    # Every commit is on disk before it returns.
+    PROFILE_DURABLE: SQLiteProfile(
+        journal_mode='wal', synchronous='full', cache_size=64 * 2**10,
+        mmap_size=0, temp_store='default', busy_timeout=5000),
+    # Commits can not corrupt the database but the most recent ones may be
+    # rolled back by a power failure. Suits most workloads.
+    PROFILE_BALANCED: SQLiteProfile(
+        journal_mode='wal', synchronous='normal', cache_size=64 * 2**10,
+        mmap_size=256 * 2**20, temp_store='memory', busy_timeout=5000),
+    # Nothing is flushed until the database is closed, so a crash during an
+    # import can lose the import. Only suits data that can be loaded again.
+    PROFILE_BULK_LOAD: SQLiteProfile(
+        journal_mode='wal', synchronous='off', cache_size=256 * 2**10,
+        mmap_size=1 * 2**30, temp_store='memory', busy_timeout=5000),
+}  # type: Dict[str, SQLiteProfile]
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+TEMP_STORES = ('default', 'file', 'memory')
+
+
+def get_profile(profile: Union[str, SQLiteProfile]) -> SQLiteProfile:
+    '''
+    Return a tuning profile, looking it up by name if necessary.
+
+    :param profile: the name of a profile in :data:`PROFILES`, or a
+      :class:`SQLiteProfile`.
+
+    :raises: an exception is raised if the profile is unknown or invalid.
+    '''
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise Exception(
+                'Invalid SQLite profile. Expected one of {} but got {}'.format(
+                    ', '.join(sorted(PROFILES)), profile))
+        return PROFILES[profile]
+    for name, value, choices in (
+            ('journal_mode', profile.journal_mode, JOURNAL_MODES),
+            ('synchronous', profile.synchronous, SYNCHRONOUS_LEVELS),
+            ('temp_store', profile.temp_store, TEMP_STORES)):
+        if value not in choices:
+            raise Exception(
+                'Invalid {}. Expected one of {} but got {}'.format(
+                    name, ', '.join(choices), value))
+    for name in ('cache_size', 'mmap_size', 'busy_timeout'):
+        value = getattr(profile, name)
+        if value < 0:
+            raise Exception(
+                'Invalid {}. Expected at least 0 but got {}'.format(
+                    name, value))
+    return profile
+
+
+def profile_pragmas(profile: SQLiteProfile,
+                    read_only: bool = False) -> List[str]:
+    '''
+    Return the PRAGMA statements that apply a profile to a connection.
+
+    The busy timeout is set first so that changing the journal mode waits
+    for other connections. PRAGMA statements do not accept bound parameters
+    so the values are validated by :func:`get_profile`.
+
+    :param read_only: the connection is read only. The journal mode is
+      recorded in the database file and can only be changed by a writer.
+    '''
+    pragmas = ['PRAGMA busy_timeout = {:d}'.format(profile.busy_timeout)]
+    if not read_only:
+        pragmas.append('PRAGMA journal_mode = {}'.format(profile.journal_mode))
+    return pragmas + [
+        'PRAGMA synchronous = {}'.format(profile.synchronous),
+        # a negative cache size is a number of KiB rather than pages
+        'PRAGMA cache_size = {:d}'.format(-profile.cache_size),
+        'PRAGMA mmap_size = {:d}'.format(profile.mmap_size),
+        'PRAGMA temp_store = {}'.format(profile.temp_store)]
+
+
+def configure_connection(dbapi_connection: Any,
+                         profile: SQLiteProfile,
+                         read_only: bool = False) -> None:
+    ''' Apply a profile to a DBAPI connection '''
+    cursor = dbapi_connection.cursor()
+    try:
+        for statement in profile_pragmas(profile, read_only=read_only):
+            cursor.execute(statement)
+    finally:
+        cursor.close()
+
+
+def apply_profile(engine: Engine,
+                  profile: Union[str, SQLiteProfile],
+                  read_only: bool = False) -> SQLiteProfile:
+    '''
+    Apply a profile to every connection an engine opens.
+
+    :param engine: a SQLite engine. It should not have opened any
+      connections yet.
+
+    :param profile: the name of a profile in :data:`PROFILES`, or a
+      :class:`SQLiteProfile`.
+
+    :param read_only: the engine's connections are read only.
+
+    :return: the profile applied.
+    '''
+    profile = get_profile(profile)
+
+    def on_connect(dbapi_connection: Any, connection_record: Any) -> None:
+        configure_connection(dbapi_connection, profile, read_only=read_only)
+
+    event.listen(engine, 'connect', on_connect)
+    return profile
+
+
+def checkpoint(engine: Engine, synchronous: str = 'full') -> None:
+    '''
+    Copy the contents of the write ahead log into the database file, flush
+    it to disk and truncate the log. This makes everything committed so far
+    durable even if it was committed with ``synchronous`` turned off.
+
+    :param engine: a SQLite engine.
+
+    :param synchronous: the level used while checkpointing. See
+      :class:`SQLiteProfile`.
+    '''
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise Exception(
+            'Invalid synchronous. Expected one of {} but got {}'.format(
+                ', '.join(SYNCHRONOUS_LEVELS), synchronous))
+    raw = engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        if mode != 'wal':
+            return
+        conn.execute('PRAGMA synchronous = {}'.format(synchronous))
+        busy, _, _ = conn.execute(
+            'PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        if busy:
+            logger.warning(
+                'Checkpoint was blocked by another connection to the database')
+    finally:
+        raw.close()
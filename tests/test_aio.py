@@ -0,0 +1,273 @@
+''' Tests for digestdb.aio '''
+
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import unittest
+
+import digestdb
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class AsyncDigestDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_async_database_blobs(self):
+        ''' check blobs can be added, retrieved and queried asynchronously '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        async def run():
+            db = digestdb.AsyncDigestDB(
+                tempdir, dir_depth=1, max_workers=2, max_pending=4)
+            async with db:
+                await db.put_category('cat1')
+
+                blobs = [
+                    'item {}'.format(i).encode() * 100 for i in range(20)]
+                digests = await asyncio.gather(
+                    *[db.put_data('cat1', blob) for blob in blobs])
+                self.assertEqual(len(set(digests)), 20)
+                self.assertEqual(await db.count_data(), 20)
+
+                results = await asyncio.gather(
+                    *[db.get_data(digest) for digest in digests])
+                self.assertEqual(results, blobs)
+
+                results = await db.get_data_many(
+                    [digests[1], b'missing', digests[0], digests[1]])
+                self.assertEqual(
+                    [r.digest for r in results],
+                    [digests[1], b'missing', digests[0]])
+                self.assertEqual(results[0].data, blobs[1])
+                self.assertIsInstance(results[1].error, FileNotFoundError)
+
+                self.assertTrue(await db.exists(digests[0]))
+                self.assertFalse(await db.exists(b'deadbeef'))
+
+                matches = await db.query_data(category='cat1')
+                self.assertEqual(len(matches), 20)
+
+                rows = []
+                async for row in db.iter_query_data(batch_size=3, order='asc'):
+                    rows.append(row)
+                self.assertEqual(rows, await db.query_data(order='asc'))
+
+                categories = []
+                async for row in db.iter_query_category():
+                    categories.append(row)
+                self.assertEqual(categories, [('cat1', '')])
+
+                chunks = []
+                async for chunk in db.iter_data(digests[3], chunk_size=64):
+                    chunks.append(chunk)
+                self.assertGreater(len(chunks), 1)
+                self.assertEqual(b''.join(chunks), blobs[3])
+
+                with self.assertRaises(Exception) as cm:
+                    await db.put_data('cat1', blobs[0])
+                self.assertIn('Duplicate file detected', str(cm.exception))
+
+                result = await db.put_data_dedup('cat1', blobs[0])
+                self.assertEqual(result.status, 'duplicate')
+                result = await db.put_data_dedup(
+                    'cat1', blobs[0], reference=True)
+                self.assertEqual(
+                    len(await db.query_occurrences(result.digest)), 2)
+                result = await db.put_data_dedup('cat1', b'new item')
+                self.assertEqual(result.status, 'stored')
+                self.assertEqual(await db.get_data(result.digest), b'new item')
+                self.assertTrue(await db.exists(result.digest))
+
+                with open(db.db.storage.path(digests[5]), 'wb') as fd:
+                    fd.write(b'damaged')
+                report = await db.scrub(batch_size=6, quarantine=True)
+                self.assertEqual(report.checked, 21)
+                self.assertEqual(
+                    [issue.digest for issue in report.issues], [digests[5]])
+                self.assertEqual(report.quarantined, [digests[5]])
+                self.assertFalse(await db.exists(digests[5]))
+
+                # putting a quarantined item again repairs it
+                self.assertEqual(
+                    await db.put_data('cat1', blobs[5]), digests[5])
+                self.assertTrue(await db.exists(digests[5]))
+                self.assertEqual(await db.get_data(digests[5]), blobs[5])
+                self.assertEqual(
+                    len(await db.query_occurrences(digests[5])), 2)
+                report = await db.scrub()
+                self.assertEqual(report.issues, [])
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_async_max_pending(self):
+        ''' check operations hold their slot from start to finish '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        active = [0]
+        peak = [0]
+        lock = threading.Lock()
+
+        async def run():
+            db = digestdb.AsyncDigestDB(
+                tempdir, dir_depth=1, max_workers=4, max_pending=2)
+            async with db:
+                await db.put_category('cat1')
+                digests = [
+                    await db.put_data('cat1', 'item {}'.format(i).encode())
+                    for i in range(12)]
+                encoding, read_data = db.db._encoding, db.db._read_data
+
+                # get_data looks up the encoding and then reads the item
+                def start(digest):
+                    with lock:
+                        active[0] += 1
+                        peak[0] = max(peak[0], active[0])
+                    return encoding(digest)
+
+                def finish(*args):
+                    time.sleep(0.01)
+                    with lock:
+                        active[0] -= 1
+                    return read_data(*args)
+
+                db.db._encoding, db.db._read_data = start, finish
+                results = await asyncio.gather(
+                    *[db.get_data(digest) for digest in digests])
+                self.assertEqual(
+                    results, ['item {}'.format(i).encode() for i in range(12)])
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+        self.assertEqual(active[0], 0)
+        self.assertEqual(peak[0], 2)
+
+    def test_async_get_data_many(self):
+        ''' check no more than the window of items is read at once '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        active = [0]
+        peak = [0]
+        lock = threading.Lock()
+
+        async def run():
+            db = digestdb.AsyncDigestDB(tempdir, dir_depth=1, max_workers=8)
+            async with db:
+                await db.put_category('cat1')
+                blobs = ['item {}'.format(i).encode() for i in range(30)]
+                digests = [await db.put_data('cat1', blob) for blob in blobs]
+                get_item = db.db._get_item
+
+                def read(*args):
+                    with lock:
+                        active[0] += 1
+                        peak[0] = max(peak[0], active[0])
+                    time.sleep(0.005)
+                    with lock:
+                        active[0] -= 1
+                    return get_item(*args)
+
+                db.db._get_item = read
+                results = await db.get_data_many(
+                    list(reversed(digests)) + [b'missing'], window=4)
+                self.assertEqual(
+                    [r.digest for r in results],
+                    list(reversed(digests)) + [b'missing'])
+                self.assertEqual(
+                    [r.data for r in results[:-1]], list(reversed(blobs)))
+                self.assertIsInstance(results[-1].error, FileNotFoundError)
+                self.assertLessEqual(peak[0], 4)
+                self.assertGreater(peak[0], 1)
+
+                self.assertEqual(await db.get_data_many([]), [])
+                with self.assertRaises(Exception) as cm:
+                    await db.get_data_many(digests, window=0)
+                self.assertIn('Invalid window', str(cm.exception))
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_async_collect_garbage(self):
+        ''' check retention policies can be enforced in the background '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        async def run():
+            db = digestdb.AsyncDigestDB(tempdir, dir_depth=1, max_workers=2)
+            async with db:
+                await db.put_category('cat1')
+                await db.set_retention('cat1', max_count=5)
+                self.assertEqual(
+                    await db.get_retention('cat1'), (None, None, 5))
+                for i in range(20):
+                    await db.put_data('cat1', 'old {}'.format(i).encode())
+
+                task = asyncio.ensure_future(
+                    db.collect_garbage(batch_size=4))
+                new = await db.put_data('cat1', b'new')
+                report = await task
+                self.assertGreaterEqual(report.occurrences, 15)
+                self.assertEqual(report.categories, ['cat1'])
+                self.assertEqual(
+                    await db.count_data(), 21 - report.occurrences)
+
+                # items added during a collection are counted by the next
+                await db.collect_garbage()
+                self.assertEqual(await db.count_data(), 5)
+                self.assertTrue(await db.exists(new))
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_async_retrain_dictionaries(self):
+        ''' check dictionaries can be retrained in the background '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        blobs = [
+            '{{"kind": "status", "id": {}, "source": "receiver", '
+            '"state": "nominal"}}'.format(i).encode()
+            for i in range(30)]
+
+        async def run():
+            db = digestdb.AsyncDigestDB(
+                tempdir, dir_depth=1, compression='zlib')
+            async with db:
+                await db.put_category('cat1')
+                digests = await asyncio.gather(
+                    *[db.put_data('cat1', blob) for blob in blobs])
+
+                task = asyncio.ensure_future(
+                    db.retrain_dictionaries(batch_size=7))
+                self.assertEqual(await db.get_data(digests[0]), blobs[0])
+                self.assertEqual(await task, {'cat1': 1})
+
+                results = await asyncio.gather(
+                    *[db.get_data(digest) for digest in digests])
+                self.assertEqual(results, blobs)
+                self.assertLess(
+                    db.db.storage.stat(digests[0]), len(blobs[0]))
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
@@ -0,0 +1,69 @@
+''' Tests for digestdb.bloom '''
+
+import os
+import shutil
+import tempfile
+
+import unittest
+
+import digestdb
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_bloom_membership(self):
+        ''' check added keys are always found and misses are mostly rejected '''
+        with self.assertRaises(Exception) as cm:
+            digestdb.bloom.BloomFilter(0)
+        expected = 'Invalid capacity'
+        self.assertIn(expected, str(cm.exception))
+
+        with self.assertRaises(Exception) as cm:
+            digestdb.bloom.BloomFilter(10, error_rate=1.5)
+        expected = 'Invalid error_rate'
+        self.assertIn(expected, str(cm.exception))
+
+        bf = digestdb.bloom.BloomFilter(1000, error_rate=0.01)
+        keys = [
+            digestdb.hashify.data_digest(str(i).encode())
+            for i in range(1000)]
+        bf.update(keys)
+        self.assertEqual(len(bf), 1000)
+        for key in keys:
+            self.assertIn(key, bf)
+
+        false_positives = sum(
+            digestdb.hashify.data_digest(str(-i).encode()) in bf
+            for i in range(1, 1001))
+        self.assertLess(false_positives, 50)
+
+        bf.add(b'short')
+        self.assertIn(b'short', bf)
+
+    def test_bloom_persistence(self):
+        ''' check a filter can be saved and loaded '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        try:
+            path = os.path.join(tempdir, 'test.bloom')
+            bf = digestdb.bloom.BloomFilter(100)
+            bf.add(b'deadbeef')
+            bf.save(path)
+
+            loaded = digestdb.bloom.BloomFilter.load(path)
+            self.assertIn(b'deadbeef', loaded)
+            self.assertEqual(loaded.count, 1)
+            self.assertEqual(loaded.bits, bf.bits)
+
+            with open(path, 'wb') as fd:
+                fd.write(b'garbage')
+            with self.assertRaises(Exception) as cm:
+                digestdb.bloom.BloomFilter.load(path)
+            expected = 'Invalid bloom filter file'
+            self.assertIn(expected, str(cm.exception))
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
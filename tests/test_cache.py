@@ -0,0 +1,50 @@
+''' Tests for digestdb.cache '''
+
+import unittest
+
+import digestdb
+from digestdb.cache import MISSING
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_cache_eviction(self):
+        ''' check least recently used entries are evicted '''
+        with self.assertRaises(Exception) as cm:
+            digestdb.cache.LRUCache(maxsize=0)
+        expected = 'Invalid maxsize'
+        self.assertIn(expected, str(cm.exception))
+
+        cache = digestdb.cache.LRUCache(maxsize=2)
+        cache.put(b'a', True)
+        cache.put(b'b', False)
+        self.assertIs(cache.get(b'a'), True)
+        cache.put(b'c', True)  # evicts b, the least recently used
+
+        self.assertIs(cache.get(b'b'), MISSING)
+        self.assertIs(cache.get(b'c'), True)
+        self.assertEqual(len(cache), 2)
+
+        cache.invalidate(b'c')
+        self.assertIs(cache.get(b'c', None), None)
+
+        info = cache.info()
+        self.assertEqual(info.hits, 2)
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.maxsize, 2)
+        self.assertEqual(info.currsize, 1)
+
+        cache.clear()
+        self.assertEqual(cache.info(), (0, 0, 2, 0))
+
+    def test_cache_ttl(self):
+        ''' check entries expire after their time to live '''
+        now = [100.0]
+        cache = digestdb.cache.LRUCache(
+            maxsize=10, ttl=5, clock=lambda: now[0])
+        cache.put(b'a', True)
+        now[0] += 4
+        self.assertIs(cache.get(b'a'), True)
+        now[0] += 2
+        self.assertIs(cache.get(b'a'), MISSING)
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,100 @@
+''' Tests for digestdb.compression '''
+
+import unittest
+
+import digestdb
+from digestdb.compression import (
+    FRAME_MAGIC, available_codecs, compress, decode, decompress, encode,
+    frame, iter_decode, iter_decompress, parse_frame, train_dictionary)
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def test_codecs_round_trip(self):
+        ''' check data survives compression with each available codec '''
+        data = b'abcdefgh' * 1000
+        self.assertIn('zlib', available_codecs())
+        for codec in available_codecs():
+            compressed = compress(data, codec)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(decompress(compressed, codec), data)
+
+            chunks = [compressed[i:i + 7] for i in range(0, len(compressed), 7)]
+            self.assertEqual(b''.join(iter_decompress(chunks, codec)), data)
+
+        with self.assertRaises(Exception) as cm:
+            digestdb.compression.get_codec('invalid')
+        expected = 'Unsupported compression codec: invalid'
+        self.assertIn(expected, str(cm.exception))
+
+    def test_encode(self):
+        ''' check encode only compresses data when worthwhile '''
+        data = b'abcdefgh' * 100
+        self.assertEqual(encode(data), (data, None))
+        self.assertEqual(encode(data, 'zlib', threshold=1000), (data, None))
+
+        stored, codec = encode(data, 'zlib', threshold=100)
+        self.assertEqual(codec, 'zlib')
+        self.assertEqual(decompress(stored, codec), data)
+
+        # incompressible data is stored as is
+        self.assertEqual(encode(b'\x00\xff', 'zlib'), (b'\x00\xff', None))
+
+        # unless it could be mistaken for a frame
+        data = FRAME_MAGIC + b'data'
+        stored, codec = encode(data)
+        self.assertEqual(codec, None)
+        self.assertEqual(parse_frame(stored), (13, None, None))
+        self.assertEqual(decode(stored), data)
+
+    def test_dictionary(self):
+        ''' check a trained dictionary improves compression of small items '''
+        samples = [
+            '{{"kind": "position", "id": {}, "status": "nominal"}}'.format(
+                i).encode() for i in range(50)]
+        dictionary = train_dictionary(samples, 'zlib', size=1024)
+        self.assertLessEqual(len(dictionary), 1024)
+
+        data = samples[0]
+        stored, codec = encode(data, 'zlib', dictionary=dictionary)
+        self.assertEqual(codec, 'zlib')
+        self.assertLess(len(stored), len(compress(data, 'zlib')))
+        self.assertEqual(
+            decompress(stored, 'zlib', dictionary=dictionary), data)
+
+        with self.assertRaises(Exception) as cm:
+            train_dictionary(samples, 'bz2')
+        expected = 'does not support dictionaries'
+        self.assertIn(expected, str(cm.exception))
+
+    def test_frames(self):
+        ''' check framed items are decoded as their header describes '''
+        dictionary = b'"kind": "position", "status": "nominal"'
+        data = b'{"kind": "position", "id": 1, "status": "nominal"}'
+        dictionaries = {7: dictionary}.get
+        stored = frame(
+            compress(data, 'zlib', dictionary=dictionary), 'zlib', 7)
+        self.assertEqual(parse_frame(stored), (17, 'zlib', 7))
+        self.assertIsNone(parse_frame(data))
+
+        # the encoding recorded for the item before it was framed is ignored
+        for codec in (None, 'zlib'):
+            self.assertEqual(
+                decode(stored, codec, dictionaries=dictionaries), data)
+            for size in (1, 5, 16, 1000):
+                chunks = [
+                    stored[i:i + size] for i in range(0, len(stored), size)]
+                self.assertEqual(
+                    b''.join(iter_decode(
+                        chunks, codec, dictionaries=dictionaries)), data)
+        self.assertEqual(decode(data), data)
+        self.assertEqual(decode(compress(data, 'zlib'), 'zlib'), data)
+        chunks = [data[:3], data[3:]]
+        self.assertEqual(list(iter_decode(chunks)), chunks)
+
+        with self.assertRaises(Exception) as cm:
+            decode(stored)
+        self.assertIn('Dictionary 7 is not available', str(cm.exception))
+        with self.assertRaises(Exception) as cm:
+            list(iter_decode([stored[:10]]))
+        self.assertIn('Invalid frame', str(cm.exception))
@@ -4,8 +4,15 @@ import datetime
 import os
 import random
 import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy.exc
+import sqlalchemy.orm
 import unittest
 import unittest.mock
 
@@ -58,24 +65,213 @@ class DigestDBTestCase(unittest.TestCase):
             db1.open()
             self.assertTrue(os.path.exists(db1.lock_file))
 
-            # attempt to open another db. It should detect the lock file
+            # attempt to open another db. It should detect the lock
             # and raise an exception.
             db2 = digestdb.DigestDB(tempdir)
             with self.assertRaises(Exception) as cm:
                 db2.open()
-            expected = 'Database is already open'
-            self.assertIn(expected, str(cm.exception))
+            expected = 'Database is already open for writing by process {}'
+            self.assertIn(expected.format(os.getpid()), str(cm.exception))
 
-            # close the first database, which should remove lock file
+            # close the first database, which should release the lock
             db1.close()
-            self.assertFalse(os.path.exists(db1.lock_file))
 
-            # Now try to open second db again. The lock file created
-            # by db1 should be gone, expect no exceptions.
+            # Now try to open second db again. The lock released by db1
+            # can be acquired, expect no exceptions.
             db2.open()
-            self.assertTrue(os.path.exists(db1.lock_file))
             db2.close()
-            self.assertFalse(os.path.exists(db1.lock_file))
+
+            # a lock file left by a process that crashed is not a lock
+            with open(db1.lock_file, 'w') as fd:
+                fd.write('999999')
+            db1.open()
+            self.assertEqual(db1._write_lock.stale_owner, 999999)
+            db1.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_read_only(self):
+        ''' check readers can open a database alongside a writer '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        try:
+            reader = digestdb.DigestDB(
+                tempdir, dir_depth=1, pack_threshold=10, cache_size=10,
+                cache_ttl=0)
+            with self.assertRaises(Exception) as cm:
+                reader.open(read_only=True)
+            self.assertIn('Database file not found', str(cm.exception))
+
+            writer = digestdb.DigestDB(
+                tempdir, dir_depth=1, pack_threshold=10, bloom_capacity=100,
+                compression='zlib', compression_threshold=10)
+            writer.open()
+            writer.put_category('cat1')
+            digest = writer.put_data('cat1', b'abc' * 100)
+
+            readers = [
+                digestdb.DigestDB(
+                    tempdir, dir_depth=1, pack_threshold=10, cache_size=10,
+                    cache_ttl=0)
+                for _ in range(2)]
+            for db in readers:
+                db.open(read_only=True)
+                self.assertIsNone(db.bloom)
+                self.assertEqual(db.get_data(digest), b'abc' * 100)
+
+            # readers see what the writer commits after they opened
+            packed = writer.put_data('cat1', b'small')
+            stored = writer.put_data('cat1', b'compressed' * 100)
+            for db in readers:
+                self.assertTrue(db.exists(packed))
+                self.assertEqual(db.get_data(packed), b'small')
+                self.assertEqual(db.get_data(stored), b'compressed' * 100)
+                self.assertEqual(len(db.query_data(category='cat1')), 3)
+
+            reader = readers[0]
+            with self.assertRaises(Exception) as cm:
+                reader.put_data('cat1', b'new data')
+            self.assertIn('Storage is read only', str(cm.exception))
+            with self.assertRaises(Exception):
+                reader.put_category('cat2')
+            with self.assertRaises(Exception):
+                reader.delete_data(digest)
+            self.assertTrue(writer.exists(digest))
+            with self.assertRaises(Exception) as cm:
+                digestdb.DigestDB(tempdir).open(
+                    read_only=True, bulk_load=True)
+            self.assertIn('can not be bulk loaded', str(cm.exception))
+
+            for db in readers:
+                db.close()
+                self.assertNotIsInstance(
+                    db.storage, digestdb.storage.ReadOnlyStorage)
+            writer.close()
+            self.assertTrue(os.path.exists(writer.bloom_file))
+
+            # a writer can not migrate the schema while readers are open
+            reader.open(read_only=True)
+            conn = sqlite3.connect(reader.filename)
+            conn.execute('PRAGMA user_version = 1')
+            conn.close()
+            with self.assertRaises(Exception) as cm:
+                writer.open()
+            self.assertIn('open by readers', str(cm.exception))
+            reader.close()
+            with self.assertRaises(Exception) as cm:
+                reader.open(read_only=True)
+            self.assertIn('Open the database for writing', str(cm.exception))
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_thread_safe(self):
+        ''' check a database can be shared by a pool of threads '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        try:
+            db = digestdb.DigestDB(
+                tempdir, dir_depth=1, thread_safe=True, pool_size=4,
+                cache_size=100, bloom_capacity=1000)
+            db.open()
+            db.put_category('cat1')
+            blobs = ['item {}'.format(i).encode() * 10 for i in range(100)]
+            sessions = []
+
+            def put(blob):
+                sessions.append((db.session(), threading.get_ident()))
+                digest = db.put_data('cat1', blob)
+                self.assertEqual(db.get_data(digest), blob)
+                self.assertTrue(db.exists(digest))
+                db.release_session()
+                return digest
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                digests = list(executor.map(put, blobs))
+                # each session is only ever used by one thread
+                owners = {}
+                for session, thread in sessions:
+                    self.assertEqual(
+                        owners.setdefault(id(session), thread), thread)
+                self.assertEqual(len(owners), 100)
+                self.assertEqual(db.count_data(), 100)
+
+                # readers and a writer working at the same time
+                def read(digest):
+                    data = db.get_data(digest)
+                    count = len(db.query_data(category='cat1'))
+                    db.release_session()
+                    return data, count
+
+                reads = executor.map(read, digests[10:] * 2)
+                db.delete_data_many(digests[:10])
+                for data, count in reads:
+                    self.assertIn(count, (90, 100))
+            self.assertEqual(db.count_data(), 90)
+            self.assertEqual(db.engine.pool.checkedout(), 1)
+            db.close()
+
+            # without thread safe mode every thread shares one session
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+            self.assertIsInstance(
+                db.session, sqlalchemy.orm.session.Session)
+            db.release_session()
+            self.assertEqual(db.engine.pool.checkedout(), 0)
+            self.assertEqual(db.get_data(digests[50]), blobs[50])
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_thread_safe_overflow(self):
+        ''' check more threads than pooled connections can hold sessions '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        try:
+            db = digestdb.DigestDB(
+                tempdir, dir_depth=1, thread_safe=True, pool_size=3,
+                pool_timeout=1.0)
+            db.open()
+            db.put_category('cat1')
+            barrier = threading.Barrier(10)
+
+            def put(i):
+                # sessions are never released so each thread keeps a
+                # connection checked out
+                blob = 'item {}'.format(i).encode()
+                digest = db.put_data('cat1', blob)
+                self.assertEqual(db.get_data(digest), blob)
+                self.assertTrue(db.exists(digest))
+                barrier.wait(timeout=10)
+                checkedout = db.engine.pool.checkedout()
+                barrier.wait(timeout=10)
+                return digest, checkedout
+
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                results = list(executor.map(put, range(10)))
+            self.assertGreater(min(count for _, count in results), 3)
+            self.assertEqual(db.count_data(), 10)
+            db.close()
+            self.assertIsNone(db.engine)
+
+            db = digestdb.DigestDB(tempdir, dir_depth=1, pool_size=1)
+            db.open()
+            for i, (digest, _) in enumerate(results):
+                self.assertEqual(
+                    db.get_data(digest), 'item {}'.format(i).encode())
+            db.close()
+
+            # a limited overflow raises once it is exhausted
+            db = digestdb.DigestDB(
+                tempdir, dir_depth=1, thread_safe=True, pool_size=1,
+                max_overflow=0, pool_timeout=0.1)
+            db.open()
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                with self.assertRaises(sqlalchemy.exc.TimeoutError):
+                    executor.submit(db.count_data).result()
+            db.close()
 
         finally:
             if os.path.isdir(tempdir):
@@ -234,3 +430,862 @@ class DigestDBTestCase(unittest.TestCase):
         finally:
             if os.path.isdir(tempdir):
                 shutil.rmtree(tempdir)
+
+    def test_database_put_data_batch(self):
+        ''' check items can be added in bulk with per-item results '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+
+            categories = ('cat1', 'cat2')
+            for cat in categories:
+                db.put_category(cat)
+
+            existing = db.put_data('cat1', data)
+
+            def generate_items():
+                for i in range(25):
+                    yield create_data_item(categories, timestamp=bool(i % 2))
+                yield ('cat2', data, None)  # already in the database
+                yield ('cat2', b'repeated', None)
+                yield ('cat2', b'repeated', None)  # duplicate within batch
+                yield ('cat2', 'not bytes', None)
+
+            results = db.put_data_batch(generate_items(), batch_size=10)
+            self.assertEqual(len(results), 29)
+
+            statuses = [r.status for r in results]
+            self.assertEqual(statuses.count(digestdb.database.PUT_STORED), 26)
+            self.assertEqual(results[25].digest, existing)
+            self.assertEqual(
+                results[25].status, digestdb.database.PUT_DUPLICATE)
+            self.assertEqual(
+                results[27].status, digestdb.database.PUT_DUPLICATE)
+            self.assertEqual(results[28].status, digestdb.database.PUT_FAILED)
+            self.assertIsInstance(results[28].error, Exception)
+
+            self.assertEqual(db.count_data(), 27)
+            self.assertEqual(db.get_data(results[26].digest), b'repeated')
+            for result in results[:25]:
+                self.assertTrue(db.exists(result.digest))
+
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_put_data_dedup(self):
+        ''' check storing duplicates is not an error '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1, bloom_capacity=100)
+            db.open()
+            db.put_category('cat1')
+            db.put_category('cat2')
+            ts = datetime.datetime(2020, 1, 1)
+
+            result = db.put_data_dedup('cat1', data, timestamp=ts)
+            self.assertEqual(result.status, digestdb.database.PUT_STORED)
+            digest = result.digest
+            self.assertEqual(db.get_data(digest), data)
+
+            later = datetime.datetime(2020, 1, 2)
+            with unittest.mock.patch.object(db.storage, 'put') as put:
+                result = db.put_data_dedup('cat1', data)
+                self.assertEqual(
+                    result, (digest, digestdb.database.PUT_DUPLICATE, None))
+                result = db.put_data_dedup(
+                    'cat2', data, timestamp=later, digest=digest,
+                    reference=True)
+                self.assertEqual(
+                    result.status, digestdb.database.PUT_DUPLICATE)
+                self.assertFalse(put.called)
+            self.assertEqual(
+                db.query_occurrences(digest), [('cat1', ts), ('cat2', later)])
+            self.assertEqual(db.query_occurrences(b'missing'), [])
+            self.assertEqual(db.count_data(), 1)
+
+            # an item left in storage by a failed put is rewritten
+            orphan = b'orphaned data'
+            orphan_digest = digestdb.hashify.data_digest(orphan)
+            db.storage.put(orphan_digest, b'stale')
+            result = db.put_data_dedup('cat1', orphan)
+            self.assertEqual(result.status, digestdb.database.PUT_STORED)
+            self.assertEqual(db.get_data(orphan_digest), orphan)
+
+            items = [('cat1', data, later), ('cat2', b'new', None),
+                     ('cat2', b'new', later)]
+            results = db.put_data_batch(items, reference=True)
+            self.assertEqual(
+                [r.status for r in results],
+                [digestdb.database.PUT_DUPLICATE, digestdb.database.PUT_STORED,
+                 digestdb.database.PUT_DUPLICATE])
+            self.assertEqual(len(db.query_occurrences(digest)), 3)
+            self.assertEqual(
+                [c for c, t in db.query_occurrences(results[1].digest)],
+                ['cat2', 'cat2'])
+
+            db.delete_data(digest)
+            self.assertEqual(db.query_occurrences(digest), [])
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_reference_counts(self):
+        ''' check shared items are kept until their last occurrence goes '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+            db.put_category('cat1')
+            db.put_category('cat2')
+            ts = datetime.datetime(2020, 1, 1)
+
+            shared = db.put_data_dedup('cat1', b'shared', timestamp=ts).digest
+            db.put_data_dedup('cat2', b'shared', reference=True)
+            db.put_data_dedup('cat2', b'shared', reference=True)
+            single = db.put_data('cat1', b'single')
+            self.assertEqual(db.count_data(), 2)
+            self.assertEqual(
+                [r.digest for r in db.query_data(category='cat2')],
+                [shared, shared])
+
+            result = db.delete_data_many([shared], category='cat2')
+            self.assertEqual(result, (2, 0, 0))
+            self.assertTrue(db.exists(shared))
+            self.assertEqual(db.query_occurrences(shared), [('cat1', ts)])
+            self.assertEqual(list(db.query_data(category='cat2')), [])
+
+            # an item whose other occurrences are gone is removed
+            result = db.delete_data_many([shared, single, b'missing'])
+            self.assertEqual(result, (2, 2, 12))
+            self.assertFalse(db.exists(shared))
+            self.assertFalse(db.exists(single))
+            self.assertEqual(list(db.storage.digests()), [])
+            self.assertEqual(db.count_data(), 0)
+            self.assertEqual(
+                db.delete_data_many([shared]), (0, 0, 0))
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_put_data_batch_executor(self):
+        ''' check bulk ingest works with thread and process pools '''
+        for kind in ('thread', 'process'):
+            tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+            executor = digestdb.database.create_executor(kind, max_workers=2)
+            try:
+                db = digestdb.DigestDB(
+                    tempdir, dir_depth=1, executor=executor)
+                db.open()
+
+                categories = ('cat1', 'cat2')
+                for cat in categories:
+                    db.put_category(cat)
+
+                items = [create_data_item(categories) for i in range(20)]
+                items.append(items[0])
+                items.append(('cat1', 'not bytes', None))
+                results = db.put_data_batch(items)
+
+                statuses = [r.status for r in results]
+                self.assertEqual(
+                    statuses.count(digestdb.database.PUT_STORED), 20)
+                self.assertEqual(
+                    results[20].status, digestdb.database.PUT_DUPLICATE)
+                self.assertEqual(
+                    results[21].status, digestdb.database.PUT_FAILED)
+                self.assertEqual(db.count_data(), 20)
+                self.assertEqual(db.get_data(results[5].digest), items[5][1])
+
+                db.close()
+
+            finally:
+                executor.shutdown()
+                if os.path.isdir(tempdir):
+                    shutil.rmtree(tempdir)
+
+        with self.assertRaises(Exception) as cm:
+            digestdb.database.create_executor('fibre')
+        expected = 'Invalid executor kind'
+        self.assertIn(expected, str(cm.exception))
+
+    def test_database_zero_copy_reads(self):
+        ''' check data can be read via views, file objects and buffers '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+            db.put_category('cat1')
+
+            _cat, blob, _ts = create_data_item(['cat1'], max_size=5000)
+            digest = db.put_data('cat1', blob)
+            empty_digest = db.put_data('cat1', b'')
+
+            view = db.get_data_view(digest)
+            self.assertIsInstance(view, memoryview)
+            self.assertEqual(view, blob)
+            self.assertEqual(bytes(view[10:20]), blob[10:20])
+            view.release()
+            self.assertEqual(db.get_data_view(empty_digest), b'')
+
+            with db.open_data(digest) as fd:
+                self.assertEqual(fd.read(), blob)
+
+            buffer = bytearray(len(blob) + 100)
+            count = db.read_into(digest, buffer)
+            self.assertEqual(count, len(blob))
+            self.assertEqual(buffer[:count], blob)
+
+            with self.assertRaises(Exception) as cm:
+                db.read_into(digest, bytearray(10))
+            self.assertIn('Buffer too small', str(cm.exception))
+
+            with self.assertRaises(OSError):
+                db.get_data_view(b'deadbeef')
+
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_streams(self):
+        ''' check streams and files can be added without buffering '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+            db.put_category('cat1')
+
+            blob = os.urandom(3 * 1024 + 17)
+            filepath = os.path.join(tempdir, 'tmp_file')
+            with open(filepath, 'wb') as fd:
+                fd.write(blob)
+
+            # file object source
+            with open(filepath, 'rb') as fd:
+                digest = db.put_stream('cat1', fd, chunk_size=1000)
+            self.assertEqual(digest, digestdb.hashify.data_digest(blob))
+            self.assertEqual(db.get_data(digest), blob)
+            self.assertEqual(db.query_data()[0][2], len(blob))
+
+            # duplicates are detected and the temporary file removed
+            with self.assertRaises(Exception) as cm:
+                db.put_stream('cat1', [blob[:10], blob[10:]])
+            self.assertIn('Duplicate file detected', str(cm.exception))
+            self.assertEqual(
+                [n for n in os.listdir(db.data_dir)
+                 if n.startswith(digestdb.database.TEMP_FILE_PREFIX)], [])
+
+            # iterable source
+            digest = db.put_stream('cat1', (bytes([i]) * 100 for i in range(5)))
+            self.assertEqual(len(db.get_data(digest)), 500)
+
+            # files are copied, or linked, into the database
+            db.delete_data(digestdb.hashify.data_digest(blob))
+            digest = db.put_file('cat1', filepath)
+            self.assertEqual(db.get_data(digest), blob)
+            db.delete_data(digest)
+            digest = db.put_file('cat1', filepath, link=True)
+            self.assertEqual(db.get_data(digest), blob)
+            self.assertEqual(db.count_data(), 2)
+
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_exists_cache(self):
+        ''' check the existence cache is kept coherent with the database '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1, cache_size=100)
+            db.open()
+            db.put_category('cat1')
+
+            missing = digestdb.hashify.data_digest(data)
+            self.assertFalse(db.exists(missing))
+            self.assertFalse(db.exists(missing))
+            self.assertEqual(db.cache_info().hits, 1)
+
+            digest = db.put_data('cat1', data)
+            self.assertEqual(digest, missing)
+            self.assertTrue(db.exists(digest))
+
+            results = db.put_data_batch([('cat1', b'batched', None)])
+            self.assertTrue(db.exists(results[0].digest))
+
+            db.delete_data(digest)
+            self.assertFalse(db.exists(digest))
+
+            info = db.cache_info()
+            self.assertEqual(info.hits, 4)
+            self.assertEqual(info.misses, 1)
+
+            db.close()
+
+            self.assertIsNone(digestdb.DigestDB(tempdir).cache_info())
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_bloom_filter(self):
+        ''' check the bloom filter is maintained, persisted and rebuilt '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1, bloom_capacity=100)
+            db.open()
+            db.put_category('cat1')
+            digest = db.put_data('cat1', data)
+            results = db.put_data_batch([('cat1', b'batched', None)])
+            self.assertIn(digest, db.bloom)
+            self.assertIn(results[0].digest, db.bloom)
+            self.assertTrue(db.exists(digest))
+
+            # definite misses are answered without querying the database
+            with unittest.mock.patch.object(db, 'session') as session:
+                self.assertFalse(db.exists(b'not stored'))
+                self.assertFalse(session.query.called)
+
+            db.close()
+            self.assertTrue(os.path.exists(db.bloom_file))
+
+            # the saved filter is loaded, and removed until the next close
+            db.open()
+            self.assertFalse(os.path.exists(db.bloom_file))
+            self.assertIn(digest, db.bloom)
+            self.assertTrue(db.exists(results[0].digest))
+            db.close()
+
+            # a database opened without the filter discards the saved one
+            # and the filter is rebuilt from the digests table next time.
+            plain = digestdb.DigestDB(tempdir, dir_depth=1)
+            plain.open()
+            added = plain.put_data('cat1', b'unfiltered')
+            plain.close()
+            self.assertFalse(os.path.exists(db.bloom_file))
+
+            db.open()
+            self.assertTrue(db.exists(added))
+            self.assertEqual(db.bloom.count, 3)
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_query_data_filters(self):
+        ''' check query filters, ordering and pagination '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+            for label in ('cat1', 'cat2', 'cat3'):
+                db.put_category(label)
+
+            start = datetime.datetime(2016, 8, 1)
+            items = []
+            for i in range(30):
+                category = ('cat1', 'cat2', 'cat3')[i % 3]
+                data = 'item {}'.format(i).encode() * (i + 1)
+                # pairs of items share a timestamp to exercise the digest
+                # tie breaker used by pagination.
+                timestamp = start + datetime.timedelta(seconds=i // 2)
+                digest = db.put_data(category, data, timestamp=timestamp)
+                items.append((digest, category, len(data), timestamp, i + 1))
+
+            def expected(predicate, reverse=False):
+                return sorted(
+                    (item for item in items if predicate(item)),
+                    key=lambda item: (item[3], item[0], item[4]),
+                    reverse=reverse)
+
+            since = start + datetime.timedelta(seconds=3)
+            until = start + datetime.timedelta(seconds=10)
+            self.assertEqual(
+                db.query_data(
+                    category=['cat1', 'cat3'], since=since, until=until,
+                    order='asc'),
+                expected(lambda i: i[1] != 'cat2' and since <= i[3] < until))
+            self.assertEqual(
+                db.query_data(min_size=50, max_size=100, order='desc'),
+                expected(lambda i: 50 <= i[2] <= 100, reverse=True))
+
+            rows = db.query_data(category='cat2', order='asc', limit=2)
+            self.assertEqual(len(rows), 2)
+            self.assertEqual(rows[0].category_label, 'cat2')
+
+            for order in ('asc', 'desc'):
+                pages = []
+                after = None
+                while True:
+                    page = db.query_data(order=order, limit=4, after=after)
+                    if not page:
+                        break
+                    pages.extend(page)
+                    last = page[-1]
+                    after = (last.timestamp, last.digest, last.occurrence_id)
+                self.assertEqual(
+                    pages, expected(lambda i: True, reverse=order == 'desc'))
+
+            # occurrences of an item sharing a timestamp are ordered by id
+            # and are not skipped between pages
+            for category in ('cat1', 'cat2', 'cat3'):
+                digest = db.put_data_dedup(
+                    category, b'repeated', timestamp=start,
+                    reference=True).digest
+                items.append((digest, category, 8, start, len(items) + 1))
+            for order in ('asc', 'desc'):
+                pages = []
+                after = None
+                while True:
+                    page = db.query_data(order=order, limit=2, after=after)
+                    if not page:
+                        break
+                    pages.extend(page)
+                    last = page[-1]
+                    after = (last.timestamp, last.digest, last.occurrence_id)
+                self.assertEqual(
+                    pages, expected(lambda i: True, reverse=order == 'desc'))
+            ties = [row for row in db.query_data(order='asc')
+                    if row.digest == digest]
+            self.assertEqual(
+                [row.category_label for row in ties], ['cat1', 'cat2', 'cat3'])
+            # a 2-tuple skips every occurrence of the item at the timestamp
+            self.assertNotIn(
+                digest, [row.digest for row in db.query_data(
+                    order='asc', after=(start, digest))])
+
+            with self.assertRaises(Exception) as cm:
+                db.query_data(after=(start,))
+            self.assertIn('Invalid after', str(cm.exception))
+
+            # the iterator variant streams the same rows
+            rows = db.iter_query_data(batch_size=4, order='asc')
+            self.assertEqual(next(rows), expected(lambda i: True)[0])
+            self.assertEqual(len(list(rows)), len(items) - 1)
+            self.assertEqual(
+                list(db.iter_query_category(batch_size=2)),
+                db.query_category())
+
+            with self.assertRaises(Exception) as cm:
+                db.iter_query_data(categroy='cat1')
+            self.assertIn('Unsupported query filter', str(cm.exception))
+
+            with self.assertRaises(Exception) as cm:
+                db.query_data(categroy='cat1')
+            self.assertIn('Unsupported query filter: categroy', str(cm.exception))
+
+            with self.assertRaises(Exception) as cm:
+                db.query_data(order='sideways')
+            self.assertIn('Invalid order', str(cm.exception))
+
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_get_data_many(self):
+        ''' check many data items can be fetched at once '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(
+                tempdir, dir_depth=1, pack_threshold=50, compression='zlib',
+                compression_threshold=100)
+            db.open()
+            db.put_category('cat1')
+
+            blobs = {}
+            for i in range(40):
+                data = 'item {}'.format(i).encode() * (i + 1)
+                blobs[db.put_data('cat1', data)] = data
+            requested = list(blobs)
+            random.shuffle(requested)
+            missing = digestdb.hashify.data_digest(b'missing')
+
+            results = list(db.get_data_many(
+                requested + [missing] + requested[:5]))
+            self.assertEqual(
+                [r.digest for r in results], requested + [missing])
+            for digest, data, error in results[:-1]:
+                self.assertEqual(data, blobs[digest])
+                self.assertIsNone(error)
+            self.assertIsNone(results[-1].data)
+            self.assertIsInstance(results[-1].error, FileNotFoundError)
+
+            results = list(db.get_data_many(requested, ordered=False))
+            self.assertEqual(
+                dict((r.digest, r.data) for r in results), blobs)
+            self.assertEqual(list(db.get_data_many([])), [])
+
+            # no more than the window of items is read ahead of the consumer
+            started = []
+            get_item = db._get_item
+
+            def counted(digest, *encoding):
+                started.append(digest)
+                return get_item(digest, *encoding)
+
+            for ordered in (True, False):
+                del started[:]
+                with unittest.mock.patch.object(
+                        db, '_get_item', side_effect=counted):
+                    results = []
+                    for result in db.get_data_many(
+                            requested, ordered=ordered, window=6):
+                        results.append(result)
+                        self.assertLessEqual(len(started), len(results) + 6)
+                self.assertEqual(len(started), 40)
+                if ordered:
+                    self.assertEqual([r.digest for r in results], requested)
+                self.assertEqual(
+                    dict((r.digest, r.data) for r in results), blobs)
+
+            with self.assertRaises(Exception) as cm:
+                db.get_data_many(requested, window=0)
+            self.assertIn('Invalid window', str(cm.exception))
+
+            # pack items are read in pack file order, file items by path
+            order = db.storage.read_order(requested)
+            packed = [d for d in order if db.packs.exists(d)]
+            self.assertEqual(
+                packed,
+                sorted(packed, key=lambda d: db.packs.locate(d).offset))
+            self.assertEqual(
+                order[len(packed):], sorted(set(requested) - set(packed)))
+
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_replay(self):
+        ''' check data items are replayed in timestamp order '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+            db.put_category('cat1')
+            db.put_category('cat2')
+
+            start = datetime.datetime(2016, 8, 1)
+            items = []
+            # added out of order to check the replay is in timestamp order
+            for i in reversed(range(50)):
+                category = 'cat1' if i % 2 else 'cat2'
+                timestamp = start + datetime.timedelta(milliseconds=i)
+                data = 'message {}'.format(i).encode()
+                db.put_data(category, data, timestamp=timestamp)
+                items.append((timestamp, category, data))
+            items.sort()
+
+            self.assertEqual(list(db.replay(window=4, workers=2)), items)
+            until = start + datetime.timedelta(milliseconds=20)
+            self.assertEqual(
+                list(db.replay(category='cat1', since=start, until=until)),
+                [item for item in items if item[1] == 'cat1' and item[0] < until])
+
+            # items are paced by their timestamps, 49ms at double speed
+            t0 = time.monotonic()
+            replayed = list(db.replay(speed=2.0))
+            self.assertGreaterEqual(time.monotonic() - t0, 0.049 / 2)
+            self.assertEqual(replayed, items)
+
+            # stopping part way through releases the read ahead pool
+            replay = db.replay(window=8)
+            self.assertEqual(next(replay), items[0])
+            replay.close()
+
+            with self.assertRaises(Exception) as cm:
+                db.replay(window=0)
+            self.assertIn('Invalid window', str(cm.exception))
+
+            with self.assertRaises(Exception) as cm:
+                db.replay(speed=0)
+            self.assertIn('Invalid speed', str(cm.exception))
+
+            with self.assertRaises(Exception) as cm:
+                db.replay(order='desc')
+            self.assertNotIsInstance(cm.exception, TypeError)
+            self.assertIn('Invalid filter', str(cm.exception))
+
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_compression(self):
+        ''' check data items are compressed and decompressed transparently '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            with self.assertRaises(Exception) as cm:
+                digestdb.DigestDB(tempdir, compression='invalid')
+            expected = 'Unsupported compression codec'
+            self.assertIn(expected, str(cm.exception))
+
+            db = digestdb.DigestDB(
+                tempdir, dir_depth=1, compression='zlib',
+                compression_threshold=100)
+            db.open()
+            db.put_category('cat1')
+
+            data = b'compressible' * 1000
+            digest = db.put_data('cat1', data)
+            small = db.put_data('cat1', b'small')
+            self.assertEqual(digest, digestdb.hashify.data_digest(data))
+            self.assertLess(db.storage.stat(digest), len(data))
+            self.assertEqual(db.storage.stat(small), 5)
+
+            results = db.put_data_batch([
+                ('cat1', b'batched' * 1000, None),
+                ('cat1', b'tiny', None)])
+            self.assertEqual(
+                [r.status for r in results], ['stored', 'stored'])
+            self.assertLess(db.storage.stat(results[0].digest), 7000)
+
+            self.assertEqual(db.get_data(digest), data)
+            self.assertEqual(db.get_data(small), b'small')
+            self.assertEqual(db.get_data_view(digest), data)
+            with db.open_data(digest) as fd:
+                self.assertEqual(fd.read(), data)
+            buffer = bytearray(len(data))
+            self.assertEqual(db.read_into(digest, buffer), len(data))
+            self.assertEqual(buffer, data)
+            self.assertEqual(
+                b''.join(db.iter_data(digest, chunk_size=100)), data)
+            self.assertEqual(
+                db.get_data(results[0].digest), b'batched' * 1000)
+
+            sizes = dict(
+                (row.digest, row.byte_size)
+                for row in db.query_data(category='cat1'))
+            self.assertEqual(sizes[digest], len(data))
+            db.close()
+
+            # Compressed items are still readable when compression is
+            # no longer configured.
+            db = digestdb.DigestDB(tempdir, dir_depth=1)
+            db.open()
+            self.assertEqual(db.get_data(digest), data)
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_compression_dictionaries(self):
+        ''' check category dictionaries are trained and used '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        def message(i):
+            return (
+                '{{"kind": "position", "id": {}, "status": "ok", '
+                '"source": "receiver"}}'.format(i).encode())
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1, compression='zlib')
+            db.open()
+            db.put_category('cat1')
+            db.put_category('cat2')
+
+            with self.assertRaises(Exception) as cm:
+                db.train_dictionary('cat1')
+            expected = 'Not enough data items'
+            self.assertIn(expected, str(cm.exception))
+
+            old = [db.put_data('cat1', message(i)) for i in range(20)]
+            size = db.storage.stat(old[0])
+            self.assertEqual(size, len(message(0)))  # below the threshold
+
+            self.assertEqual(db.train_dictionary('cat1'), 1)
+            self.assertEqual(db.query_dictionaries(), [
+                ('cat1', 1, 'zlib', db.query_dictionaries()[0][3])])
+
+            new = db.put_data('cat1', message(100))
+            self.assertLess(db.storage.stat(new), len(message(100)))
+            self.assertEqual(db.get_data(new), message(100))
+            results = db.put_data_batch([('cat1', message(101), None)])
+            self.assertLess(
+                db.storage.stat(results[0].digest), len(message(101)))
+
+            # recompressing rewrites the items stored without the dictionary
+            self.assertEqual(db.retrain_dictionaries(), {'cat1': 2})
+            self.assertLess(db.storage.stat(old[0]), size)
+            for i, digest in enumerate(old):
+                self.assertEqual(db.get_data(digest), message(i))
+            self.assertEqual(
+                b''.join(db.iter_data(new, chunk_size=8)), message(100))
+            # version 1 is no longer used so it was removed
+            self.assertEqual(
+                [row[:2] for row in db.query_dictionaries('cat1')],
+                [('cat1', 2)])
+            self.assertEqual(db.recompress_category('cat1'), 0)
+            db.close()
+
+            # dictionaries are reloaded when the database is reopened
+            db = digestdb.DigestDB(tempdir, dir_depth=1, compression='zlib')
+            db.open()
+            self.assertEqual(db.get_data(old[0]), message(0))
+            digest = db.put_data('cat1', message(200))
+            self.assertLess(db.storage.stat(digest), len(message(200)))
+            db.close()
+
+            with self.assertRaises(Exception) as cm:
+                db = digestdb.DigestDB(tempdir, compression='bz2')
+                db.open()
+                try:
+                    db.train_dictionary('cat1')
+                finally:
+                    db.close()
+            expected = 'supports dictionaries'
+            self.assertIn(expected, str(cm.exception))
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_recompress_concurrent_reads(self):
+        ''' check items are readable while they are recompressed '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        def message(i):
+            return (
+                '{{"kind": "position", "id": {}, "status": "ok", '
+                '"source": "receiver"}}'.format(i).encode())
+
+        try:
+            db = digestdb.DigestDB(
+                tempdir, dir_depth=1, compression='zlib', thread_safe=True)
+            db.open()
+            db.put_category('cat1')
+            # stored uncompressed as they are below the threshold
+            digests = [db.put_data('cat1', message(i)) for i in range(40)]
+            stale = dict((d, db._encoding(d)) for d in digests)
+            self.assertEqual(set(stale.values()), {(None, None)})
+
+            def check(digest, i):
+                data = message(i)
+                self.assertEqual(db.get_data(digest), data)
+                self.assertEqual(bytes(db.get_data_view(digest)), data)
+                with db.open_data(digest) as fd:
+                    self.assertEqual(fd.read(), data)
+                buffer = bytearray(len(data))
+                self.assertEqual(db.read_into(digest, buffer), len(data))
+                self.assertEqual(bytes(buffer), data)
+                self.assertEqual(
+                    b''.join(db.iter_data(digest, chunk_size=5)), data)
+                # metadata looked up before the item was recompressed
+                self.assertEqual(
+                    db._read_data(digest, *stale[digest]), data)
+
+            # the process is killed before the metadata is updated
+            db.retrain_dictionaries(recompress=False)
+            with unittest.mock.patch.object(
+                    db, '_update_encodings', side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    db.recompress_category('cat1')
+            self.assertEqual(db._encoding(digests[0]), (None, None))
+            self.assertLess(db.storage.stat(digests[0]), len(message(0)))
+            for i, digest in enumerate(digests):
+                check(digest, i)
+            self.assertEqual(db.scrub().issues, [])
+            self.assertEqual(db.recompress_category('cat1'), 40)
+
+            # readers racing the recompression of every item
+            stop = threading.Event()
+            errors = []
+
+            def read():
+                reads = 0
+                while not stop.is_set() or reads == 0:
+                    for i, digest in enumerate(digests):
+                        try:
+                            check(digest, i)
+                        except Exception as exc:
+                            errors.append(exc)
+                    reads += 1
+                db.release_session()
+                return reads
+
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                readers = [executor.submit(read) for _ in range(3)]
+                for _ in range(3):
+                    db.retrain_dictionaries(batch_size=3)
+                stop.set()
+                self.assertTrue(all(r.result() > 0 for r in readers))
+            self.assertEqual(errors, [])
+            self.assertEqual(
+                [row[:2] for row in db.query_dictionaries('cat1')],
+                [('cat1', 4)])
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_database_pack_files(self):
+        ''' check small items are stored in pack files '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+        try:
+            db = digestdb.DigestDB(tempdir, dir_depth=1, pack_threshold=100)
+            db.open()
+            db.put_category('cat1')
+
+            small = db.put_data('cat1', b'small')
+            large = db.put_data('cat1', b'large' * 100)
+            self.assertTrue(db.packs.exists(small))
+            self.assertFalse(db.packs.exists(large))
+            self.assertEqual(db.get_data(small), b'small')
+            self.assertEqual(db.get_data(large), b'large' * 100)
+
+            results = db.put_data_batch([
+                ('cat1', b'tiny', None),
+                ('cat1', b'huge' * 100, None),
+                ('cat1', b'tiny', None)])
+            self.assertEqual(
+                [r.status for r in results],
+                ['stored', 'stored', 'duplicate'])
+            self.assertTrue(db.packs.exists(results[0].digest))
+
+            self.assertTrue(db.exists(small))
+            self.assertEqual(db.get_data_view(small), b'small')
+            with db.open_data(small) as fd:
+                self.assertEqual(fd.read(), b'small')
+            buffer = bytearray(10)
+            self.assertEqual(db.read_into(small, buffer), 5)
+            self.assertEqual(b''.join(db.iter_data(small, chunk_size=2)), b'small')
+
+            db.delete_data(small)
+            self.assertFalse(db.exists(small))
+            self.assertEqual(db.count_data(), 3)
+            self.assertEqual(db.compact(min_dead_ratio=0.1), 0)  # active pack
+
+            db.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
@@ -0,0 +1,145 @@
+''' Tests for digestdb.gc '''
+
+import datetime
+import os
+import shutil
+import tempfile
+
+import unittest
+import unittest.mock
+
+import digestdb
+from digestdb.gc import Collector, RetentionPolicy
+from digestdb.scrub import RateLimiter
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class GarbageCollectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        self.db = digestdb.DigestDB(self.tempdir, dir_depth=1, cache_size=100)
+        self.db.open()
+        self.db.put_category('cat1')
+        self.db.put_category('cat2')
+        # ten items of ten bytes, one a day, in each category
+        self.start = datetime.datetime(2020, 1, 1)
+        self.digests = {}
+        for label in ('cat1', 'cat2'):
+            self.digests[label] = [
+                self.db.put_data(
+                    label, '{} {:05d}'.format(label, i).encode(),
+                    timestamp=self.start + datetime.timedelta(days=i))
+                for i in range(10)]
+
+    def tearDown(self):
+        self.db.close()
+        if os.path.isdir(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+    def remaining(self, label):
+        return [row.digest for row in self.db.query_data(
+            category=label, order='asc')]
+
+    def test_retention_policy(self):
+        ''' check retention policies are stored with categories '''
+        db = self.db
+        self.assertEqual(
+            db.get_retention('cat1'), RetentionPolicy(None, None, None))
+        db.set_retention('cat1', max_age=3600.0, max_count=5)
+        self.assertEqual(db.get_retention('cat1'), (3600.0, None, 5))
+        db.set_retention('cat1', max_bytes=100)
+        self.assertEqual(db.get_retention('cat1'), (None, 100, None))
+        self.assertEqual(db.get_category('cat1'), ('cat1', ''))
+
+        with self.assertRaises(Exception) as cm:
+            db.set_retention('missing', max_count=1)
+        self.assertIn('not found', str(cm.exception))
+        with self.assertRaises(Exception) as cm:
+            db.get_retention('missing')
+        self.assertIn('not found', str(cm.exception))
+        with self.assertRaises(Exception) as cm:
+            db.set_retention('cat1', max_count=-1)
+        self.assertIn('Invalid max_count', str(cm.exception))
+
+    def test_collect_garbage(self):
+        ''' check each limit deletes the oldest occurrences first '''
+        db = self.db
+        cat1, cat2 = self.digests['cat1'], self.digests['cat2']
+
+        # categories without a policy are left alone
+        self.assertEqual(db.collect_garbage(), (0, 0, 0, []))
+
+        now = self.start + datetime.timedelta(days=10)
+        db.set_retention('cat1', max_age=3.5 * 86400)
+        with unittest.mock.patch('datetime.datetime') as mock_datetime:
+            mock_datetime.now.return_value = now
+            report = db.collect_garbage(batch_size=4)
+        self.assertEqual(report, (7, 7, 70, ['cat1']))
+        self.assertEqual(self.remaining('cat1'), cat1[7:])
+        for digest in cat1[:7]:
+            self.assertFalse(db.exists(digest))
+            self.assertFalse(os.path.exists(db.storage.path(digest)))
+
+        db.set_retention('cat2', max_count=6)
+        report = db.collect_garbage(categories=['cat2'], batch_size=3)
+        self.assertEqual(report, (4, 4, 40, ['cat2']))
+        self.assertEqual(self.remaining('cat2'), cat2[4:])
+
+        # the oldest items are deleted until the total is within the limit
+        db.set_retention('cat2', max_bytes=25)
+        report = db.collect_garbage(categories=['cat2'], batch_size=1)
+        self.assertEqual(report, (4, 4, 40, ['cat2']))
+        self.assertEqual(self.remaining('cat2'), cat2[8:])
+        self.assertEqual(
+            db.collect_garbage(categories=['cat2']), (0, 0, 0, []))
+        self.assertEqual(db.count_data(), 5)
+        self.assertEqual(len(list(db.storage.digests())), 5)
+
+    def test_collect_shared_items(self):
+        ''' check items shared with other categories are kept '''
+        db = self.db
+        shared = self.digests['cat2'][0]
+        result = db.put_data_dedup(
+            'cat1', b'cat2 00000', timestamp=self.start, reference=True)
+        self.assertEqual(result.digest, shared)
+
+        db.set_retention('cat1', max_count=0)
+        report = db.collect_garbage(categories=['cat1'])
+        self.assertEqual(report, (11, 10, 100, ['cat1']))
+        self.assertEqual(self.remaining('cat1'), [])
+        self.assertTrue(db.exists(shared))
+        self.assertEqual(len(self.remaining('cat2')), 10)
+
+    def test_collect_limits(self):
+        ''' check collection can be bounded and throttled '''
+        db = self.db
+        db.set_retention('cat1', max_count=0)
+        db.set_retention('cat2', max_count=0)
+
+        report = db.collect_garbage(limit=3, batch_size=2)
+        self.assertEqual(report.occurrences, 3)
+        self.assertEqual(self.remaining('cat1'), self.digests['cat1'][3:])
+
+        # a batch is deleted without delay, then deletes are paced
+        now = [0.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        collector = Collector(db, rate=10, batch_size=4)
+        collector.limiter = RateLimiter(
+            10, burst=4, clock=lambda: now[0], sleep=sleep)
+        report = collector.run()
+        self.assertEqual(report.occurrences, 17)
+        self.assertEqual(report.categories, ['cat1', 'cat2'])
+        self.assertAlmostEqual(sum(slept), 1.3)
+        self.assertEqual(db.count_data(), 0)
+
+        with self.assertRaises(Exception) as cm:
+            Collector(db, limit=-1)
+        self.assertIn('Invalid limit', str(cm.exception))
@@ -0,0 +1,204 @@
+''' Tests for digestdb.migration '''
+
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import unittest
+
+import digestdb
+from digestdb.migration import SCHEMA_VERSION
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+# The schema created by releases before the schema was versioned
+LEGACY_SCHEMA = (
+    'CREATE TABLE categories (label VARCHAR NOT NULL, description VARCHAR, '
+    'PRIMARY KEY (label))',
+    'CREATE TABLE digests (digest BLOB NOT NULL, category_label VARCHAR, '
+    'timestamp DATETIME, byte_size INTEGER, PRIMARY KEY (digest), '
+    'FOREIGN KEY(category_label) REFERENCES categories (label))',
+)
+
+
+# The tables of schema version 4 that changed in version 5
+V4_SCHEMA = LEGACY_SCHEMA[:1] + (
+    'CREATE TABLE digests (digest BLOB NOT NULL, category_label VARCHAR, '
+    'timestamp INTEGER, byte_size INTEGER, codec VARCHAR, '
+    'dictionary_id INTEGER, PRIMARY KEY (digest))',
+    'CREATE TABLE occurrences (id INTEGER NOT NULL, digest BLOB NOT NULL, '
+    'category_label VARCHAR, timestamp INTEGER, PRIMARY KEY (id), '
+    'FOREIGN KEY(digest) REFERENCES digests (digest))',
+    'CREATE INDEX ix_occurrences_digest ON occurrences (digest)',
+)
+
+
+class MigrationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        self.filename = os.path.join(self.tempdir, 'digestdb.db')
+
+    def tearDown(self):
+        if os.path.isdir(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+    def sqlite_master(self, name):
+        conn = sqlite3.connect(self.filename)
+        try:
+            return conn.execute(
+                'SELECT sql FROM sqlite_master WHERE name = ?',
+                (name,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def schema(self, filename):
+        ''' return the columns, foreign keys and indexes of each table '''
+        conn = sqlite3.connect(filename)
+        try:
+            tables = dict(
+                (name, (
+                    conn.execute('PRAGMA table_info({})'.format(name)).fetchall(),
+                    conn.execute(
+                        'PRAGMA foreign_key_list({})'.format(name)).fetchall()))
+                for name, in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            indexes = dict(conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                'AND sql IS NOT NULL').fetchall())
+            return tables, indexes
+        finally:
+            conn.close()
+
+    def test_create_schema(self):
+        ''' check a new database is created at the current version '''
+        db = digestdb.DigestDB(self.tempdir, without_rowid=True)
+        db.open()
+        db.put_category('cat1')
+        timestamp = datetime.datetime(2016, 8, 1, 12, 34, 56, 123456)
+        digest = db.put_data('cat1', b'data', timestamp=timestamp)
+        self.assertEqual(db.query_data(category='cat1')[0][3], timestamp)
+        db.close()
+
+        conn = sqlite3.connect(self.filename)
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            self.assertEqual(version, SCHEMA_VERSION)
+            stored = conn.execute(
+                'SELECT timestamp FROM occurrences WHERE digest = ?',
+                (digest,)).fetchone()[0]
+            self.assertEqual(stored, 1470054896123456)
+
+            # time sliced queries of a category are index range scans
+            plan = ' '.join(row[3] for row in conn.execute(
+                'EXPLAIN QUERY PLAN SELECT digest FROM occurrences '
+                'WHERE category_label = ? AND timestamp BETWEEN ? AND ?',
+                ('cat1', 0, 1)))
+            self.assertIn('ix_occurrences_category_timestamp', plan)
+        finally:
+            conn.close()
+        self.assertIn('WITHOUT ROWID', self.sqlite_master('digests'))
+
+    def test_migrate_legacy_schema(self):
+        ''' check a database created before schema versioning is upgraded '''
+        conn = sqlite3.connect(self.filename)
+        for ddl in LEGACY_SCHEMA:
+            conn.execute(ddl)
+        conn.execute("INSERT INTO categories VALUES ('cat1', '')")
+        conn.execute(
+            'INSERT INTO digests VALUES (?, ?, ?, ?)',
+            (b'\x01' * 32, 'cat1', '2016-08-01 12:34:56.123456', 4))
+        conn.commit()
+        conn.close()
+
+        db = digestdb.DigestDB(self.tempdir)
+        db.open()
+        self.assertEqual(db.query_data(category='cat1'), [
+            (b'\x01' * 32, 'cat1', 4,
+             datetime.datetime(2016, 8, 1, 12, 34, 56, 123456), 1)])
+        db.close()
+
+        self.assertNotIn('WITHOUT ROWID', self.sqlite_master('digests'))
+        self.assertNotIn('category_label', self.sqlite_master('digests'))
+        self.assertIn('max_count', self.sqlite_master('categories'))
+        self.assertIn(
+            'category_label',
+            self.sqlite_master('ix_occurrences_category_timestamp'))
+        self.assertIn(
+            'REFERENCES digests (', self.sqlite_master('occurrences'))
+
+        # the migrated schema matches the schema of a new database
+        new_dir = os.path.join(self.tempdir, 'new')
+        os.mkdir(new_dir)
+        db = digestdb.DigestDB(new_dir)
+        db.open()
+        db.close()
+        self.assertEqual(
+            self.schema(self.filename),
+            self.schema(os.path.join(new_dir, 'digestdb.db')))
+
+        # reopening a migrated database leaves it unchanged
+        db = digestdb.DigestDB(self.tempdir)
+        db.open()
+        self.assertEqual(db.count_data(), 1)
+        db.close()
+
+    def test_migrate_occurrences(self):
+        ''' check later occurrences are counted as references '''
+        conn = sqlite3.connect(self.filename)
+        for ddl in V4_SCHEMA:
+            conn.execute(ddl)
+        conn.execute("INSERT INTO categories VALUES ('cat1', '')")
+        conn.execute("INSERT INTO categories VALUES ('cat2', '')")
+        digest = digestdb.hashify.data_digest(b'data')
+        conn.execute(
+            'INSERT INTO digests VALUES (?, ?, ?, ?, NULL, NULL)',
+            (digest, 'cat1', 1470054896123456, 4))
+        conn.execute(
+            'INSERT INTO occurrences (digest, category_label, timestamp) '
+            'VALUES (?, ?, ?)', (digest, 'cat2', 1470054897000000))
+        conn.execute('PRAGMA user_version = 4')
+        conn.commit()
+        conn.close()
+
+        db = digestdb.DigestDB(self.tempdir, dir_depth=1)
+        db.open()
+        db.storage.put(digest, b'data')
+        self.assertEqual(
+            [category for category, _ in db.query_occurrences(digest)],
+            ['cat1', 'cat2'])
+        self.assertEqual(
+            [row.category_label for row in db.query_data(order='asc')],
+            ['cat1', 'cat2'])
+        self.assertIn(
+            '(timestamp, digest, id)',
+            self.sqlite_master('ix_occurrences_timestamp'))
+        db.delete_data(digest, category='cat1')
+        self.assertTrue(db.exists(digest))
+        db.delete_data(digest, category='cat2')
+        self.assertFalse(db.exists(digest))
+        self.assertEqual(list(db.storage.digests()), [])
+        db.close()
+
+    def test_newer_schema(self):
+        ''' check a database created by a newer release is not opened '''
+        db = digestdb.DigestDB(self.tempdir)
+        db.open()
+        db.close()
+        conn = sqlite3.connect(self.filename)
+        conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION + 1))
+        conn.close()
+
+        db = digestdb.DigestDB(self.tempdir)
+        with self.assertRaises(Exception) as cm:
+            db.open()
+        expected = 'is newer than the supported version'
+        self.assertIn(expected, str(cm.exception))
+
+        # the failed open released the database's locks
+        with self.assertRaises(Exception) as cm:
+            db.open()
+        self.assertIn(expected, str(cm.exception))
@@ -0,0 +1,106 @@
+''' Tests for digestdb.pack '''
+
+import os
+import shutil
+import tempfile
+
+import unittest
+
+import digestdb
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+def make_items(count, size=100):
+    items = []
+    for i in range(count):
+        data = '{:04d}'.format(i).encode() * (size // 4)
+        items.append((digestdb.hashify.data_digest(data), data))
+    return items
+
+
+class PackStoreTestCase(unittest.TestCase):
+
+    def test_pack_put_get_delete(self):
+        ''' check blobs can be appended, read back and deleted '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        try:
+            store = digestdb.pack.PackStore(
+                os.path.join(tempdir, 'packs'), max_pack_size=1000)
+            store.open()
+
+            items = make_items(25)
+            digest, data = items[0]
+            store.put(digest, data)
+            with self.assertRaises(Exception) as cm:
+                store.put(digest, data)
+            expected = 'Duplicate pack entry detected'
+            self.assertIn(expected, str(cm.exception))
+
+            errors = store.put_many(items[1:] + items[1:2])
+            self.assertEqual(errors[:-1], [None] * 24)
+            self.assertIsInstance(errors[-1], Exception)
+
+            # 100 byte blobs in 1000 byte packs
+            self.assertEqual(store.pack_ids(), [1, 2, 3])
+            for digest, data in items:
+                self.assertTrue(store.exists(digest))
+                self.assertEqual(store.get(digest), data)
+            self.assertEqual(store.locate(items[12][0]), (2, 200, 100))
+            self.assertEqual(
+                sorted(store.digests()), sorted(d for d, _ in items))
+
+            self.assertTrue(store.delete(items[0][0]))
+            self.assertFalse(store.delete(items[0][0]))
+            with self.assertRaises(FileNotFoundError):
+                store.get(items[0][0])
+            self.assertFalse(store.exists(items[0][0]))
+
+            store.close()
+
+            # contents persist across reopening
+            store.open()
+            self.assertEqual(store.get(items[24][0]), items[24][1])
+            store.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
+
+    def test_pack_compaction(self):
+        ''' check compaction reclaims the space used by deleted blobs '''
+        tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        try:
+            store = digestdb.pack.PackStore(
+                os.path.join(tempdir, 'packs'), max_pack_size=1000)
+            store.open()
+
+            items = make_items(30)
+            store.put_many(items)
+            for digest, _ in items[:8]:
+                store.delete(digest)
+
+            stats = store.stats()
+            self.assertEqual(stats.packs, 3)
+            self.assertEqual(stats.items, 22)
+            self.assertEqual(stats.total_bytes, 3000)
+            self.assertEqual(stats.live_bytes, 2200)
+
+            # pack 1 is 80% unused, pack 2 is fully used, pack 3 is active
+            view = store.view(items[9][0])
+            reclaimed = store.compact(min_dead_ratio=0.5)
+            self.assertEqual(reclaimed, 800)
+            self.assertNotIn(1, store.pack_ids())
+            self.assertEqual(store.stats().total_bytes, 2200)
+
+            # views taken before compaction remain valid
+            self.assertEqual(view, items[9][1])
+            for digest, data in items[8:]:
+                self.assertEqual(store.get(digest), data)
+
+            store.close()
+
+        finally:
+            if os.path.isdir(tempdir):
+                shutil.rmtree(tempdir)
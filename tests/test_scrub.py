@@ -0,0 +1,221 @@
+''' Tests for digestdb.scrub '''
+
+import os
+import shutil
+import tempfile
+
+import unittest
+
+import digestdb
+from digestdb.model import Digest
+from digestdb.scrub import (
+    SCRUB_DIGEST_MISMATCH, SCRUB_MISSING, SCRUB_SIZE_MISMATCH,
+    SCRUB_UNREADABLE, RateLimiter)
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class ScrubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        self.db = digestdb.DigestDB(
+            self.tempdir, dir_depth=1, pack_threshold=40, cache_size=100,
+            compression='zlib', compression_threshold=300)
+        self.db.open()
+        self.db.put_category('cat1')
+        # random data so that compressed items are still stored in files
+        self.blobs = [
+            os.urandom(i) + b'abc' * i for i in range(1, 120, 4)]
+        self.digests = [self.db.put_data('cat1', blob) for blob in self.blobs]
+
+    def tearDown(self):
+        self.db.close()
+        if os.path.isdir(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+    def file_digests(self, codec):
+        ''' return the digests of items stored in files using a codec '''
+        rows = self.db.session.query(Digest.digest).filter(
+            Digest.digest.in_(self.digests), Digest.codec.is_(codec))
+        return sorted(
+            row[0] for row in rows if not self.db.packs.exists(row[0]))
+
+    def damage(self, digest):
+        ''' change the first byte of an item stored in a file '''
+        with open(self.db.storage.large.path(digest), 'r+b') as fd:
+            first = fd.read(1)
+            fd.seek(0)
+            fd.write(bytes([first[0] ^ 0xff]))
+
+    def test_rate_limiter(self):
+        ''' check consumers are delayed to keep to the rate '''
+        now = [0.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+
+        limiter = RateLimiter(100, clock=lambda: now[0], sleep=sleep)
+        limiter.consume(100)
+        self.assertEqual(sleeps, [])
+        limiter.consume(50)
+        self.assertEqual(sleeps, [0.5])
+        now[0] += 10
+        limiter.consume(100)
+        self.assertEqual(sleeps, [0.5])
+
+        with self.assertRaises(Exception) as cm:
+            RateLimiter(0)
+        self.assertIn('Invalid rate', str(cm.exception))
+
+    def test_scrub(self):
+        ''' check damaged and missing items are reported '''
+        report = self.db.scrub(workers=2, batch_size=7)
+        self.assertEqual(report.checked, len(self.digests))
+        self.assertEqual(report.issues, [])
+        self.assertGreater(report.bytes_read, 0)
+        timestamp, problem = self.db.last_verified(self.digests[0])
+        self.assertIsNone(problem)
+        self.assertIsNone(self.db.last_verified(b'missing'))
+
+        # items verified recently are skipped
+        self.assertEqual(self.db.scrub(max_age=3600).checked, 0)
+        self.assertEqual(self.db.scrub(limit=5).checked, 5)
+
+        plain = self.file_digests(None)
+        compressed = self.file_digests('zlib')
+        with open(self.db.storage.large.path(plain[0]), 'r+b') as fd:
+            fd.write(b'X')
+        os.remove(self.db.storage.large.path(plain[1]))
+        with open(self.db.storage.large.path(compressed[0]), 'r+b') as fd:
+            fd.write(b'XXXX')
+        packed = [d for d in self.digests if self.db.packs.exists(d)]
+        self.db.session.query(Digest).filter_by(digest=packed[0]).update(
+            {'byte_size': 1000})
+        self.db.session.commit()
+
+        report = self.db.scrub(max_age=3600)
+        self.assertEqual(report.checked, 0)
+        report = self.db.scrub()
+        self.assertEqual(report.checked, len(self.digests))
+        problems = dict((issue.digest, issue.problem) for issue in report.issues)
+        self.assertEqual(problems, {
+            plain[0]: SCRUB_DIGEST_MISMATCH,
+            plain[1]: SCRUB_MISSING,
+            compressed[0]: SCRUB_UNREADABLE,
+            packed[0]: SCRUB_SIZE_MISMATCH})
+        self.assertEqual(report.quarantined, [])
+        self.assertEqual(
+            self.db.last_verified(plain[0])[1], SCRUB_DIGEST_MISMATCH)
+
+    def test_scrub_quarantine(self):
+        ''' check damaged items are moved out of storage '''
+        damaged = self.file_digests(None)[0]
+        self.assertTrue(self.db.exists(damaged))
+        path = self.db.storage.large.path(damaged)
+        with open(path, 'r+b') as fd:
+            fd.write(b'X')
+
+        report = self.db.scrub(quarantine=True, rate=2**30)
+        self.assertEqual(report.quarantined, [damaged])
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(self.db.exists(damaged))
+        with open(os.path.join(self.db.quarantine_dir, damaged.hex()),
+                  'rb') as fd:
+            self.assertTrue(fd.read().startswith(b'X'))
+        self.assertEqual(self.db.reconcile().missing, [damaged])
+
+        self.db.delete_data(damaged)
+        self.assertIsNone(self.db.last_verified(damaged))
+
+    def test_scrub_repair(self):
+        ''' check putting a damaged item again repairs it '''
+        db = self.db
+        damaged = self.file_digests(None)[:2]
+        for digest in damaged:
+            self.damage(digest)
+        report = db.scrub(quarantine=True, rate=2**30)
+        self.assertEqual(report.quarantined, damaged)
+
+        blob = self.blobs[self.digests.index(damaged[0])]
+        self.assertEqual(db.put_data('cat1', blob), damaged[0])
+        self.assertTrue(db.exists(damaged[0]))
+        self.assertEqual(db.get_data(damaged[0]), blob)
+        self.assertIsNone(db.last_verified(damaged[0]))
+        self.assertEqual(len(db.query_occurrences(damaged[0])), 2)
+
+        blob = self.blobs[self.digests.index(damaged[1])]
+        result = db.put_data_dedup('cat1', blob)
+        self.assertEqual(result, (damaged[1], 'stored', None))
+        self.assertEqual(db.get_data(damaged[1]), blob)
+        self.assertEqual(
+            db.put_data_dedup('cat1', blob).status, 'duplicate')
+
+        # the repairs were committed
+        db.session.rollback()
+        self.assertIsNone(db.last_verified(damaged[1]))
+        report = db.scrub(rate=2**30)
+        self.assertEqual(report.issues, [])
+        self.assertEqual(report.quarantined, [])
+
+    def test_scrub_repair_batch(self):
+        ''' check putting damaged items in a batch repairs them '''
+        db = self.db
+        quarantined, damaged, later = self.file_digests(None)[:3]
+        for digest in (quarantined, later):
+            self.damage(digest)
+        db.scrub(quarantine=True, rate=2**30)
+        # a damaged copy that was not quarantined is replaced
+        self.damage(damaged)
+        report = db.scrub(rate=2**30)
+        self.assertIn(damaged, [issue.digest for issue in report.issues])
+
+        blobs = [self.blobs[self.digests.index(d)] for d in
+                 (quarantined, damaged, quarantined)] + [b'new item']
+        results = db.put_data_batch(
+            [('cat1', blob, None) for blob in blobs], reference=True)
+        self.assertEqual(
+            [result.status for result in results],
+            ['stored', 'stored', 'duplicate', 'stored'])
+        for digest, blob in zip((quarantined, damaged), blobs):
+            self.assertTrue(db.exists(digest))
+            self.assertEqual(db.get_data(digest), blob)
+            self.assertIsNone(db.last_verified(digest))
+        self.assertEqual(len(db.query_occurrences(quarantined)), 3)
+        self.assertEqual(len(db.query_occurrences(damaged)), 2)
+
+        blob = self.blobs[self.digests.index(later)]
+        self.assertEqual(db.put_data_many(('cat1', blob, None)), [later])
+        self.assertEqual(db.get_data(later), blob)
+        self.assertEqual(len(db.query_occurrences(later)), 1)
+
+        report = db.scrub(rate=2**30)
+        self.assertEqual(report.issues, [])
+
+    def test_scrub_repair_copied(self):
+        ''' check copying damaged items in again repairs them '''
+        db = self.db
+        damaged = self.file_digests(None)[:3]
+        for digest in damaged[:2]:
+            self.damage(digest)
+        db.scrub(quarantine=True, rate=2**30)
+        self.damage(damaged[2])
+        db.scrub(rate=2**30)
+
+        blob = self.blobs[self.digests.index(damaged[0])]
+        self.assertEqual(db.put_stream('cat1', [blob]), damaged[0])
+        for digest in damaged[1:]:
+            path = os.path.join(self.tempdir, 'source')
+            with open(path, 'wb') as fd:
+                fd.write(self.blobs[self.digests.index(digest)])
+            self.assertEqual(db.put_file('cat1', path), digest)
+
+        for digest in damaged:
+            self.assertEqual(
+                db.get_data(digest), self.blobs[self.digests.index(digest)])
+            self.assertIsNone(db.last_verified(digest))
+            self.assertEqual(len(db.query_occurrences(digest)), 2)
+        self.assertEqual(db.scrub(rate=2**30).issues, [])
@@ -0,0 +1,219 @@
+''' Tests for digestdb.storage '''
+
+import os
+import shutil
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+import unittest
+import unittest.mock
+
+import digestdb
+from digestdb.compression import (
+    FRAME_MAGIC, compress, frame, frame_plain)
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+    def tearDown(self):
+        if os.path.isdir(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+    def check_storage(self, storage):
+        ''' exercise the storage interface '''
+        storage.open()
+        try:
+            small = b'small'
+            large = b'large' * 100
+            small_digest = digestdb.hashify.data_digest(small)
+            large_digest = digestdb.hashify.data_digest(large)
+
+            storage.put(small_digest, small)
+            with self.assertRaises(Exception) as cm:
+                storage.put(small_digest, small)
+            self.assertIn('Duplicate', str(cm.exception))
+
+            errors = storage.put_many(
+                [(large_digest, large), (small_digest, small)])
+            self.assertIsNone(errors[0])
+            self.assertIsInstance(errors[1], Exception)
+
+            for digest, data in ((small_digest, small), (large_digest, large)):
+                self.assertTrue(storage.exists(digest))
+                self.assertEqual(storage.stat(digest), len(data))
+                self.assertEqual(storage.get(digest), data)
+                self.assertEqual(storage.view(digest), data)
+                with storage.open_file(digest) as fd:
+                    self.assertEqual(fd.read(), data)
+                self.assertEqual(
+                    b''.join(storage.iter_chunks(digest, chunk_size=7)), data)
+                buffer = bytearray(1000)
+                self.assertEqual(storage.read_into(digest, buffer), len(data))
+                self.assertEqual(buffer[:len(data)], data)
+
+            self.assertEqual(
+                sorted(storage.digests()), sorted([small_digest, large_digest]))
+            for digest in (small_digest, large_digest):
+                self.assertIn(digest, storage.shard_digests(digest.hex()[:2]))
+            self.assertEqual(
+                sum(len(storage.shard_digests(s))
+                    for s in digestdb.storage.SHARDS), 2)
+            self.assertEqual(
+                dict(storage.get_many([small_digest, b'missing'])),
+                {small_digest: small, b'missing': None})
+
+            digest, size = storage.put_stream(
+                iter([b'str', b'eam']), hash_name='sha256')
+            self.assertEqual(digest, digestdb.hashify.data_digest(b'stream'))
+            self.assertEqual(size, 6)
+
+            filepath = os.path.join(self.tempdir, 'source')
+            with open(filepath, 'wb') as fd:
+                fd.write(b'file contents')
+            file_digest = digestdb.hashify.file_digest(filepath)
+            self.assertEqual(storage.put_file(filepath, file_digest), 13)
+            self.assertEqual(storage.get(file_digest), b'file contents')
+
+            # replacing an item may move it between hybrid backends
+            storage.replace(file_digest, b'replaced' * 100)
+            self.assertEqual(storage.get(file_digest), b'replaced' * 100)
+            storage.replace(file_digest, b'file contents')
+            self.assertEqual(storage.get(file_digest), b'file contents')
+
+            self.assertTrue(storage.delete(small_digest))
+            self.assertFalse(storage.delete(small_digest))
+            self.assertFalse(storage.exists(small_digest))
+            with self.assertRaises(FileNotFoundError):
+                storage.get(small_digest)
+            with self.assertRaises(OSError):
+                storage.stat(small_digest)
+            self.assertEqual(
+                storage.delete_many([large_digest, digest, b'missing']), 2)
+            self.assertEqual(list(storage.digests()), [file_digest])
+        finally:
+            storage.close()
+
+    def test_read_database_file(self):
+        ''' check stored data can be decoded as it is read '''
+        data = b'{"kind": "position", "id": 1, "status": "nominal"}' * 10
+        dictionary = b'"kind": "position", "status": "nominal"'
+        compressed = compress(data, 'zlib', dictionary=dictionary)
+        plain = FRAME_MAGIC + data
+        items = [
+            (compress(data, 'zlib'), dict(codec='zlib')),
+            (compressed, dict(codec='zlib', dictionary=dictionary)),
+            # recompressed items are framed whatever their recorded codec
+            (frame(compressed, 'zlib', 7), dict(codec='zlib')),
+            (frame(compressed, 'zlib', 7), dict(decode=True)),
+            (frame_plain(plain), dict(decode=True))]
+        for index, (stored, kwargs) in enumerate(items):
+            digest = bytes([index]) * 32
+            digestdb.storage.write_database_file(
+                digest, stored, self.tempdir, 1)
+            self.assertEqual(
+                b''.join(digestdb.storage.read_database_file(
+                    digest, self.tempdir, 1)), stored)
+            expected = plain if index == 4 else data
+            self.assertEqual(
+                b''.join(digestdb.storage.read_database_file(
+                    digest, self.tempdir, 1, chunk_size=5,
+                    dictionaries={7: dictionary}.get, **kwargs)), expected)
+
+    def test_memory_storage(self):
+        ''' check the in-memory storage backend '''
+        self.check_storage(digestdb.storage.MemoryStorage())
+
+    def test_file_storage(self):
+        ''' check the file storage backend '''
+        self.check_storage(digestdb.storage.FileStorage(
+            os.path.join(self.tempdir, 'data'), dir_depth=2))
+
+    def test_hybrid_storage(self):
+        ''' check the hybrid pack and file storage backend '''
+        packs = digestdb.pack.PackStore(os.path.join(self.tempdir, 'packs'))
+        files = digestdb.storage.FileStorage(
+            os.path.join(self.tempdir, 'data'), dir_depth=1)
+        storage = digestdb.storage.HybridStorage(packs, files, threshold=100)
+        self.check_storage(storage)
+
+    def test_database_storage(self):
+        ''' check the database can use an alternative storage backend '''
+        storage = digestdb.storage.MemoryStorage()
+        db = digestdb.DigestDB(self.tempdir, storage=storage)
+        db.open()
+        db.put_category('cat1')
+        digest = db.put_data('cat1', b'in memory')
+        self.assertEqual(storage.items, {digest: b'in memory'})
+        self.assertTrue(db.exists(digest))
+        self.assertEqual(db.get_data(digest), b'in memory')
+        self.assertEqual(digestdb.database.sync_file_system(db.data_dir, db), [])
+        db.delete_data(digest)
+        self.assertEqual(storage.items, {})
+        self.assertFalse(os.path.exists(db.data_dir))
+        db.close()
+
+    def test_file_storage_durability(self):
+        ''' check items are written atomically and flushed as configured '''
+        with self.assertRaises(Exception) as cm:
+            digestdb.storage.FileStorage(self.tempdir, durability='always')
+        self.assertIn('Invalid durability', str(cm.exception))
+
+        items = [(digestdb.hashify.data_digest(data), data)
+                 for data in (b'one' * 10, b'two' * 10, b'three' * 10)]
+        for durability in digestdb.storage.DURABILITY_MODES:
+            for executor in (None, ThreadPoolExecutor(max_workers=2)):
+                data_dir = os.path.join(self.tempdir, durability)
+                shutil.rmtree(data_dir, ignore_errors=True)
+                storage = digestdb.storage.FileStorage(
+                    data_dir, dir_depth=2, durability=durability)
+                self.check_storage(storage)
+                with unittest.mock.patch(
+                        'os.fsync', wraps=os.fsync) as fsync:
+                    errors = storage.put_many(
+                        items + items[:1], executor=executor)
+                if executor:
+                    executor.shutdown()
+                self.assertEqual(errors[:3], [None, None, None])
+                self.assertIn('Duplicate file detected', str(errors[3]))
+                for digest, data in items:
+                    self.assertEqual(storage.get(digest), data)
+                # each file and each directory is flushed
+                expected = 0 if durability == 'none' else 6
+                self.assertEqual(fsync.call_count, expected)
+
+        # a failed write never leaves a partial item at the digest path
+        storage = digestdb.storage.FileStorage(
+            os.path.join(self.tempdir, 'failed'), dir_depth=1)
+        digest, data = items[0]
+        with unittest.mock.patch('os.replace', side_effect=OSError('boom')):
+            with self.assertRaises(OSError):
+                storage.put(digest, data)
+            self.assertIsInstance(storage.put_many(items)[0], OSError)
+            with self.assertRaises(OSError):
+                storage.put_stream([data])
+        self.assertEqual(list(storage.digests()), [])
+        for dirpath, dirnames, filenames in os.walk(storage.data_dir):
+            self.assertEqual(filenames, [])
+
+    def test_pack_storage_durability(self):
+        ''' check pack files are flushed as configured '''
+        for durability, expected in (('none', 0), ('fsync', 2)):
+            packs = digestdb.pack.PackStore(
+                os.path.join(self.tempdir, durability), durability=durability)
+            packs.open()
+            try:
+                with unittest.mock.patch(
+                        'os.fsync', wraps=os.fsync) as fsync:
+                    packs.put_many([(b'a', b'1'), (b'b', b'2')])
+                    packs.put(b'c', b'3')
+                self.assertEqual(fsync.call_count, expected)
+                self.assertEqual(packs.get(b'c'), b'3')
+            finally:
+                packs.close()
@@ -0,0 +1,134 @@
+''' Tests for digestdb.sync '''
+
+import os
+import shutil
+import tempfile
+import time
+
+import unittest
+import unittest.mock
+
+import digestdb
+from digestdb.sync import Reconciler, diff_sorted
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class SyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+        self.db = digestdb.DigestDB(
+            self.tempdir, dir_depth=2, pack_threshold=20)
+        self.db.open()
+        self.db.put_category('cat1')
+        self.digests = [
+            self.db.put_data('cat1', 'item {}'.format(i).encode() * i)
+            for i in range(1, 40)]
+        self.state_file = os.path.join(self.tempdir, 'sync.json')
+
+    def tearDown(self):
+        self.db.close()
+        if os.path.isdir(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+    def add_untracked(self, data):
+        ''' add an item to storage without adding it to the database '''
+        digest = digestdb.hashify.data_digest(data)
+        self.db.storage.put(digest, data)
+        return digest
+
+    def test_diff_sorted(self):
+        ''' check sorted streams are compared '''
+        self.assertEqual(
+            diff_sorted([b'a', b'c', b'd', b'f'], [b'b', b'c', b'e', b'f', b'g']),
+            ([b'a', b'd'], [b'b', b'e', b'g']))
+        self.assertEqual(diff_sorted([], [b'a']), ([], [b'a']))
+
+    def test_reconcile(self):
+        ''' check differences are found in both directions '''
+        report = self.db.reconcile(workers=4)
+        self.assertEqual(report.untracked, [])
+        self.assertEqual(report.missing, [])
+        self.assertEqual(len(report.scanned), 256)
+
+        untracked = sorted([
+            self.add_untracked(b'untracked pack item'),
+            self.add_untracked(b'untracked file item' * 10)])
+        missing = sorted(
+            [d for d in self.digests if not self.db.packs.exists(d)][:3])
+        for digest in missing:
+            os.remove(self.db.storage.large.path(digest))
+        # files that are not items are ignored
+        with open(os.path.join(self.db.data_dir, 'README'), 'w') as fd:
+            fd.write('not an item')
+
+        report = self.db.reconcile(workers=4)
+        self.assertEqual(report.untracked, untracked)
+        self.assertEqual(report.missing, missing)
+        self.assertEqual(
+            digestdb.database.sync_file_system(self.db.data_dir, self.db),
+            untracked)
+
+    def test_reconcile_resume(self):
+        ''' check an interrupted run resumes from its checkpoint '''
+        untracked = self.add_untracked(b'untracked file item' * 10)
+        shard = untracked.hex()[:2]
+
+        reconciler = Reconciler(self.db, state_file=self.state_file)
+        rows = reconciler._shard_rows
+
+        def interrupt(name):
+            if name > shard:
+                raise KeyboardInterrupt()
+            return rows(name)
+
+        with unittest.mock.patch.object(
+                reconciler, '_shard_rows', side_effect=interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                reconciler.run()
+
+        report = self.db.reconcile(state_file=self.state_file)
+        self.assertEqual(report.untracked, [untracked])
+        self.assertIn(shard, report.skipped)
+        self.assertNotIn(shard, report.scanned)
+        self.assertEqual(len(report.scanned) + len(report.skipped), 256)
+
+        # the completed run is not resumed again
+        report = self.db.reconcile(state_file=self.state_file)
+        self.assertEqual(len(report.scanned), 256)
+
+    def test_reconcile_incremental(self):
+        ''' check unchanged shards are skipped '''
+        with self.assertRaises(Exception) as cm:
+            self.db.reconcile(incremental=True)
+        self.assertIn('requires a state_file', str(cm.exception))
+
+        with unittest.mock.patch.object(
+                digestdb.storage, 'SIGNATURE_SETTLE_TIME', 0):
+            report = self.db.reconcile(
+                state_file=self.state_file, incremental=True)
+            self.assertEqual(len(report.scanned), 256)
+
+            report = self.db.reconcile(
+                state_file=self.state_file, incremental=True)
+            self.assertEqual(report.scanned, [])
+
+            # wait so that the directory modification time changes
+            time.sleep(0.05)
+            untracked = self.add_untracked(b'untracked file item' * 10)
+            report = self.db.reconcile(
+                state_file=self.state_file, incremental=True)
+            self.assertEqual(report.scanned, [untracked.hex()[:2]])
+            self.assertEqual(report.untracked, [untracked])
+
+            # shards with differences are always rescanned
+            report = self.db.reconcile(
+                state_file=self.state_file, incremental=True)
+            self.assertEqual(report.untracked, [untracked])
+
+        # recently modified shards are never skipped
+        report = self.db.reconcile(
+            state_file=self.state_file, incremental=True)
+        self.assertIn(untracked.hex()[:2], report.scanned)
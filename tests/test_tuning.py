@@ -0,0 +1,113 @@
+''' Tests for digestdb.tuning '''
+
+import os
+import shutil
+import tempfile
+
+import unittest
+import unittest.mock
+
+import digestdb
+from digestdb.tuning import PROFILES, SQLiteProfile, get_profile
+
+
+SYS_TMP_DIR = os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class TuningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(dir=SYS_TMP_DIR)
+
+    def tearDown(self):
+        if os.path.isdir(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+    def pragmas(self, db):
+        ''' return the settings of a connection from the database's pool '''
+        raw = db.engine.raw_connection()
+        try:
+            return dict(
+                (name, raw.driver_connection.execute(
+                    'PRAGMA {}'.format(name)).fetchone()[0])
+                for name in ('journal_mode', 'synchronous', 'cache_size',
+                             'mmap_size', 'temp_store', 'busy_timeout'))
+        finally:
+            raw.close()
+
+    def test_get_profile(self):
+        ''' check profiles are looked up and validated '''
+        self.assertEqual(set(PROFILES), {'durable', 'balanced', 'bulk-load'})
+        self.assertIs(get_profile('balanced'), PROFILES['balanced'])
+        custom = PROFILES['durable']._replace(synchronous='normal')
+        self.assertIs(get_profile(custom), custom)
+
+        with self.assertRaises(Exception) as cm:
+            get_profile('fast')
+        self.assertIn('Invalid SQLite profile', str(cm.exception))
+        with self.assertRaises(Exception) as cm:
+            get_profile(custom._replace(journal_mode='wal; DROP TABLE x'))
+        self.assertIn('Invalid journal_mode', str(cm.exception))
+        with self.assertRaises(Exception) as cm:
+            get_profile(custom._replace(cache_size=-1))
+        self.assertIn('Invalid cache_size', str(cm.exception))
+        with self.assertRaises(Exception) as cm:
+            digestdb.DigestDB(self.tempdir, sqlite_profile='fast')
+        self.assertIn('Invalid SQLite profile', str(cm.exception))
+
+    def test_database_profiles(self):
+        ''' check profiles are applied to every connection '''
+        db = digestdb.DigestDB(self.tempdir, dir_depth=1)
+        db.open()
+        try:
+            self.assertEqual(self.pragmas(db), {
+                'journal_mode': 'wal', 'synchronous': 2, 'cache_size': -65536,
+                'mmap_size': 0, 'temp_store': 0, 'busy_timeout': 5000})
+            db.put_category('cat1')
+            digest = db.put_data('cat1', b'data')
+        finally:
+            db.close()
+
+        profile = SQLiteProfile(
+            journal_mode='delete', synchronous='normal', cache_size=1024,
+            mmap_size=2**20, temp_store='memory', busy_timeout=100)
+        db = digestdb.DigestDB(
+            self.tempdir, dir_depth=1, sqlite_profile=profile)
+        db.open()
+        try:
+            self.assertEqual(self.pragmas(db), {
+                'journal_mode': 'delete', 'synchronous': 1,
+                'cache_size': -1024, 'mmap_size': 2**20, 'temp_store': 2,
+                'busy_timeout': 100})
+            self.assertEqual(db.get_data(digest), b'data')
+        finally:
+            db.close()
+
+    def test_bulk_load(self):
+        ''' check a bulk load is flushed when the database is closed '''
+        db = digestdb.DigestDB(
+            self.tempdir, dir_depth=1, sqlite_profile='balanced')
+        db.open(bulk_load=True)
+        self.assertTrue(db.bulk_load)
+        pragmas = self.pragmas(db)
+        self.assertEqual(pragmas['synchronous'], 0)
+        self.assertEqual(pragmas['mmap_size'], 2**30)
+        db.put_category('cat1')
+        results = db.put_data_batch(
+            [('cat1', 'item {}'.format(i).encode(), None)
+             for i in range(100)])
+        with unittest.mock.patch(
+                'digestdb.database.checkpoint',
+                wraps=digestdb.tuning.checkpoint) as checkpoint:
+            db.close()
+        checkpoint.assert_called_once_with(
+            unittest.mock.ANY, synchronous='normal')
+
+        db.open()
+        try:
+            self.assertFalse(db.bulk_load)
+            self.assertEqual(self.pragmas(db)['synchronous'], 1)
+            self.assertEqual(db.count_data(), 100)
+            self.assertEqual(db.get_data(results[99].digest), b'item 99')
+        finally:
+            db.close()